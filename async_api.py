@@ -0,0 +1,136 @@
+'''Asyncio counterparts of the ingest functions in insert_data.py and the reports in query_data.py.
+
+Every coroutine runs on an AsyncSession over the aiosqlite driver, so an async service can await
+them directly instead of pushing the synchronous functions onto a thread pool. Like their
+synchronous counterparts they open a session of their own per call unless one is passed in, and
+the rollup and summary-cache events fire exactly as they do for synchronous sessions. Reports
+return their results instead of printing them.
+
+get_dashboard() runs the workout, nutrition, sleep and mood summaries concurrently with
+asyncio.gather(), each on its own session, since one AsyncSession cannot run two statements at once.
+'''
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from create import User, FitnessGoal, Workout, NutritionLog
+from database import get_async_engine, async_session_scope
+import query_data
+import summaries
+import goal_progress
+import rollups # Registers the events that keep the daily rollup tables in step with every write below
+
+engine = get_async_engine() # Writes go through the configured database's writer pool
+read_engine = get_async_engine(read_only=True) # Reports use query-only connections that never wait for the writer
+WriteSession = async_sessionmaker(engine, expire_on_commit=False)
+ReadSession = async_sessionmaker(read_engine, expire_on_commit=False)
+
+DASHBOARD_PANELS = ( # (summary, tables it reads) in the order of the Dashboard fields
+    (summaries.nutrition_summary, ('nutrition_logs',)),
+    (summaries.workout_summary, ('workouts',)),
+    (summaries.sleep_overview, ('sleep_records',)),
+    (summaries.mood_trends, ('mood_logs',)),
+)
+
+async def register_user_with_goals(user_details, goal_details, session=None):
+    '''Register a new user with fitness goals and return the user's ID, or None if it failed'''
+    async with async_session_scope(WriteSession, session) as session:
+        try:
+            new_user = User(**user_details)
+            session.add(new_user)
+            await session.flush() # Assigns the user's ID for the goals below
+            session.add_all([FitnessGoal(**dict(goal_detail, user_id=new_user.id)) for goal_detail in goal_details])
+            await session.commit()
+            return new_user.id
+        except SQLAlchemyError as e:
+            await session.rollback()
+            print(f"Error during registration: {e}")
+            return None
+
+async def log_workout_and_update_goals(user_id, workout_data, goal_updates=None, session=None):
+    '''Log a new workout and update the status of the user's fitness goals; return whether it succeeded'''
+    async with async_session_scope(WriteSession, session) as session:
+        try:
+            session.add(Workout(user_id=user_id, **workout_data))
+            if goal_updates:
+                goals = await session.scalars(select(FitnessGoal).where(FitnessGoal.id.in_(goal_updates), FitnessGoal.user_id == user_id))
+                for goal in goals:
+                    goal.completed = goal_updates[goal.id]
+            await session.commit()
+            return True
+        except SQLAlchemyError as e:
+            await session.rollback()
+            print(f"Error during workout logging: {e}")
+            return False
+
+async def log_entries(entries, session=None):
+    '''Insert log rows (workouts, nutrition logs, sleep records or mood logs) in one transaction'''
+    async with async_session_scope(WriteSession, session) as session:
+        session.add_all(entries)
+        await session.flush()
+
+async def _summary(summary, tables, user_id, start, end, session):
+    '''Read-through the summary cache shared with query_data.py for one of the summaries functions'''
+    async with async_session_scope(ReadSession, session) as session:
+        return await session.run_sync(lambda sync_session: query_data._cached_summary(summary, tables, sync_session, user_id, start, end))
+
+async def get_user_workouts(user_id, session=None):
+    '''Return all workouts of a user'''
+    async with async_session_scope(ReadSession, session) as session:
+        return (await session.scalars(select(Workout).where(Workout.user_id == user_id))).all()
+
+async def get_average_sleep_duration(user_id, session=None):
+    '''Return the average sleep duration in hours over the last month, or None without records'''
+    overview = await _summary(summaries.sleep_overview, ('sleep_records',), user_id, *query_data._last_month_window(), session)
+    return overview.average_hours
+
+async def get_nutrition_summary(user_id, date, session=None):
+    '''Return the nutrition logs of one day'''
+    start, end = query_data._day_window(date)
+    async with async_session_scope(ReadSession, session) as session:
+        return (await session.scalars(select(NutritionLog).where(NutritionLog.user_id == user_id, NutritionLog.date >= start, NutritionLog.date < end))).all()
+
+async def get_user_fitness_goals(user_id, session=None):
+    '''Return all fitness goals of a user'''
+    async with async_session_scope(ReadSession, session) as session:
+        return (await session.scalars(select(FitnessGoal).where(FitnessGoal.user_id == user_id))).all()
+
+async def get_detailed_nutrition_summary(user_id, start_date, end_date, session=None):
+    '''Return the NutritionSummary between two dates, both included'''
+    return await _summary(summaries.nutrition_summary, ('nutrition_logs',), user_id, *query_data._date_window(start_date, end_date), session)
+
+async def get_monthly_workout_summary(user_id, current_month, current_year, session=None):
+    '''Return the WorkoutSummary of a calendar month'''
+    return await _summary(summaries.workout_summary, ('workouts',), user_id, *query_data._month_window(current_month, current_year), session)
+
+async def get_sleep_quality_overview(user_id, session=None):
+    '''Return the SleepOverview of the last month'''
+    return await _summary(summaries.sleep_overview, ('sleep_records',), user_id, *query_data._last_month_window(), session)
+
+async def get_user_mood_trends(user_id, session=None):
+    '''Return the MoodTrends of the last month'''
+    return await _summary(summaries.mood_trends, ('mood_logs',), user_id, *query_data._last_month_window(), session)
+
+async def get_progress_towards_fitness_goals(user_id, session=None):
+    '''Return (goal, status, target date) for every fitness goal of a user'''
+    goals = await get_user_fitness_goals(user_id, session)
+    progress = [goal_progress.evaluate(goal) for goal in goals] # Constant time per goal: the counters are kept up to date on write
+    return [(goal.goal, status.status.title() if status else "Completed" if goal.completed else "In Progress", goal.target_date)
+            for goal, status in zip(goals, progress)]
+
+async def get_dashboard(user_id, start=None, end=None):
+    '''Return the Dashboard of [start, end) (default: the last month), its four panels queried concurrently'''
+    if start is None:
+        start, end = query_data._last_month_window()
+    panels = await asyncio.gather(*[_summary(summary, tables, user_id, start, end, None) for summary, tables in DASHBOARD_PANELS])
+    return summaries.Dashboard(*panels)
+
+if __name__ == '__main__':
+    async def main():
+        user_id = 1 # Example user ID
+        print(await get_dashboard(user_id))
+        print(await get_monthly_workout_summary(user_id, 7, 2023))
+        await engine.dispose()
+        await read_engine.dispose()
+
+    asyncio.run(main())
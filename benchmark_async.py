@@ -0,0 +1,93 @@
+'''Measure full-dashboard latency under many concurrent simulated clients.
+
+Run `python benchmark_async.py --clients 500 --requests 10` to generate a dataset and time the
+dashboard two ways: the synchronous summaries pushed onto the default thread pool with
+asyncio.to_thread() ("threads", what async callers had to do before async_api.py existed), and
+async_api.get_dashboard(), which gathers its four panels on aiosqlite sessions ("async"). For
+comparison, "union" awaits summaries.dashboard(), one UNION ALL statement on a single session.
+The summary cache is disabled unless --cache is given, so every request reaches SQLite.
+'''
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from cache import SummaryCache
+from database import get_engine, get_async_engine, session_scope
+import async_api
+import bulk_data
+import query_data
+import summaries
+
+ANCHOR = date(2024, 6, 30)
+WINDOW = (ANCHOR - timedelta(days=30), ANCHOR + timedelta(days=1))
+
+def threaded_dashboard(user_id):
+    '''The dashboard as a synchronous caller builds it, one panel after the other'''
+    with session_scope(query_data.Session) as session:
+        return summaries.Dashboard(*[query_data._cached_summary(summary, tables, session, user_id, *WINDOW)
+                                     for summary, tables in async_api.DASHBOARD_PANELS])
+
+async def single_statement_dashboard(user_id):
+    '''The dashboard as one UNION ALL statement on one aiosqlite session, for comparison with the gathered panels'''
+    async with async_api.ReadSession() as session:
+        return await session.run_sync(summaries.dashboard, user_id, *WINDOW)
+
+async def run(dashboard, clients, requests, users):
+    '''Start `clients` clients that each request `requests` dashboards; return the latencies and elapsed time'''
+    latencies = []
+
+    async def client(seed):
+        rng = random.Random(seed)
+        for _ in range(requests):
+            started = time.perf_counter()
+            await dashboard(rng.randint(1, users))
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*[client(seed) for seed in range(clients)])
+    return sorted(latencies), time.perf_counter() - started
+
+def percentile(latencies, fraction):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))]
+
+def report(label, latencies, elapsed):
+    print(f"{label:<8}{len(latencies) / elapsed:>14.0f}{percentile(latencies, 0.5) * 1000:>12.1f}{percentile(latencies, 0.99) * 1000:>12.1f}")
+
+async def benchmark(url, args):
+    print(f"{'mode':<8}{'requests/s':>14}{'p50 ms':>12}{'p99 ms':>12}")
+
+    reader = get_engine(url, read_only=True)
+    query_data.Session = sessionmaker(bind=reader)
+    report('threads', *await run(lambda user_id: asyncio.to_thread(threaded_dashboard, user_id), args.clients, args.requests, args.users))
+    reader.dispose()
+
+    async_reader = get_async_engine(url, read_only=True)
+    async_api.ReadSession = async_sessionmaker(async_reader, expire_on_commit=False)
+    report('async', *await run(lambda user_id: async_api.get_dashboard(user_id, *WINDOW), args.clients, args.requests, args.users))
+    report('union', *await run(single_statement_dashboard, args.clients, args.requests, args.users))
+    await async_reader.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=500, help='number of concurrent simulated clients')
+    parser.add_argument('--requests', type=int, default=10, help='dashboard requests per client')
+    parser.add_argument('--users', type=int, default=1000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=400000, help='log rows to generate')
+    parser.add_argument('--cache', action='store_true', help='keep the summary cache enabled')
+    args = parser.parse_args()
+
+    query_data.summary_cache = SummaryCache() if args.cache else SummaryCache(max_entries=0)
+    with tempfile.TemporaryDirectory() as directory:
+        url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        writer = get_engine(url)
+        bulk_data.generate(writer, args.users, args.log_rows, anchor=ANCHOR)
+        writer.dispose()
+        asyncio.run(benchmark(url, args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''Measure read and write throughput with N reader threads and one writer thread.
+
+Run `python benchmark_concurrency.py --readers 8 --seconds 10` to compare a plain
+create_engine() in rollback-journal mode ("before") with the tuned writer and read-only
+engines from database.py in WAL mode ("after") on the same generated dataset.
+'''
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+from create import Workout
+from database import get_engine
+import bulk_data
+import summaries
+
+ANCHOR = date(2024, 6, 30)
+WINDOW = (ANCHOR - timedelta(days=30), ANCHOR + timedelta(days=1))
+
+def run(writer_engine, reader_engine, readers, seconds, users):
+    '''Run the readers and the writer for `seconds` and return their counters'''
+    stop = threading.Event()
+    counters = {'reads': 0, 'writes': 0, 'errors': 0, 'read_latencies': []}
+    lock = threading.Lock()
+
+    def reader(seed):
+        rng = random.Random(seed)
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                with Session(reader_engine) as session:
+                    summaries.dashboard(session, rng.randint(1, users), *WINDOW)
+            except OperationalError:
+                with lock:
+                    counters['errors'] += 1
+                continue
+            with lock:
+                counters['reads'] += 1
+                counters['read_latencies'].append(time.perf_counter() - started)
+
+    def writer():
+        rng = random.Random(-1)
+        while not stop.is_set():
+            try:
+                with Session(writer_engine) as session:
+                    session.add(Workout(user_id=rng.randint(1, users), date=ANCHOR, duration=30, type='Running', intensity='Low', calories_burned=250))
+                    session.commit()
+            except OperationalError:
+                with lock:
+                    counters['errors'] += 1
+                continue
+            with lock:
+                counters['writes'] += 1
+
+    threads = [threading.Thread(target=reader, args=(seed,)) for seed in range(readers)] + [threading.Thread(target=writer)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return counters
+
+def report(label, counters, seconds):
+    latencies = sorted(counters['read_latencies']) or [0]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    print(f"{label:<8}{counters['reads'] / seconds:>12.0f}{counters['writes'] / seconds:>12.0f}{p99 * 1000:>14.1f}{counters['errors']:>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8, help='number of reader threads')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of each run')
+    parser.add_argument('--users', type=int, default=1000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=400000, help='log rows to generate')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        url = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+        bulk_data.generate(create_engine(url), args.users, args.log_rows, anchor=ANCHOR)
+        print(f"{'engine':<8}{'reads/s':>12}{'writes/s':>12}{'p99 read ms':>14}{'errors':>8}")
+
+        before = create_engine(url) # The engine every module used to build for itself
+        with before.connect() as connection:
+            connection.exec_driver_sql('PRAGMA journal_mode=DELETE')
+        report('before', run(before, before, args.readers, args.seconds, args.users), args.seconds)
+        before.dispose()
+
+        writer, reader = get_engine(url), get_engine(url, read_only=True)
+        with writer.connect(): # The writer switches the file to WAL before the readers connect
+            pass
+        report('after', run(writer, reader, args.readers, args.seconds, args.users), args.seconds)
+        writer.dispose()
+        reader.dispose()
+
+if __name__ == '__main__':
+    main()
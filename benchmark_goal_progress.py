@@ -0,0 +1,90 @@
+'''Compare goal progress from the incremental counters with rescanning the logs of every goal.
+
+Run `python benchmark_goal_progress.py --users 200 --log-rows 1000000 --goals 2000` to generate two
+years of logs, give a few users thousands of measurable goals with windows spread over that history,
+and time, per user, the progress of all their goals read from the counters against summing each
+goal's window of raw log rows, as the progress query would have to without them. The last lines time
+logging a workout for a user with and without those goals, which is what keeping the counters costs.
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+from sqlalchemy import select, insert, func
+from sqlalchemy.orm import Session
+from create import FitnessGoal, Workout, NutritionLog, SleepRecord
+from database import get_engine
+import bulk_data
+import goal_progress
+
+ANCHOR = date(2024, 6, 30)
+HISTORY_DAYS = 730
+RAW = {'workout_minutes': (Workout, Workout.date, func.sum(Workout.duration)), 'workout_sessions': (Workout, Workout.date, func.count()),
+       'calories_burned': (Workout, Workout.date, func.sum(Workout.calories_burned)), 'daily_calories': (NutritionLog, NutritionLog.date, func.sum(NutritionLog.calories)),
+       'sleep_hours': (SleepRecord, func.date(SleepRecord.start_time), func.avg(SleepRecord.duration_hours))}
+
+def add_goals(engine, user_ids, goals_per_user, rng):
+    '''Measurable goals of every metric with windows of one to twelve weeks anywhere in the history'''
+    rows = []
+    for user_id in user_ids:
+        for index in range(goals_per_user):
+            start = ANCHOR - timedelta(days=rng.randint(0, HISTORY_DAYS))
+            rows.append({'user_id': user_id, 'goal': f"Goal {index}", 'metric': rng.choice(list(goal_progress.TARGETS)), 'target': rng.choice((8, 600, 2000)),
+                         'start_date': start, 'target_date': start + timedelta(days=rng.randint(7, 84)), 'completed': False})
+    with engine.begin() as connection:
+        connection.execute(insert(FitnessGoal.__table__), rows) # Core inserts skip the seeding events, so the counters are rebuilt below
+        goal_progress.rebuild(connection)
+
+def from_counters(session, user_id):
+    return [goal_progress.evaluate(goal, ANCHOR) for goal in session.scalars(select(FitnessGoal).where(FitnessGoal.user_id == user_id, FitnessGoal.metric.isnot(None)))]
+
+def rescanned(session, user_id):
+    values = []
+    for goal in session.scalars(select(FitnessGoal).where(FitnessGoal.user_id == user_id, FitnessGoal.metric.isnot(None))):
+        model, day, value = RAW[goal.metric]
+        values.append(session.execute(select(value).where(model.user_id == user_id, day >= goal.start_date, day <= goal.target_date)).scalar())
+    return values
+
+def time_logging(engine, user_id, calls):
+    started = time.perf_counter()
+    for offset in range(calls):
+        with Session(engine) as session:
+            session.add(Workout(user_id=user_id, date=ANCHOR - timedelta(days=offset), duration=30, calories_burned=250))
+            session.commit()
+    return (time.perf_counter() - started) * 1000 / calls
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=1000000, help='log rows to generate')
+    parser.add_argument('--goals', type=int, default=2000, help='measurable goals of each measured user')
+    parser.add_argument('--measured', type=int, default=5, help='users given --goals goals each')
+    parser.add_argument('--calls', type=int, default=50, help='workouts logged per user in the write timings')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    user_ids = rng.sample(range(2, args.users + 1), args.measured) # User 1 keeps no measurable goals
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        bulk_data.generate(engine, args.users, args.log_rows, days=HISTORY_DAYS, anchor=ANCHOR)
+        started = time.perf_counter()
+        add_goals(engine, user_ids, args.goals, rng)
+        print(f"Seeded {args.goals * args.measured} goals in {time.perf_counter() - started:.2f}s")
+        with Session(engine) as session:
+            print(f"{'query':<32}{'ms/user':>10}")
+            for label, query in (('progress, rescanning the logs', rescanned), ('progress, from the counters', from_counters)):
+                started = time.perf_counter()
+                for user_id in user_ids:
+                    query(session, user_id)
+                print(f"{label:<32}{(time.perf_counter() - started) * 1000 / len(user_ids):>10.1f}")
+        print(f"{'write':<32}{'ms/call':>10}")
+        print(f"{'log workout, no goals':<32}{time_logging(engine, 1, args.calls):>10.2f}")
+        print(f"{f'log workout, {args.goals} goals':<32}{time_logging(engine, user_ids[0], args.calls):>10.2f}")
+        with engine.connect() as connection:
+            assert goal_progress.check(connection, user_ids) == []
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
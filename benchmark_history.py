@@ -0,0 +1,62 @@
+'''Measure memory and time to first row when reading a user's whole workout history.
+
+Run `python benchmark_history.py --lengths 1000 10000 100000` to give one user histories of each
+length and compare loading them with .all() (how get_user_workouts used to read them), streaming
+them with query_data.iter_user_workouts() and fetching the first page of get_user_workouts_page().
+'''
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from sqlalchemy import insert, select
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, Workout
+from database import get_engine
+import query_data
+
+def populate(engine, length):
+    '''One user with `length` workouts, several per day'''
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'id': 1, 'name': 'Power User', 'email': 'power@example.com'}])
+        connection.execute(insert(Workout), [{'user_id': 1, 'date': date(2020, 1, 1) + timedelta(days=index // 24), 'duration': 1, 'type': 'Walking',
+                                              'intensity': 'Low', 'calories_burned': 5, 'notes': 'Minute-level entry'} for index in range(length)])
+
+def measure(read):
+    '''Return (seconds to the first row, seconds to the last row, peak traced MiB) for a reader of rows'''
+    tracemalloc.start()
+    started = time.perf_counter()
+    first = None
+    for _ in read():
+        first = first or time.perf_counter() - started
+    total = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] / 2 ** 20
+    tracemalloc.stop()
+    return first, total, peak
+
+def load_all():
+    with query_data.Session() as session:
+        return session.scalars(select(Workout).where(Workout.user_id == 1)).all()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[1000, 10000, 100000], help='history lengths to measure')
+    args = parser.parse_args()
+
+    print(f"{'rows':>8}  {'mode':<10}{'first row ms':>14}{'all rows ms':>14}{'peak MiB':>10}")
+    for length in args.lengths:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = get_engine('sqlite:///' + os.path.join(directory, 'history.db'))
+            populate(engine, length)
+            query_data.Session = sessionmaker(bind=engine, expire_on_commit=False)
+            modes = [('all', load_all), ('stream', lambda: query_data.iter_user_workouts(1)),
+                     ('first page', lambda: query_data.get_user_workouts_page(1)[0])]
+            for label, read in modes:
+                first, total, peak = measure(read)
+                print(f"{length:>8}  {label:<10}{first * 1000:>14.1f}{total * 1000:>14.1f}{peak:>10.1f}")
+            engine.dispose()
+
+if __name__ == '__main__':
+    main()
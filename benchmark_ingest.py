@@ -0,0 +1,67 @@
+'''Compare per-event transactions with the write-batching ingest queue.
+
+Run `python benchmark_ingest.py --events 20000` to log the same stream of workouts, each with a goal
+status change, first through insert_data.log_workout_and_update_goals() (one transaction and one
+goal lookup per workout) and then through ingest.IngestQueue.
+'''
+import argparse
+import io
+import os
+import random
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import date, timedelta
+from sqlalchemy import insert
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, FitnessGoal
+from database import get_engine
+from ingest import IngestQueue
+import insert_data
+
+def prepare(url, users):
+    '''Create a database with `users` users and one goal per user (goal id = user id)'''
+    engine = get_engine(url)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(User), [{'id': user_id, 'name': f'User {user_id}', 'email': f'user{user_id}@example.com'} for user_id in range(1, users + 1)])
+        connection.execute(insert(FitnessGoal), [{'id': user_id, 'user_id': user_id, 'goal': 'Train more'} for user_id in range(1, users + 1)])
+    return engine
+
+def events(count, users, seed=0):
+    '''(user_id, workout_data, goal_updates) triples, the same for both runs'''
+    rng = random.Random(seed)
+    for _ in range(count):
+        user_id = rng.randint(1, users)
+        yield user_id, {'date': date(2024, 1, 1) + timedelta(days=rng.randint(0, 365)), 'duration': rng.choice([30, 45, 60]),
+                        'type': 'Running', 'intensity': rng.choice(['Low', 'Medium', 'High']), 'calories_burned': rng.randint(100, 800)}, {user_id: rng.random() < 0.5}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, default=20000, help='workouts to log in each run')
+    parser.add_argument('--users', type=int, default=1000, help='number of users to generate')
+    parser.add_argument('--batch-size', type=int, default=1000, help='events per ingest batch')
+    args = parser.parse_args()
+
+    print(f"{'mode':<14}{'events/s':>12}")
+    with tempfile.TemporaryDirectory() as directory:
+        engine = prepare('sqlite:///' + os.path.join(directory, 'per_event.db'), args.users)
+        insert_data.DBSession = sessionmaker(bind=engine, expire_on_commit=False)
+        started = time.perf_counter()
+        with redirect_stdout(io.StringIO()):
+            for user_id, workout_data, goal_updates in events(args.events, args.users):
+                insert_data.log_workout_and_update_goals(user_id, workout_data, goal_updates)
+        print(f"{'per event':<14}{args.events / (time.perf_counter() - started):>12.0f}")
+        engine.dispose()
+
+        engine = prepare('sqlite:///' + os.path.join(directory, 'batched.db'), args.users)
+        started = time.perf_counter()
+        with IngestQueue(engine, batch_size=args.batch_size) as ingest:
+            for user_id, workout_data, goal_updates in events(args.events, args.users):
+                ingest.log_workout_and_update_goals(user_id, workout_data, goal_updates)
+        print(f"{'ingest queue':<14}{args.events / (time.perf_counter() - started):>12.0f}")
+        print(ingest.stats())
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''Measure the overhead of @instrumented on the query_data reporting functions.
+
+Run `python benchmark_instrumentation.py --users 1000 --log-rows 200000` to generate a dataset and
+time each function with and without its instrumentation wrapper (the undecorated function is
+reachable as `__wrapped__`; the engine events and counting cursors stay active in both cases).
+The per-function measurements gathered during the run are printed at the end.
+'''
+import argparse
+import contextlib
+import io
+import os
+import random
+import tempfile
+import time
+from datetime import date
+from sqlalchemy.orm import sessionmaker
+from database import get_engine
+from cache import SummaryCache
+import bulk_data
+import instrumentation
+import query_data
+
+ANCHOR = date(2024, 6, 30)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=200000, help='log rows to generate')
+    parser.add_argument('--calls', type=int, default=500, help='calls per function, each for a random user')
+    args = parser.parse_args()
+
+    functions = [
+        ('get_user_workouts', query_data.get_user_workouts, ()),
+        ('get_average_sleep_duration', query_data.get_average_sleep_duration, ()),
+        ('get_nutrition_summary', query_data.get_nutrition_summary, (ANCHOR,)),
+        ('get_user_mood_trends', query_data.get_user_mood_trends, ()),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        instrumentation.set_slow_query_threshold(float('inf')) # The load's own statements are not of interest
+        bulk_data.generate(engine, args.users, args.log_rows, anchor=ANCHOR)
+        instrumentation.set_slow_query_threshold(100)
+        query_data.Session = sessionmaker(bind=engine, expire_on_commit=False)
+        print(f"{'function':<30}{'plain ms':>10}{'instrumented ms':>17}")
+        for label, function, extra in functions:
+            timings = []
+            for variant in (function.__wrapped__, function):
+                rng = random.Random(0)
+                query_data.summary_cache = SummaryCache() # Both variants start cold
+                with contextlib.redirect_stdout(io.StringIO()):
+                    started = time.perf_counter()
+                    for _ in range(args.calls):
+                        variant(rng.randint(1, args.users), *extra)
+                timings.append((time.perf_counter() - started) * 1000 / args.calls)
+            print(f"{label:<30}{timings[0]:>10.3f}{timings[1]:>17.3f}")
+        engine.dispose()
+
+    print()
+    print(f"{'function':<42}{'calls':>7}{'p50 ms':>9}{'p95 ms':>9}{'stmts/call':>12}{'rows read/call':>16}")
+    for name, stats in instrumentation.snapshot()['functions'].items():
+        calls = stats['calls']
+        print(f"{name:<42}{calls:>7}{stats['seconds']['p50'] * 1000:>9.3f}{stats['seconds']['p95'] * 1000:>9.3f}"
+              f"{stats['statements']['sum'] / calls:>12.1f}{stats['rows_read']['sum'] / calls:>16.1f}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+'''Compare leaderboard lookups on the snapshot tables with ranking every user on each request.
+
+Run `python benchmark_leaderboards.py --users 10000 --log-rows 2000000` to generate a dataset,
+refresh the snapshots of the anchor week and month, and time, per random user, a rank lookup and a
+top-10 query of the user's age band on the snapshot against the same answers computed on request
+with the window-function statement the refresh runs.
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from create import User
+from database import get_engine
+import bulk_data
+import leaderboards
+
+ANCHOR = date(2024, 6, 30)
+METRIC = 'workout_minutes'
+
+def live_rank(session, user_id, cohort):
+    start, end = leaderboards.period_window('week', ANCHOR)
+    ranked = leaderboards.ranking_statement(METRIC, start, end).subquery()
+    return session.execute(select(ranked).where(ranked.c.user_id == user_id, ranked.c.cohort == cohort)).first()
+
+def live_top(session, user_id, cohort):
+    start, end = leaderboards.period_window('week', ANCHOR)
+    ranked = leaderboards.ranking_statement(METRIC, start, end).subquery()
+    return session.execute(select(ranked).where(ranked.c.cohort == cohort).order_by(ranked.c.rank).limit(leaderboards.TOP_K)).all()
+
+def snapshot_rank(session, user_id, cohort):
+    return leaderboards.user_rankings(session, user_id, 'week', ANCHOR, metrics=[METRIC])
+
+def snapshot_top(session, user_id, cohort):
+    return leaderboards.top(session, METRIC, 'week', cohort, day=ANCHOR)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=2000000, help='log rows to generate')
+    parser.add_argument('--calls', type=int, default=100, help='calls per query, each for a random user')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        bulk_data.generate(engine, args.users, args.log_rows, anchor=ANCHOR)
+        started = time.perf_counter()
+        leaderboards.refresh_all(engine, ANCHOR)
+        print(f"Refreshed {len(leaderboards.METRICS) * len(leaderboards.PERIODS)} snapshots in {time.perf_counter() - started:.2f}s")
+        with Session(engine) as session:
+            ages = dict(session.execute(select(User.id, User.age)).all())
+            print(f"{'query':<20}{'ms/call':>10}")
+            for label, query in (('rank, on request', live_rank), ('rank, snapshot', snapshot_rank),
+                                 ('top 10, on request', live_top), ('top 10, snapshot', snapshot_top)):
+                rng = random.Random(0)
+                started = time.perf_counter()
+                for _ in range(args.calls):
+                    user_id = rng.randint(1, args.users)
+                    query(session, user_id, leaderboards.cohorts_of(ages[user_id], None)[1])
+                print(f"{label:<20}{(time.perf_counter() - started) * 1000 / args.calls:>10.3f}")
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
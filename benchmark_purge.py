@@ -0,0 +1,80 @@
+'''Compare ways of deleting users with long histories.
+
+Run `python benchmark_purge.py --users 200 --log-rows 1000000 --purged 20` to generate a dataset
+and delete the same users from three copies of it: through the session with every child collection
+loaded first, so the ORM deletes the rows one by one (what the cascade did before passive_deletes),
+through the session with ON DELETE CASCADE, and with purge.purge_users(). Each line gives the total time and
+the longest single write transaction, which is how long other writers may have to wait.
+'''
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from datetime import date
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from create import User
+from database import get_engine
+import bulk_data
+import instrumentation
+import purge
+
+ANCHOR = date(2024, 6, 30)
+COLLECTIONS = ('fitness_goals', 'workouts', 'nutrition_logs', 'sleep_records', 'mood_logs')
+
+def orm_loaded(engine, user_ids):
+    for user_id in user_ids:
+        with Session(engine) as session:
+            user = session.get(User, user_id)
+            for name in COLLECTIONS:
+                getattr(user, name) # Loaded collections are still deleted row by row by the ORM cascade
+            session.delete(user)
+            session.commit()
+
+def orm_cascade(engine, user_ids):
+    for user_id in user_ids:
+        with Session(engine) as session:
+            session.delete(session.get(User, user_id))
+            session.commit()
+
+def chunked_purge(engine, user_ids):
+    purge.purge_users(engine, user_ids)
+
+def transaction_timer(engine):
+    '''Record the duration of every transaction committed on `engine`'''
+    durations, started = [], {}
+    event.listen(engine, 'begin', lambda connection: started.__setitem__(id(connection), time.perf_counter()))
+    event.listen(engine, 'commit', lambda connection: durations.append(time.perf_counter() - started.pop(id(connection), time.perf_counter())))
+    return durations
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=1000000, help='log rows to generate')
+    parser.add_argument('--purged', type=int, default=20, help='users deleted by every variant')
+    args = parser.parse_args()
+
+    user_ids = random.Random(0).sample(range(1, args.users + 1), args.purged)
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'source.db')
+        engine = get_engine('sqlite:///' + source)
+        instrumentation.set_slow_query_threshold(float('inf')) # The load's own statements are not of interest
+        bulk_data.generate(engine, args.users, args.log_rows, anchor=ANCHOR)
+        engine.dispose()
+        print(f"{'variant':<26}{'seconds':>10}{'longest transaction ms':>25}")
+        for label, variant in (('ORM, children loaded', orm_loaded), ('ORM, ON DELETE CASCADE', orm_cascade), ('purge.purge_users', chunked_purge)):
+            copy = os.path.join(directory, 'copy.db')
+            shutil.copyfile(source, copy)
+            engine = get_engine('sqlite:///' + copy)
+            durations = transaction_timer(engine)
+            started = time.perf_counter()
+            variant(engine, user_ids)
+            elapsed = time.perf_counter() - started
+            print(f"{label:<26}{elapsed:>10.2f}{max(durations) * 1000:>25.1f}")
+            engine.dispose()
+            os.remove(copy)
+
+if __name__ == '__main__':
+    main()
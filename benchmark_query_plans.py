@@ -0,0 +1,138 @@
+'''Benchmark the reporting queries in query_data.py and show their SQLite query plans.
+
+Run `python benchmark_query_plans.py --users 200 --rows 500` to build a throwaway database,
+time every reporting function and print the EXPLAIN QUERY PLAN of each statement it issues.
+The script exits with a non-zero status if any statement falls back to a full table scan.
+'''
+import argparse
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+from sqlalchemy import create_engine, event, insert
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, FitnessGoal, Workout, NutritionLog, SleepRecord, MoodLog
+from cache import SummaryCache
+import query_data
+import rollups
+
+def populate(engine, users, rows_per_user, seed=0):
+    '''Fill the database with `users` users and `rows_per_user` rows in every log table'''
+    rng = random.Random(seed)
+    today = date.today()
+    with engine.begin() as connection:
+        connection.execute(insert(User), [
+            {'id': user_id, 'name': f'User {user_id}', 'email': f'user{user_id}@example.com', 'age': rng.randint(18, 65)}
+            for user_id in range(1, users + 1)
+        ])
+        for user_id in range(1, users + 1):
+            days = [today - timedelta(days=rng.randint(0, 365)) for _ in range(rows_per_user)]
+            connection.execute(insert(FitnessGoal), [
+                {'user_id': user_id, 'goal': 'Run a 10k', 'target_date': day, 'completed': False} for day in days[:3]
+            ])
+            connection.execute(insert(Workout), [
+                {'user_id': user_id, 'date': day, 'duration': rng.choice([30, 45, 60]), 'type': 'Running',
+                 'intensity': rng.choice(['Low', 'Medium', 'High']), 'calories_burned': rng.randint(100, 800)}
+                for day in days
+            ])
+            connection.execute(insert(NutritionLog), [
+                {'user_id': user_id, 'date': day, 'meal_type': 'Lunch', 'calories': rng.randint(100, 1200),
+                 'proteins': rng.uniform(0, 100), 'carbs': rng.uniform(0, 300), 'fats': rng.uniform(0, 100)}
+                for day in days
+            ])
+            connection.execute(insert(SleepRecord), [
+                {'user_id': user_id, 'start_time': datetime.combine(day, datetime.min.time()) + timedelta(hours=22),
+                 'end_time': datetime.combine(day, datetime.min.time()) + timedelta(hours=30),
+                 'duration_hours': 8.0, 'quality': rng.choice(['Poor', 'Fair', 'Good', 'Excellent']), 'deep_sleep_duration': rng.uniform(1, 5)}
+                for day in days
+            ])
+            connection.execute(insert(MoodLog), [
+                {'user_id': user_id, 'date': day, 'mood': rng.choice(['Happy', 'Sad', 'Calm']), 'stress_level': rng.randint(1, 10)}
+                for day in days
+            ])
+        rollups.rebuild(connection) # Core inserts bypass the ORM events that maintain the rollups
+
+def capture_statements(engine, function, *args):
+    '''Run a reporting function and return the (statement, parameters) pairs it sent to SQLite'''
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters))
+
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        with redirect_stdout(io.StringIO()):
+            function(*args)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    return statements
+
+def explain(engine, statement, parameters):
+    '''Return the detail column of EXPLAIN QUERY PLAN for a statement'''
+    with engine.connect() as connection:
+        return [row[3] for row in connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters)]
+
+def is_full_scan(detail):
+    '''A plan step is a full scan when SQLite walks a table without any index'''
+    return detail.startswith('SCAN') and 'INDEX' not in detail
+
+def time_function(function, args, repeat):
+    '''Average wall time in milliseconds of `repeat` calls to a reporting function'''
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            function(*args)
+    return (time.perf_counter() - start) * 1000 / repeat
+
+def reporting_calls(user_id):
+    '''Every reporting function in query_data.py with representative arguments'''
+    today = date.today()
+    return [
+        (query_data.get_user_workouts, (user_id,)),
+        (query_data.get_user_workouts_page, (user_id, (today - timedelta(days=180), 0))),
+        (query_data.get_user_fitness_goals_page, (user_id, (today - timedelta(days=180), 0))),
+        (query_data.get_average_sleep_duration, (user_id,)),
+        (query_data.get_nutrition_summary, (user_id, today.isoformat())),
+        (query_data.get_user_fitness_goals, (user_id,)),
+        (query_data.get_detailed_nutrition_summary, (user_id, (today - timedelta(days=30)).isoformat(), today.isoformat())),
+        (query_data.get_monthly_workout_summary, (user_id, today.month, today.year)),
+        (query_data.get_sleep_quality_overview, (user_id,)),
+        (query_data.get_user_mood_trends, (user_id,)),
+        (query_data.get_progress_towards_fitness_goals, (user_id,)),
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='number of users to generate')
+    parser.add_argument('--rows', type=int, default=500, help='rows per user in every log table')
+    parser.add_argument('--repeat', type=int, default=20, help='calls per function when timing')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the generated data')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        Base.metadata.create_all(engine)
+        populate(engine, args.users, args.rows, args.seed)
+        query_data.Session = sessionmaker(bind=engine, expire_on_commit=False) # Point the reporting functions at the benchmark database
+        query_data.summary_cache = SummaryCache(max_entries=0) # Every call must reach SQLite to be timed and explained
+
+        full_scans = 0
+        user_id = args.users // 2
+        for function, call_args in reporting_calls(user_id):
+            elapsed = time_function(function, call_args, args.repeat)
+            print(f"{function.__name__}: {elapsed:.2f} ms/call")
+            for statement, parameters in capture_statements(engine, function, *call_args):
+                for detail in explain(engine, statement, parameters):
+                    full_scans += is_full_scan(detail)
+                    print(f"    {'FULL SCAN ' if is_full_scan(detail) else ''}{detail}")
+        engine.dispose()
+
+    print(f"\n{full_scans} full table scan(s) found")
+    sys.exit(1 if full_scans else 0)
+
+if __name__ == '__main__':
+    main()
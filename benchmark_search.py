@@ -0,0 +1,64 @@
+'''Compare full-text search through notes_fts with LIKE scans of the notes columns.
+
+Run `python benchmark_search.py --users 10000 --log-rows 2000000` to generate a dataset, build the
+search index and time, for random words of the generated notes, LIKE '%word%' queries over the
+notes of one user and over every workout against search_notes() for one user, for every user
+ranked by bm25 and for every user newest first.
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from create import Workout, NutritionLog, SleepRecord, MoodLog
+from database import get_engine
+import bulk_data
+import search
+
+def like_user(session, word, user_id):
+    return [session.execute(select(model.id).where(model.user_id == user_id, model.notes.like(f'%{word}%'))).all()
+            for model in (Workout, NutritionLog, SleepRecord, MoodLog)]
+
+def like_everyone(session, word, user_id):
+    return session.execute(select(func.count()).where(Workout.notes.like(f'%{word}%'))).scalar() # Ranking needs every match
+
+def search_user(session, word, user_id):
+    return search.search_notes(session, word, user_id=user_id)
+
+def search_everyone(session, word, user_id):
+    return search.search_notes(session, word)
+
+def search_everyone_newest(session, word, user_id):
+    return search.search_notes(session, word, ranked=False)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=2000000, help='log rows to generate')
+    parser.add_argument('--calls', type=int, default=200, help='calls per query, each for a random user and word')
+    args = parser.parse_args()
+
+    cases = [('LIKE, one user', like_user), ('LIKE, all workouts', like_everyone), ('FTS5, one user', search_user),
+             ('FTS5, every user', search_everyone), ('FTS5, newest first', search_everyone_newest)]
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        bulk_data.generate(engine, args.users, args.log_rows)
+        started = time.perf_counter()
+        with engine.begin() as connection:
+            search.create_index(connection)
+        print(f"Index built in {time.perf_counter() - started:.1f} s")
+        words = sorted({word.strip('.,').lower() for note in bulk_data.build_text_pools(0)['short_texts'] for word in note.split() if len(word) > 4})
+        print(f"{'query':<20}{'ms/call':>10}")
+        with Session(engine) as session:
+            for label, query in cases:
+                rng = random.Random(0)
+                started = time.perf_counter()
+                for _ in range(args.calls):
+                    query(session, rng.choice(words), rng.randint(1, args.users))
+                print(f"{label:<20}{(time.perf_counter() - started) * 1000 / args.calls:>10.3f}")
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
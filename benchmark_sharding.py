@@ -0,0 +1,63 @@
+'''Measure ingest throughput as the number of shards grows.
+
+Run `python benchmark_sharding.py --shards 1 2 4 --writers 4` to spread the same users over 1, 2 and 4
+shard files and log workouts for them from several writer processes at once, one transaction per
+workout as insert_data.log_workout_and_update_goals() does. With one shard every commit waits for
+the same writer lock; with more shards writers for users on different shards commit in parallel.
+'''
+import argparse
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+from multiprocessing import Pool
+from sqlalchemy import insert
+from create import User, Workout
+from sharding import ShardRouter
+
+def prepare(directory, shards, users):
+    '''A router over `shards` new shard files holding `users` users'''
+    router = ShardRouter([f"sqlite:///{os.path.join(directory, f'shard{shard}.db')}" for shard in range(shards)],
+                         f"sqlite:///{os.path.join(directory, 'directory.db')}")
+    router.create_all()
+    for _ in range(users):
+        user_id = router.allocate_user_id()
+        with router.engines[router.shard_for(user_id)].begin() as connection:
+            connection.execute(insert(User).values(id=user_id, name=f'User {user_id}', email=f'user{user_id}@example.com'))
+    return router
+
+def write(task):
+    '''Writer process: log `workouts` workouts for each of its users, one transaction each'''
+    shard_urls, directory_url, user_ids, workouts = task
+    router = ShardRouter(shard_urls, directory_url)
+    factory = router.sessionmaker()
+    for index in range(workouts):
+        for user_id in user_ids:
+            with factory() as session:
+                session.add(Workout(user_id=user_id, date=date(2024, 1, 1) + timedelta(days=index % 365), duration=30, type='Running', intensity='Low', calories_burned=250))
+                session.commit()
+    router.dispose()
+    return len(user_ids) * workouts
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4], help='shard counts to measure')
+    parser.add_argument('--writers', type=int, default=4, help='concurrent writer processes')
+    parser.add_argument('--users', type=int, default=64, help='number of users')
+    parser.add_argument('--workouts', type=int, default=20, help='workouts logged per user')
+    args = parser.parse_args()
+
+    print(f"{'shards':>6}{'writes/s':>12}")
+    for shards in args.shards:
+        with tempfile.TemporaryDirectory() as directory:
+            router = prepare(directory, shards, args.users)
+            user_ids = list(range(1, args.users + 1))
+            tasks = [(router.shard_urls, str(router.directory.url), user_ids[writer::args.writers], args.workouts) for writer in range(args.writers)]
+            started = time.perf_counter()
+            with Pool(args.writers) as pool:
+                written = sum(pool.map(write, tasks))
+            print(f"{shards:>6}{written / (time.perf_counter() - started):>12.0f}")
+            router.dispose()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+'''Compare sleep queries on the stored duration_hours column with per-call julianday() arithmetic.
+
+Run `python benchmark_sleep.py --users 1000 --log-rows 2000000` to generate a dataset and time, per
+user, the last-month average duration and the "nights under 6 hours" count computed from
+julianday(end_time) - julianday(start_time) against the same questions answered from duration_hours,
+followed by every sleep_analytics metric.
+'''
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from create import SleepRecord
+from database import get_engine
+import bulk_data
+import sleep_analytics
+
+ANCHOR = date(2024, 6, 30)
+WINDOW = (ANCHOR - timedelta(days=30), ANCHOR + timedelta(days=1))
+JULIAN_HOURS = (func.julianday(SleepRecord.end_time) - func.julianday(SleepRecord.start_time)) * 24
+
+def in_window(user_id):
+    start, end = (datetime.combine(day, datetime.min.time()) for day in WINDOW)
+    return SleepRecord.user_id == user_id, SleepRecord.start_time >= start, SleepRecord.start_time < end
+
+def julian_average(session, user_id):
+    return session.scalar(select(func.avg(JULIAN_HOURS)).where(*in_window(user_id)))
+
+def stored_average(session, user_id):
+    return session.scalar(select(func.avg(SleepRecord.duration_hours)).where(*in_window(user_id)))
+
+def julian_short_nights(session, user_id):
+    return session.scalar(select(func.count()).where(SleepRecord.user_id == user_id, JULIAN_HOURS < sleep_analytics.SHORT_NIGHT_HOURS))
+
+def stored_short_nights(session, user_id):
+    return session.scalar(select(func.count()).where(SleepRecord.user_id == user_id, SleepRecord.duration_hours < sleep_analytics.SHORT_NIGHT_HOURS))
+
+def analytics(metric):
+    return lambda session, user_id: metric(session, user_id, *WINDOW)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=2000000, help='log rows to generate')
+    parser.add_argument('--calls', type=int, default=500, help='calls per query, each for a random user')
+    args = parser.parse_args()
+
+    cases = [
+        ('average, julianday', julian_average), ('average, stored', stored_average),
+        ('under 6 h, julianday', julian_short_nights), ('under 6 h, stored', stored_short_nights),
+        ('weekly_averages', analytics(sleep_analytics.weekly_averages)), ('sleep_debt', analytics(sleep_analytics.sleep_debt)),
+        ('bedtime_consistency', analytics(sleep_analytics.bedtime_consistency)), ('deep_sleep_ratio', analytics(sleep_analytics.deep_sleep_ratio)),
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        bulk_data.generate(engine, args.users, args.log_rows, anchor=ANCHOR)
+        print(f"{'query':<24}{'ms/call':>10}")
+        with Session(engine) as session:
+            for label, query in cases:
+                rng = random.Random(0)
+                started = time.perf_counter()
+                for _ in range(args.calls):
+                    query(session, rng.randint(1, args.users))
+                print(f"{label:<24}{(time.perf_counter() - started) * 1000 / args.calls:>10.3f}")
+        engine.dispose()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+'''Scale-factor benchmark suite for the reporting and ingest functions, with regression thresholds.
+
+Run `python benchmark_suite.py --scales 1 4` to time, on a dataset generated by bulk_data.py for
+every scale factor (SCALE_USERS users and SCALE_LOG_ROWS log rows per unit, the schema of
+create.py including the search index), every public function of query_data.py and every ingest
+path of insert_data.py. Each function is called for the same sample of users twice: cold, right
+after the engine's connections (and so SQLite's page cache) and the summary cache were dropped,
+then warm. Both phases run --repeat times and the fastest run is kept. Every phase records
+throughput, latency percentiles, SQL statements per call (from instrumentation.py) and the peak
+Python memory of a separate tracemalloc pass, which would otherwise slow the timed calls down.
+
+The results are compared with the JSON baseline (benchmark_baseline.json by default), and the
+script exits with status 1 when a phase regressed past --threshold: slower median latency or lower
+throughput, more statements per call or a larger memory peak. A timing only counts when both the
+median latency and the throughput of a phase moved by more than --threshold beyond the machine's
+own drift. That drift is measured with a fixed workload that runs none of this repository's code (a
+pure-Python loop and constant SQLite queries), timed right before the phases of every function and
+capped at MAX_DRIFT, so a busier or slower machine does not read as a regression while a change that
+slows every phase still does. Statement counts and memory peaks are compared as they are.
+`--update-baseline` records the run as the new baseline instead. Baselines are only comparable on the
+same machine and scale factors.
+Generated datasets are kept in --data-dir and copied for every run, since the ingest paths write.
+'''
+import argparse
+import contextlib
+import inspect
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+import sqlalchemy
+from sqlalchemy import select, func
+from sqlalchemy.orm import sessionmaker
+from create import User, FitnessGoal
+from database import get_engine
+from cache import SummaryCache
+import bulk_data
+import insert_data
+import instrumentation
+import query_data
+import search
+
+SCALE_USERS = 500 # Users per unit of scale factor
+SCALE_LOG_ROWS = 100000 # Log rows per unit of scale factor
+ANCHOR = date(2024, 6, 30) # Last day of the generated history, standing in for today in the reports' last-month windows
+MEMORY_CALLS = 20 # Calls traced by tracemalloc per phase
+SAMPLE_CALLS = 20 # Calls of the create_sample_* functions per phase, which write many rows each
+LATENCY_FLOOR_MS = 0.5 # Latency growth below this many milliseconds is jitter, whatever its ratio; statement counts still catch extra queries
+CALIBRATION_ROUNDS = 5 # Runs of the calibration workload before every function, of which the median is kept
+MAX_DRIFT = 1.5 # Largest machine slowdown discounted from the timings; anything beyond it counts against the code
+
+def _arguments(rng, users, goals, counter):
+    '''Values for the parameters of the reporting and ingest functions, by parameter name'''
+    day = ANCHOR - timedelta(days=rng.randint(0, 60))
+    serial = next(counter)
+    user_id = rng.randint(1, users)
+    return {
+        'user_id': user_id,
+        'date': day,
+        'start_date': day - timedelta(days=30),
+        'end_date': day,
+        'current_month': day.month,
+        'current_year': day.year,
+        'users': [User(id=rng.randint(1, users)) for _ in range(5)], # The create_sample_* functions only read user.id
+        'user_details': {'name': f'Benchmark User {serial}', 'email': f'benchmark{serial}@example.com', 'age': 30},
+        'goal_details': [{'goal': 'Run a 10k', 'target_date': ANCHOR + timedelta(days=90)}],
+        'workout_data': {'date': day, 'duration': 45, 'type': 'Running', 'intensity': 'Medium', 'calories_burned': 400},
+        'goal_updates': {rng.randint(1, goals): True},
+    }
+
+def cases():
+    '''(qualified name, function, whether it writes) for every instrumented public function of query_data and insert_data'''
+    found = []
+    for module in (query_data, insert_data):
+        for name, function in sorted(vars(module).items()):
+            if callable(function) and hasattr(function, '__wrapped__') and function.__module__ == module.__name__:
+                found.append((f'{module.__name__}.{name}', function, module is insert_data))
+    return found
+
+def _call(function, values):
+    parameters = inspect.signature(function).parameters
+    result = function(**{name: values[name] for name, parameter in parameters.items()
+                         if parameter.default is inspect.Parameter.empty or name in values}) # Optional parameters too, when a value is sampled for them
+    if inspect.isgenerator(result):
+        for _ in result: # Streaming functions do their work as they are consumed
+            pass
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, round(fraction * (len(sorted_values) - 1)))]
+
+def prepare_dataset(data_dir, scale, seed):
+    '''Path of the pristine dataset of a scale factor, generated on first use'''
+    path = os.path.join(data_dir, f'scale{scale}-seed{seed}.db')
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        partial = path + '.partial'
+        if os.path.exists(partial):
+            os.remove(partial)
+        process = multiprocessing.get_context('spawn').Process(target=_generate, args=(partial, scale, seed))
+        process.start() # A separate interpreter, so the timed run starts in the same state whether or not it generated the data
+        process.join()
+        if process.exitcode != 0:
+            sys.exit(f"Generating {path} failed")
+        os.replace(partial, path)
+    return path
+
+def _generate(path, scale, seed):
+    engine = get_engine('sqlite:///' + path)
+    bulk_data.generate(engine, SCALE_USERS * scale, SCALE_LOG_ROWS * scale, seed=seed, anchor=ANCHOR)
+    with engine.begin() as connection:
+        search.create_index(connection)
+    engine.dispose()
+
+def run_phase(function, arguments):
+    '''Time one call per set of arguments and return the phase's measurements'''
+    instrumentation.reset()
+    latencies = []
+    started = time.perf_counter()
+    for values in arguments:
+        call_started = time.perf_counter()
+        _call(function, values)
+        latencies.append((time.perf_counter() - call_started) * 1000)
+    elapsed = time.perf_counter() - started
+    measured = instrumentation.snapshot()['functions'].get(f'{function.__module__}.{function.__name__}')
+    latencies.sort()
+    return {
+        'calls': len(latencies),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': _percentile(latencies, 0.5),
+        'p95_ms': _percentile(latencies, 0.95),
+        'p99_ms': _percentile(latencies, 0.99),
+        'max_ms': latencies[-1],
+        'statements_per_call': measured['statements']['sum'] / len(latencies) if measured else 0,
+    }
+
+def _best(phases):
+    '''The fastest of repeated runs of a phase, which is the least disturbed by the rest of the machine'''
+    return min(phases, key=lambda phase: phase['p50_ms'])
+
+def _peak_memory(function, arguments):
+    '''Peak KiB of Python allocations while calling `function` for a few sets of arguments'''
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        for values in arguments[:MEMORY_CALLS]:
+            _call(function, values)
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+def run_scale(dataset, scale, calls, seed, repeat=1):
+    '''Measure every case on a private copy of a dataset; return {case: {'cold': ..., 'warm': ...}}'''
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'benchmark.db')
+        shutil.copyfile(dataset, path)
+        engine = get_engine('sqlite:///' + path)
+        with engine.connect() as connection:
+            users = connection.execute(select(func.max(User.id))).scalar()
+            goals = connection.execute(select(func.max(FitnessGoal.id))).scalar() or 1
+        factory = sessionmaker(bind=engine, expire_on_commit=False)
+        saved = query_data.Session, insert_data.DBSession, query_data.summary_cache, query_data._last_month_window
+        query_data.Session = insert_data.DBSession = factory
+        query_data._last_month_window = lambda: (ANCHOR - timedelta(days=30), ANCHOR + timedelta(days=1))
+        counter = iter(range(sys.maxsize))
+        insert_data.faker.seed_instance(seed) # The create_sample_* functions draw from Faker and random
+        random.seed(seed)
+        try:
+            for name, function, writes in cases():
+                rng = random.Random(f'{seed}-{name}')
+                count = SAMPLE_CALLS if name.startswith('insert_data.create_sample_') else calls
+                sample = lambda: [_arguments(rng, users, goals, counter) for _ in range(count)]
+                arguments = sample()
+                colds, warms = [], []
+                calibration = calibrate()
+                with contextlib.redirect_stdout(io.StringIO()): # The reporting functions print their reports
+                    for _ in range(repeat):
+                        engine.dispose() # New connections start with an empty SQLite page cache
+                        query_data.summary_cache = SummaryCache()
+                        colds.append(run_phase(function, sample() if writes else arguments)) # Writes need new users and emails
+                        warms.append(run_phase(function, sample() if writes else arguments))
+                    peak = min(_peak_memory(function, sample() if writes else arguments) for _ in range(2)) # The first pass may also count lazy one-off setup
+                cold, warm = _best(colds), _best(warms)
+                cold['peak_kib'] = warm['peak_kib'] = peak
+                cold['calibration_ms'] = warm['calibration_ms'] = calibration
+                results[name] = {'cold': cold, 'warm': warm}
+                print(f"{scale:>5} {name:<52}{cold['throughput']:>10.0f}{cold['p50_ms']:>9.3f}{warm['throughput']:>10.0f}"
+                      f"{warm['p50_ms']:>9.3f}{warm['p95_ms']:>9.3f}{warm['statements_per_call']:>8.1f}{peak:>10.0f}")
+        finally:
+            query_data.Session, insert_data.DBSession, query_data.summary_cache, query_data._last_month_window = saved
+            engine.dispose()
+    return results
+
+def calibrate(rounds=CALIBRATION_ROUNDS):
+    '''Milliseconds of a fixed CPU and SQLite workload that does not depend on the code under test, median of `rounds`'''
+    connection = sqlite3.connect(':memory:')
+    connection.execute('CREATE TABLE numbers (n INTEGER PRIMARY KEY, v INTEGER)')
+    connection.executemany('INSERT INTO numbers VALUES (?, ?)', ((n, n * 7919 % 1000) for n in range(20000)))
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        sum(n * n % 7 for n in range(200000))
+        for n in range(200):
+            connection.execute('SELECT sum(v) FROM numbers WHERE n BETWEEN ? AND ?', (n * 50, n * 50 + 500)).fetchone()
+        connection.execute('SELECT v, count(*) FROM numbers GROUP BY v').fetchall()
+        timings.append(time.perf_counter() - started)
+    connection.close()
+    return statistics.median(timings) * 1000 # The median, unlike the fastest round, reflects how loaded the machine is
+
+def _drift(before, after):
+    '''How much slower the machine ran the calibration workload for a phase than for its baseline, between 1 and MAX_DRIFT'''
+    if not before.get('calibration_ms') or not after.get('calibration_ms'):
+        return 1
+    return min(MAX_DRIFT, max(1, after['calibration_ms'] / before['calibration_ms']))
+
+def compare(baseline, current, threshold, memory_threshold=None):
+    '''Regressions of `current` against `baseline` as (scale, case, phase, metric, before, after) tuples'''
+    memory_threshold = threshold if memory_threshold is None else memory_threshold
+    pairs = []
+    for scale, cases_measured in current['results'].items():
+        for name, phases in cases_measured.items():
+            for phase, after in phases.items():
+                before = baseline.get('results', {}).get(scale, {}).get(name, {}).get(phase)
+                if before is not None:
+                    pairs.append((scale, name, phase, before, after))
+    regressions = []
+    for scale, name, phase, before, after in pairs:
+        drift = _drift(before, after)
+        expected_ms = before['p50_ms'] * drift
+        slower = (after['p50_ms'] > expected_ms * (1 + threshold) and after['p50_ms'] - expected_ms > LATENCY_FLOOR_MS
+                  and after['throughput'] < before['throughput'] / drift / (1 + threshold))
+        checks = [
+            ('p50_ms', slower),
+            ('throughput', slower),
+            ('statements_per_call', after['statements_per_call'] > before['statements_per_call'] * (1 + threshold)),
+            ('peak_kib', after['peak_kib'] > before['peak_kib'] * (1 + memory_threshold) and after['peak_kib'] - before['peak_kib'] > 64),
+        ]
+        regressions += [(scale, name, phase, metric, before[metric], after[metric]) for metric, regressed in checks if regressed]
+    return regressions
+
+def environment():
+    return {
+        'python': platform.python_version(), 'sqlalchemy': sqlalchemy.__version__, 'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(), 'processor': platform.processor(), 'cpus': os.cpu_count(), 'node': platform.node(),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 4], help='scale factors to measure')
+    parser.add_argument('--calls', type=int, default=100, help='calls per function and phase')
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every phase, of which the fastest is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the datasets and of the sampled arguments')
+    parser.add_argument('--data-dir', default='benchmark_data', help='directory keeping the generated datasets')
+    parser.add_argument('--baseline', default='benchmark_baseline.json', help='JSON baseline to compare with or update')
+    parser.add_argument('--update-baseline', action='store_true', help='record this run as the baseline instead of comparing')
+    parser.add_argument('--output', help='also write the results of this run to this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.25, help='relative regression tolerated before failing (0.25 = 25%%)')
+    parser.add_argument('--memory-threshold', type=float, default=None, help='relative memory growth tolerated (default: --threshold)')
+    args = parser.parse_args()
+
+    instrumentation.set_slow_query_threshold(float('inf')) # Slow-query logging would add EXPLAIN calls to the timings
+    run = {'environment': environment(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'calls': args.calls, 'repeat': args.repeat, 'seed': args.seed,
+           'scale_users': SCALE_USERS, 'scale_log_rows': SCALE_LOG_ROWS, 'results': {}}
+    print(f"{'scale':>5} {'function':<52}{'cold/s':>10}{'cold p50':>9}{'warm/s':>10}{'warm p50':>9}{'warm p95':>9}{'stmts':>8}{'peak KiB':>10}")
+    for scale in args.scales:
+        dataset = prepare_dataset(args.data_dir, scale, args.seed)
+        run['results'][str(scale)] = run_scale(dataset, scale, args.calls, args.seed, args.repeat)
+    run['peak_rss_kib'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(run, output, indent=2)
+    if args.update_baseline or not os.path.exists(args.baseline):
+        with open(args.baseline, 'w') as output:
+            json.dump(run, output, indent=2)
+        print(f"Baseline written to {args.baseline}")
+        return
+    with open(args.baseline) as source:
+        baseline = json.load(source)
+    if baseline.get('environment') != run['environment']:
+        print("Warning: the baseline was recorded in a different environment; differences may not be regressions")
+    regressions = compare(baseline, run, args.threshold, args.memory_threshold)
+    for scale, name, phase, metric, before, after in regressions:
+        print(f"REGRESSION scale {scale} {name} ({phase}) {metric}: {before:.3f} -> {after:.3f}")
+    if regressions:
+        sys.exit(1)
+    print(f"No regression beyond {args.threshold:.0%} against {args.baseline}")
+
+if __name__ == '__main__':
+    main()
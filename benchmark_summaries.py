@@ -0,0 +1,95 @@
+'''Compare the set-based summaries in summaries.py with the original per-row Python loops.
+
+Run `python benchmark_summaries.py --rows 10000 1000000` to time both approaches for a single
+user holding that many rows in every log table.
+'''
+import argparse
+import os
+import tempfile
+import time
+from datetime import date, timedelta
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from create import Workout, NutritionLog, SleepRecord, MoodLog
+import bulk_data
+import summaries
+
+ANCHOR = date(2024, 6, 30) # Fixed so every run generates the same rows
+DAYS = 730
+
+def loop_nutrition(session, user_id, start, end):
+    '''Original get_detailed_nutrition_summary: load every log and sum in Python'''
+    logs = session.query(NutritionLog).filter(NutritionLog.user_id == user_id, NutritionLog.date >= start, NutritionLog.date < end).all()
+    total_calories, total_proteins, total_carbs, total_fats = 0, 0, 0, 0
+    for log in logs:
+        total_calories += log.calories
+        total_proteins += log.proteins
+        total_carbs += log.carbs
+        total_fats += log.fats
+    return total_calories, total_proteins, total_carbs, total_fats
+
+def loop_workouts(session, user_id, start, end):
+    '''Original get_monthly_workout_summary: load every workout and sum in Python'''
+    workouts = session.query(Workout).filter(Workout.user_id == user_id, Workout.date >= start, Workout.date < end).all()
+    return sum([workout.duration for workout in workouts]), {workout.intensity for workout in workouts}
+
+def loop_sleep(session, user_id, start, end):
+    '''Original get_sleep_quality_overview: load every record and count in Python'''
+    records = session.query(SleepRecord).filter(SleepRecord.user_id == user_id, SleepRecord.start_time >= start, SleepRecord.start_time < end).all()
+    quality_counts = {"Poor": 0, "Fair": 0, "Good": 0, "Excellent": 0}
+    for record in records:
+        quality_counts[record.quality] += 1
+    return quality_counts
+
+def loop_mood(session, user_id, start, end):
+    '''Original get_user_mood_trends: load every log and count in Python'''
+    logs = session.query(MoodLog).filter(MoodLog.user_id == user_id, MoodLog.date >= start, MoodLog.date < end).all()
+    mood_counts = {}
+    for log in logs:
+        mood_counts[log.mood] = mood_counts.get(log.mood, 0) + 1
+    return mood_counts
+
+def loop_dashboard(session, user_id, start, end):
+    '''Every panel computed with the original loops'''
+    return (loop_nutrition(session, user_id, start, end), loop_workouts(session, user_id, start, end),
+            loop_sleep(session, user_id, start, end), loop_mood(session, user_id, start, end))
+
+COMPARISONS = [
+    ('nutrition', loop_nutrition, summaries.nutrition_summary),
+    ('workouts', loop_workouts, summaries.workout_summary),
+    ('sleep', loop_sleep, summaries.sleep_overview),
+    ('mood', loop_mood, summaries.mood_trends),
+    ('dashboard', loop_dashboard, summaries.dashboard),
+]
+
+def best_of(engine, function, repeat, *args):
+    '''Best wall time in milliseconds over `repeat` calls, each in a fresh session'''
+    best = float('inf')
+    for _ in range(repeat):
+        with Session(engine) as session: # A fresh session so the identity map starts empty
+            started = time.perf_counter()
+            function(session, *args)
+            best = min(best, time.perf_counter() - started)
+    return best * 1000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 1000000], help='rows per log table for the single user')
+    parser.add_argument('--repeat', type=int, default=3, help='calls per function; the best time is reported')
+    args = parser.parse_args()
+
+    start, end = ANCHOR - timedelta(days=DAYS), ANCHOR + timedelta(days=1) # The whole generated history
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = create_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+            bulk_data.generate(engine, users=1, log_rows=rows * len(bulk_data.LOG_TABLES), anchor=ANCHOR, days=DAYS)
+            print(f"\n{rows} rows per table")
+            print(f"{'panel':<12}{'loops (ms)':>14}{'GROUP BY (ms)':>16}{'speedup':>10}")
+            for name, loop, grouped in COMPARISONS:
+                loop_ms = best_of(engine, loop, args.repeat, 1, start, end)
+                grouped_ms = best_of(engine, grouped, args.repeat, 1, start, end)
+                print(f"{name:<12}{loop_ms:>14.1f}{grouped_ms:>16.1f}{loop_ms / grouped_ms:>9.1f}x")
+            engine.dispose()
+
+if __name__ == '__main__':
+    main()
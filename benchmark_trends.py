@@ -0,0 +1,85 @@
+'''Compare NumPy trend summaries with the same metrics computed row by row in Python.
+
+Run `python benchmark_trends.py --users 5000 --log-rows 4000000` to generate a dataset spanning two
+years and time trends.trend_summary() over every user against a baseline that reads the same daily
+rollups and walks each user's days in plain Python loops.
+'''
+import argparse
+import math
+import os
+import tempfile
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from create import DailyNutrition, DailyWorkout, DailySleep, DailyMood
+from database import get_engine
+import bulk_data
+import trends
+
+ANCHOR = date(2024, 6, 30)
+WINDOW = (ANCHOR - timedelta(days=729), ANCHOR + timedelta(days=1))
+
+def row_by_row(session, start, end):
+    '''The 7-day energy balance, streaks and stress/sleep correlation of every user, one row at a time'''
+    eaten, burned, worked, slept, stress = (defaultdict(dict) for _ in range(5))
+    for user_id, day, calories in session.execute(select(DailyNutrition.user_id, DailyNutrition.day, DailyNutrition.calories).where(DailyNutrition.day >= start, DailyNutrition.day < end)):
+        eaten[user_id][day] = calories
+    for user_id, day, calories in session.execute(select(DailyWorkout.user_id, DailyWorkout.day, DailyWorkout.calories_burned).where(DailyWorkout.day >= start, DailyWorkout.day < end)):
+        burned[user_id][day] = burned[user_id].get(day, 0) + calories
+        worked[user_id][day] = True
+    for user_id, day, hours in session.execute(select(DailySleep.user_id, DailySleep.day, DailySleep.hours).where(DailySleep.day >= start, DailySleep.day < end)):
+        slept[user_id][day] = slept[user_id].get(day, 0) + hours
+    for user_id, day, total, entries in session.execute(select(DailyMood.user_id, DailyMood.day, DailyMood.stress_total, DailyMood.stress_entries).where(DailyMood.day >= start, DailyMood.day < end)):
+        previous = stress[user_id].get(day, (0, 0))
+        stress[user_id][day] = (previous[0] + total, previous[1] + entries)
+
+    days = [start + timedelta(days=offset) for offset in range((end - start).days)]
+    results = {}
+    for user_id in set(eaten) | set(burned) | set(slept) | set(stress):
+        balances = [eaten[user_id][day] - burned[user_id].get(day, 0) for day in days[-7:] if day in eaten[user_id]]
+        current = longest = 0
+        for day in days:
+            current = current + 1 if worked[user_id].get(day) else 0
+            longest = max(longest, current)
+        pairs = [(stress[user_id][day][0] / stress[user_id][day][1], slept[user_id][day - timedelta(days=1)])
+                 for day in days[1:] if stress[user_id].get(day, (0, 0))[1] and (day - timedelta(days=1)) in slept[user_id]]
+        correlation = math.nan
+        if len(pairs) >= trends.MIN_CORRELATION_DAYS:
+            mean_x = sum(x for x, _ in pairs) / len(pairs)
+            mean_y = sum(y for _, y in pairs) / len(pairs)
+            scale = math.sqrt(sum((x - mean_x) ** 2 for x, _ in pairs) * sum((y - mean_y) ** 2 for _, y in pairs))
+            if scale:
+                correlation = sum((x - mean_x) * (y - mean_y) for x, y in pairs) / scale
+        results[user_id] = (sum(balances) / len(balances) if balances else math.nan, current, longest, correlation)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=5000, help='number of users to generate')
+    parser.add_argument('--log-rows', type=int, default=4000000, help='log rows to generate')
+    parser.add_argument('--chunk-size', type=int, default=trends.CHUNK_USERS, help='users loaded per chunk')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = get_engine('sqlite:///' + os.path.join(directory, 'benchmark.db'))
+        bulk_data.generate(engine, args.users, args.log_rows, anchor=ANCHOR)
+        with Session(engine) as session:
+            started = time.perf_counter()
+            summary = trends.trend_summary(session, *WINDOW, chunk_size=args.chunk_size)
+            vectorized = time.perf_counter() - started
+            started = time.perf_counter()
+            baseline = row_by_row(session, *WINDOW)
+            looped = time.perf_counter() - started
+        engine.dispose()
+
+    mismatches = sum(1 for user_id, (_, current, longest, _) in baseline.items()
+                     if (summary.for_user(user_id)['current_streak'], summary.for_user(user_id)['longest_streak']) != (current, longest))
+    print(f"{'method':<14}{'seconds':>10}{'users/s':>12}")
+    print(f"{'vectorized':<14}{vectorized:>10.2f}{len(summary) / vectorized:>12.0f}")
+    print(f"{'row by row':<14}{looped:>10.2f}{len(baseline) / looped:>12.0f}")
+    print(f"Streak mismatches: {mismatches}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,243 @@
+'''Generate production-scale synthetic data for load testing.
+
+Unlike insert_data.py, which builds one ORM object per row, this generator builds each
+partition of users as column arrays, draws free text from a small pre-generated pool and
+writes every table with a single executemany per partition inside one large transaction.
+The daily rollup tables are rebuilt once at the end of the load. Partitions are generated
+from `seed` alone, so the same arguments always produce the same database no matter how
+many worker processes are used.
+
+    python3 bulk_data.py --database load_test.db --users 100000 --log-rows 50000000 --workers 4
+'''
+import argparse
+import random
+import time
+from datetime import date, timedelta
+from multiprocessing import Pool
+from faker import Faker
+from sqlalchemy import func, select
+from create import Base, User, create_missing_indexes
+from database import get_engine
+import rollups
+import search
+
+TEXT_POOL_SIZE = 1000 # Number of distinct notes/bios/descriptions drawn from Faker once per load
+PARTITION_ROWS = 200000 # Approximate number of log rows generated and written per partition
+
+GENDERS = ['Male', 'Female', 'Other']
+WORKOUT_TYPES = ['Running', 'Cycling', 'Swimming', 'Yoga', 'Gym', 'Hiking', 'Dancing', 'CrossFit']
+INTENSITIES = ['Low', 'Medium', 'High']
+DURATIONS = [30, 45, 60, 75, 90, 120]
+MEAL_TYPES = ['Breakfast', 'Lunch', 'Dinner', 'Snack']
+SLEEP_QUALITIES = ['Poor', 'Fair', 'Good', 'Excellent']
+MOODS = ['Happy', 'Sad', 'Angry', 'Stressed', 'Calm', 'Anxious']
+
+LOG_TABLES = ['workouts', 'nutrition_logs', 'sleep_records', 'mood_logs'] # Log rows are split evenly across these tables
+
+def build_text_pools(seed):
+    '''Pre-generate the pools of names and free text that every partition samples from'''
+    faker = Faker()
+    faker.seed_instance(seed)
+    return {
+        'names': [faker.name() for _ in range(TEXT_POOL_SIZE)],
+        'short_texts': [faker.text(max_nb_chars=100) for _ in range(TEXT_POOL_SIZE)],
+        'long_texts': [faker.text(max_nb_chars=200) for _ in range(TEXT_POOL_SIZE)],
+        'sentences': [faker.sentence(nb_words=6) for _ in range(TEXT_POOL_SIZE)],
+    }
+
+def plan_partitions(users, log_rows, first_user_id, partition_rows=PARTITION_ROWS):
+    '''Split the users into contiguous id ranges that each hold roughly `partition_rows` log rows'''
+    rows_per_user = max(log_rows // max(users, 1), 0)
+    users_per_partition = max(partition_rows // max(rows_per_user, 1), 1)
+    partitions = []
+    for index, offset in enumerate(range(0, users, users_per_partition)):
+        first = first_user_id + offset
+        last = first_user_id + min(offset + users_per_partition, users) - 1
+        partitions.append((index, first, last))
+    return partitions, rows_per_user
+
+def _rows_per_table(rows_per_user):
+    '''Split a user's log rows across the log tables, giving any remainder to the first tables'''
+    share, remainder = divmod(rows_per_user, len(LOG_TABLES))
+    return {table: share + (1 if position < remainder else 0) for position, table in enumerate(LOG_TABLES)}
+
+def generate_partition(task):
+    '''Build the rows of every table for one partition of users as (table, columns, rows) triples'''
+    index, first, last, rows_per_user, seed, anchor, days, pools = task
+    rng = random.Random(f'{seed}:{index}') # String seeds are hashed deterministically across processes
+    rnd, choices = rng.random, rng.choices
+    user_ids = range(first, last + 1)
+    user_count = len(user_ids)
+    day_strings = [(anchor - timedelta(days=offset)).isoformat() for offset in range(days + 1)]
+    per_table = _rows_per_table(rows_per_user)
+
+    def repeat_ids(per_user):
+        return [user_id for user_id in user_ids for _ in range(per_user)]
+
+    def uniform(low, high, n, digits=2):
+        return [round(low + (high - low) * rnd(), digits) for _ in range(n)]
+
+    def integers(low, high, n):
+        return [low + int((high - low + 1) * rnd()) for _ in range(n)]
+
+    tables = []
+    tables.append(('users', ('id', 'name', 'age', 'gender', 'weight', 'height', 'email', 'bio'), list(zip(
+        user_ids,
+        choices(pools['names'], k=user_count),
+        integers(18, 65, user_count),
+        choices(GENDERS, k=user_count),
+        uniform(50.0, 120.0, user_count),
+        uniform(150.0, 210.0, user_count),
+        [f'user{user_id}@example.com' for user_id in user_ids], # Faker emails collide at this scale
+        choices(pools['long_texts'], k=user_count),
+    ))))
+
+    goal_user_ids = [user_id for user_id in user_ids for _ in range(1 + int(3 * rnd()))]
+    n = len(goal_user_ids)
+    future_days = [(anchor + timedelta(days=offset)).isoformat() for offset in range(30, 366)]
+    tables.append(('fitness_goals', ('user_id', 'goal', 'description', 'target_date', 'completed'), list(zip(
+        goal_user_ids,
+        choices(pools['sentences'], k=n),
+        choices(pools['long_texts'], k=n),
+        choices(future_days, k=n),
+        choices([0, 1], k=n),
+    ))))
+
+    n = user_count * per_table['workouts']
+    tables.append(('workouts', ('user_id', 'date', 'duration', 'type', 'intensity', 'calories_burned', 'notes'), list(zip(
+        repeat_ids(per_table['workouts']),
+        choices(day_strings, k=n),
+        choices(DURATIONS, k=n),
+        choices(WORKOUT_TYPES, k=n),
+        choices(INTENSITIES, k=n),
+        integers(100, 800, n),
+        choices(pools['short_texts'], k=n),
+    ))))
+
+    n = user_count * per_table['nutrition_logs']
+    tables.append(('nutrition_logs', ('user_id', 'date', 'meal_type', 'calories', 'proteins', 'carbs', 'fats', 'notes'), list(zip(
+        repeat_ids(per_table['nutrition_logs']),
+        choices(day_strings, k=n),
+        choices(MEAL_TYPES, k=n),
+        integers(100, 1200, n),
+        uniform(0, 100, n),
+        uniform(0, 300, n),
+        uniform(0, 100, n),
+        choices(pools['short_texts'], k=n),
+    ))))
+
+    # Bedtime falls between 20:00 and 23:59 and lasts 6 to 10 hours, so the night always ends on the next day
+    n = user_count * per_table['sleep_records']
+    day_positions = integers(1, days, n)
+    start_hours = integers(20, 23, n)
+    minutes = integers(0, 59, n)
+    lengths = integers(6, 10, n)
+    tables.append(('sleep_records', ('user_id', 'start_time', 'end_time', 'duration_hours', 'quality', 'deep_sleep_duration', 'notes'), list(zip(
+        repeat_ids(per_table['sleep_records']),
+        [f'{day_strings[position]} {hour:02d}:{minute:02d}:00.000000' for position, hour, minute in zip(day_positions, start_hours, minutes)],
+        [f'{day_strings[position - 1]} {hour + length - 24:02d}:{minute:02d}:00.000000' for position, hour, minute, length in zip(day_positions, start_hours, minutes, lengths)],
+        [float(length) for length in lengths],
+        choices(SLEEP_QUALITIES, k=n),
+        uniform(1, 5, n),
+        choices(pools['short_texts'], k=n),
+    ))))
+
+    n = user_count * per_table['mood_logs']
+    tables.append(('mood_logs', ('user_id', 'date', 'mood', 'stress_level', 'notes'), list(zip(
+        repeat_ids(per_table['mood_logs']),
+        choices(day_strings, k=n),
+        choices(MOODS, k=n),
+        integers(1, 10, n),
+        choices(pools['long_texts'], k=n),
+    ))))
+    return tables
+
+def _set_load_pragmas(connection):
+    '''Trade durability for speed while loading and return the settings to restore afterwards'''
+    previous = {
+        'journal_mode': connection.exec_driver_sql('PRAGMA journal_mode').scalar(),
+        'synchronous': connection.exec_driver_sql('PRAGMA synchronous').scalar(),
+    }
+    connection.exec_driver_sql('PRAGMA journal_mode=OFF') # A failed load is simply regenerated
+    connection.exec_driver_sql('PRAGMA synchronous=OFF')
+    connection.exec_driver_sql('PRAGMA cache_size=-262144') # 256 MiB page cache for index maintenance
+    connection.exec_driver_sql('PRAGMA temp_store=MEMORY')
+    return previous
+
+def _restore_pragmas(connection, previous):
+    '''Restore the journal and synchronous settings that were active before the load'''
+    connection.exec_driver_sql(f"PRAGMA journal_mode={previous['journal_mode']}")
+    connection.exec_driver_sql(f"PRAGMA synchronous={previous['synchronous']}")
+
+def _drop_secondary_indexes(connection):
+    '''Drop the model indexes so they are built once at the end instead of row by row'''
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.drop(connection, checkfirst=True)
+
+def generate(engine, users, log_rows, seed=0, workers=1, days=730, anchor=None, defer_indexes=True, partition_rows=PARTITION_ROWS):
+    '''Load `users` users and about `log_rows` log rows into the database and return the row count per table'''
+    anchor = anchor or date.today()
+    Base.metadata.create_all(engine)
+    with engine.connect() as connection:
+        first_user_id = (connection.execute(select(func.max(User.id))).scalar() or 0) + 1 # Append after any existing users
+    partitions, rows_per_user = plan_partitions(users, log_rows, first_user_id, partition_rows)
+    pools = build_text_pools(seed)
+    tasks = [(index, first, last, rows_per_user, seed, anchor, days, pools) for index, first, last in partitions]
+
+    counts = {}
+    with engine.connect() as connection:
+        previous = _set_load_pragmas(connection)
+        indexed_notes = search.index_exists(connection) # Only a database that has the search index keeps it
+        connection.commit()
+        try:
+            with connection.begin():
+                if defer_indexes:
+                    _drop_secondary_indexes(connection)
+                search.drop_triggers(connection) # One rebuild at the end instead of an FTS insert per row
+            pool = Pool(workers) if workers > 1 else None
+            batches = pool.imap(generate_partition, tasks) if pool else map(generate_partition, tasks) # imap keeps partition order
+            try:
+                for tables in batches:
+                    with connection.begin(): # One large transaction per partition
+                        for table, columns, rows in tables:
+                            placeholders = ', '.join('?' for _ in columns)
+                            connection.exec_driver_sql(f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows)
+                            counts[table] = counts.get(table, 0) + len(rows)
+            finally:
+                if pool:
+                    pool.close()
+                    pool.join()
+        finally:
+            with connection.begin():
+                if defer_indexes:
+                    create_missing_indexes(connection)
+                rollups.rebuild(connection) # executemany bypasses the ORM events that maintain the rollups and the goal counters
+                if indexed_notes:
+                    search.rebuild(connection)
+            _restore_pragmas(connection, previous)
+            connection.commit()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate production-scale synthetic data for load testing')
+    parser.add_argument('--database', default='load_test.db', help='SQLite file to fill (created if missing)')
+    parser.add_argument('--users', type=int, default=100000, help='number of users to create')
+    parser.add_argument('--log-rows', type=int, default=5000000, help='total rows across the workout, nutrition, sleep and mood tables')
+    parser.add_argument('--seed', type=int, default=0, help='seed that fully determines the generated data')
+    parser.add_argument('--workers', type=int, default=1, help='processes used to generate partitions')
+    parser.add_argument('--days', type=int, default=730, help='number of days of history to spread the logs over')
+    parser.add_argument('--anchor-date', type=date.fromisoformat, default=None, help='last day of history (default: today)')
+    args = parser.parse_args()
+
+    engine = get_engine(f'sqlite:///{args.database}')
+    started = time.perf_counter()
+    counts = generate(engine, args.users, args.log_rows, seed=args.seed, workers=args.workers, days=args.days, anchor=args.anchor_date)
+    elapsed = time.perf_counter() - started
+    total = sum(counts.values())
+    for table, count in counts.items():
+        print(f"{table}: {count} rows")
+    print(f"Inserted {total} rows in {elapsed:.1f}s ({total / elapsed:,.0f} rows/s)")
+
+if __name__ == '__main__':
+    main()
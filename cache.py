@@ -0,0 +1,183 @@
+'''Read-through cache for per-user summaries, invalidated by writes to the tables they read.
+
+Entries are keyed by (function name, user_id, window) and remember the generation of every
+(user_id, table) pair they depend on. A write bumps the generations of the pairs it touches, so
+a stale entry is never served, even if it was being computed while the write happened.
+
+ORM writes are detected through Session events on every session in the process. Writes that
+bypass the ORM (Core executemany, raw SQL) must call invalidate_all_caches() themselves.
+'''
+import pickle
+import sqlite3
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+
+TRACKED_TABLES = ('workouts', 'nutrition_logs', 'sleep_records', 'mood_logs', 'fitness_goals') # Per-user tables whose writes invalidate summaries
+
+_caches = weakref.WeakSet() # Every live SummaryCache, so one set of session listeners serves them all
+
+class SharedCacheBackend:
+    '''SQLite-file cache tier that lets several worker processes reuse each other's results'''
+
+    def __init__(self, path, max_entries=100000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL') # Readers in other processes never block on a writer
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, generations TEXT, expires REAL, value BLOB)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS generations (user_id INTEGER, table_name TEXT, generation INTEGER, PRIMARY KEY (user_id, table_name))')
+        self._writes = 0
+
+    def generations(self, user_id, tables):
+        '''Current generation of each (user_id, table) pair, in the order of `tables`'''
+        with self._lock:
+            rows = dict(self._connection.execute(
+                f"SELECT table_name, generation FROM generations WHERE user_id = ? AND table_name IN ({', '.join('?' for _ in tables)})",
+                (user_id, *tables)).fetchall())
+        return tuple(rows.get(table, 0) for table in tables)
+
+    def bump(self, user_id, tables):
+        '''Invalidate every shared entry of `user_id` that depends on `tables`'''
+        with self._lock:
+            self._connection.executemany('INSERT INTO generations VALUES (?, ?, 1) ON CONFLICT DO UPDATE SET generation = generation + 1',
+                                         [(user_id, table) for table in tables])
+
+    def get(self, key, generations):
+        '''The stored value for `key` if it was computed at `generations` and has not expired, else None'''
+        with self._lock:
+            row = self._connection.execute('SELECT value FROM entries WHERE key = ? AND generations = ? AND expires > ?',
+                                           (repr(key), repr(generations), time.time())).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def set(self, key, generations, value, ttl):
+        '''Store a value computed at `generations`, pruning the oldest entries once over `max_entries`'''
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                                     (repr(key), repr(generations), time.time() + ttl, pickle.dumps(value)))
+            self._writes += 1
+            if self._writes % 1000 == 0: # Prune occasionally rather than on every write
+                self._connection.execute('DELETE FROM entries WHERE expires <= ? OR key IN (SELECT key FROM entries ORDER BY expires DESC LIMIT -1 OFFSET ?)',
+                                         (time.time(), self.max_entries))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM entries')
+
+class SummaryCache:
+    '''Bounded in-process LRU/TTL cache for summaries, optionally backed by a SharedCacheBackend'''
+
+    def __init__(self, max_entries=1024, ttl=300.0, shared=None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.shared = shared
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # key -> (expires, tables, generations, value), least recently used first
+        self._generations = {} # (user_id, table) -> generation, used when there is no shared backend
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        _caches.add(self)
+
+    def _current_generations(self, user_id, tables):
+        if self.shared is not None:
+            return self.shared.generations(user_id, tables)
+        with self._lock:
+            return tuple(self._generations.get((user_id, table), 0) for table in tables)
+
+    def get_or_compute(self, name, user_id, window, tables, compute):
+        '''Return the cached result of `name` for (user_id, window), calling `compute()` on a miss'''
+        key = (name, user_id, window)
+        generations = self._current_generations(user_id, tables) # Taken before computing, so a concurrent write makes the result stale
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > self._clock() and entry[2] == generations:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[3]
+
+        value = self.shared.get(key, generations) if self.shared is not None else None
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+        else:
+            with self._lock:
+                self.misses += 1
+            value = compute()
+            if self.shared is not None:
+                self.shared.set(key, generations, value, self.ttl)
+
+        with self._lock:
+            self._entries[key] = (self._clock() + self.ttl, tables, generations, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return value
+
+    def invalidate(self, user_id, tables):
+        '''Drop every entry of `user_id` that depends on any of `tables`'''
+        tables = set(tables)
+        with self._lock:
+            for table in tables:
+                self._generations[(user_id, table)] = self._generations.get((user_id, table), 0) + 1
+            stale = [key for key, entry in self._entries.items() if key[1] == user_id and tables.intersection(entry[1])]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+        if self.shared is not None:
+            self.shared.bump(user_id, sorted(tables))
+
+    def clear(self):
+        '''Drop every entry'''
+        with self._lock:
+            self._entries.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        '''Hit, miss, eviction and invalidation counters plus the current number of entries'''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'invalidations': self.invalidations, 'size': len(self._entries)}
+
+def invalidate_all_caches(user_id, tables):
+    '''Invalidate `tables` for `user_id` in every live SummaryCache'''
+    for summary_cache in list(_caches):
+        summary_cache.invalidate(user_id, tables)
+
+def _touched(session):
+    '''(user_id, table) pairs written by the objects pending in a flush, including the old owner of a moved row'''
+    touched = set()
+    for instance in session.deleted:
+        if getattr(instance, '__tablename__', None) == 'users': # Its rows go through ON DELETE CASCADE, never through the session
+            touched.update((instance.id, table) for table in TRACKED_TABLES)
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(instance, '__tablename__', None)
+        if table not in TRACKED_TABLES:
+            continue
+        history = inspect(instance).attrs.user_id.history
+        for user_id in [instance.user_id, *history.deleted]:
+            if user_id is not None:
+                touched.add((user_id, table))
+    return touched
+
+@event.listens_for(Session, 'before_flush')
+def _collect_writes(session, flush_context, instances):
+    session.info.setdefault('summary_cache_writes', set()).update(_touched(session))
+
+@event.listens_for(Session, 'after_flush')
+def _invalidate_flushed(session, flush_context):
+    for user_id, table in session.info.get('summary_cache_writes', ()):
+        invalidate_all_caches(user_id, (table,))
+
+def _invalidate_finished(session):
+    # Invalidate again once the transaction ends: another connection may have cached the
+    # previously committed data between the flush and the commit, and a rollback undoes the flush
+    for user_id, table in session.info.pop('summary_cache_writes', ()):
+        invalidate_all_caches(user_id, (table,))
+
+event.listen(Session, 'after_commit', _invalidate_finished)
+event.listen(Session, 'after_rollback', _invalidate_finished)
@@ -0,0 +1,27 @@
+import pytest
+from sqlalchemy.orm import sessionmaker
+from database import get_engine
+from create import Base, User
+
+@pytest.fixture
+def users():
+    '''Users the `session` fixture starts with; a test module overrides this fixture to seed its own.'''
+    return [User(id=1, name="Tess Test", email="tess@example.com")]
+
+@pytest.fixture
+def rows():
+    '''Rows the `session` fixture adds after the users, such as a module's logs; none by default.'''
+    return []
+
+@pytest.fixture
+def session(users, rows):
+    '''A session on a fresh in-memory database holding `users` and then `rows`, with foreign keys enforced like every get_engine() connection.'''
+    engine = get_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all(users)
+    session.add_all(rows)
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
@@ -1,5 +1,8 @@
-from sqlalchemy import create_engine, Column, Integer, String, Float, ForeignKey, Date, DateTime, Boolean, Text
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Date, DateTime, Boolean, Text, Index, event, inspect, text
 from sqlalchemy.orm import relationship, sessionmaker, declarative_base
+from sqlalchemy.schema import CreateTable
+from database import get_engine
+import search
 
 Base = declarative_base() # Base class for our classes to inherit from
 
@@ -14,28 +17,35 @@ class User(Base):
     height = Column(Float) # Height of the user in centimeters
     email = Column(String, unique=True, nullable=False,index=True) # Email address of the user
     bio = Column(Text) # A short bio of the user
-    fitness_goals = relationship("FitnessGoal", back_populates="user", cascade="all, delete, delete-orphan") # Relationship with the FitnessGoal class (one-to-many)
-    workouts = relationship("Workout", back_populates="user", cascade="all, delete, delete-orphan") # Relationship with the Workout class (one-to-many)
-    nutrition_logs = relationship("NutritionLog", back_populates="user", cascade="all, delete, delete-orphan") # Relationship with the NutritionLog class (one-to-many)
-    sleep_records = relationship("SleepRecord", back_populates="user", cascade="all, delete, delete-orphan") # Relationship with the SleepRecord class (one-to-many)
-    mood_logs = relationship("MoodLog", back_populates="user", cascade="all, delete, delete-orphan") # Relationship with the MoodLog class (one-to-many)
+    fitness_goals = relationship("FitnessGoal", back_populates="user", cascade="all, delete, delete-orphan", passive_deletes=True) # Relationship with the FitnessGoal class (one-to-many)
+    workouts = relationship("Workout", back_populates="user", cascade="all, delete, delete-orphan", passive_deletes=True) # Relationship with the Workout class (one-to-many)
+    nutrition_logs = relationship("NutritionLog", back_populates="user", cascade="all, delete, delete-orphan", passive_deletes=True) # Relationship with the NutritionLog class (one-to-many)
+    sleep_records = relationship("SleepRecord", back_populates="user", cascade="all, delete, delete-orphan", passive_deletes=True) # Relationship with the SleepRecord class (one-to-many)
+    mood_logs = relationship("MoodLog", back_populates="user", cascade="all, delete, delete-orphan", passive_deletes=True) # Relationship with the MoodLog class (one-to-many)
 
 class FitnessGoal(Base):
     '''This class represents the fitness_goals table in the database'''
     __tablename__ = 'fitness_goals'
     id = Column(Integer, primary_key=True) # Unique identifier for each fitness goal
-    user_id = Column(Integer, ForeignKey('users.id')) # Foreign key to link the fitness goal to a user
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE')) # Foreign key to link the fitness goal to a user
     goal = Column(String, nullable=False) # The fitness goal
     description = Column(Text) # A detailed description of the goal
     target_date = Column(Date) # The target date to achieve the goal
     completed = Column(Boolean, default=False) # Whether the goal has been completed or not
+    metric = Column(String) # What a measurable goal targets (a key of goal_progress.TARGETS); NULL for goals tracked by hand
+    target = Column(Float) # Total, daily ceiling or nightly average to reach by the target date
+    start_date = Column(Date) # First day counted towards a measurable goal (default: the day it is created)
+    progress = Column(Float, default=0) # Measure summed over the logs of the goal's window, kept up to date on write
+    progress_count = Column(Integer, default=0) # Workouts, days with meals or nights counted in progress
     user = relationship("User", back_populates="fitness_goals") # Relationship with the User class (many-to-one)
+    __table_args__ = (Index('ix_fitness_goals_user_id_target_date', 'user_id', 'target_date'), # Per-user goal lookups ordered by target date
+                      Index('ix_fitness_goals_user_id_metric_target_date', 'user_id', 'metric', 'target_date', sqlite_where=metric.isnot(None))) # Goals a newly logged day counts towards
 
 class Workout(Base):
     '''This class represents the workouts table in the database'''
     __tablename__ = 'workouts'
     id = Column(Integer, primary_key=True) # Unique identifier for each workout
-    user_id = Column(Integer, ForeignKey('users.id')) # Foreign key to link the workout to a user
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE')) # Foreign key to link the workout to a user
     date = Column(Date, nullable=False,index=True) # Date of the workout
     duration = Column(Float) # Duration of the workout in minutes
     type = Column(String) # Type of the workout
@@ -43,12 +53,13 @@ class Workout(Base):
     calories_burned = Column(Float) # Calories burned during the workout
     notes = Column(Text) # Any additional notes about the workout
     user = relationship("User", back_populates="workouts") # Relationship with the User class (many-to-one)
+    __table_args__ = (Index('ix_workouts_user_id_date', 'user_id', 'date'),) # Per-user date range scans
 
 class NutritionLog(Base):
     '''This class represents the nutrition_logs table in the database'''
     __tablename__ = 'nutrition_logs'
     id = Column(Integer, primary_key=True) # Unique identifier for each nutrition log
-    user_id = Column(Integer, ForeignKey('users.id')) # Foreign key to link the nutrition log to a user
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE')) # Foreign key to link the nutrition log to a user
     date = Column(Date, nullable=False,index=True) # Date of the nutrition log
     meal_type = Column(String) # Type of meal (e.g. Breakfast, Lunch, Dinner, Snack)
     calories = Column(Integer) # Calories consumed
@@ -57,34 +68,201 @@ class NutritionLog(Base):
     fats = Column(Float) # Fats consumed in grams
     notes = Column(Text) # Any additional notes about the nutrition log
     user = relationship("User", back_populates="nutrition_logs") # Relationship with the User class (many-to-one)
+    __table_args__ = (Index('ix_nutrition_logs_user_id_date', 'user_id', 'date'),) # Per-user date range scans
 
 class SleepRecord(Base):
     '''This class represents the sleep_records table in the database'''
     __tablename__ = 'sleep_records'
     id = Column(Integer, primary_key=True) # Unique identifier for each sleep record
-    user_id = Column(Integer, ForeignKey('users.id')) # Foreign key to link the sleep record to a user
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE')) # Foreign key to link the sleep record to a user
     start_time = Column(DateTime, nullable=False,index=True) # Start time of the sleep
     end_time = Column(DateTime, nullable=False) # End time of the sleep
     quality = Column(String) # Quality of the sleep (e.g. Poor, Fair, Good, Excellent)
     deep_sleep_duration = Column(Float) # Duration of deep sleep in hours
+    duration_hours = Column(Float) # end_time - start_time in hours, kept up to date on every insert and update
     notes = Column(Text) # Any additional notes about the sleep record
     user = relationship("User", back_populates="sleep_records") # Relationship with the User class (many-to-one)
+    __table_args__ = (
+        Index('ix_sleep_records_user_id_start_time', 'user_id', 'start_time'), # Per-user time range scans
+        Index('ix_sleep_records_user_id_duration_hours', 'user_id', 'duration_hours'), # Per-user questions such as "nights under 6 hours"
+    )
+
+def sleep_duration_hours(start_time, end_time):
+    '''Hours between the start and the end of a night, or None if either is missing'''
+    if start_time is None or end_time is None:
+        return None
+    return (end_time - start_time).total_seconds() / 3600
+
+@event.listens_for(SleepRecord, 'before_insert')
+@event.listens_for(SleepRecord, 'before_update')
+def _fill_duration_hours(mapper, connection, target):
+    '''Persist the duration of every sleep record written through the ORM; Core inserts use sleep_duration_hours()'''
+    target.duration_hours = sleep_duration_hours(target.start_time, target.end_time)
 
 class MoodLog(Base):
     '''This class represents the mood_logs table in the database'''
     __tablename__ = 'mood_logs'
     id = Column(Integer, primary_key=True) # Unique identifier for each mood log
-    user_id = Column(Integer, ForeignKey('users.id')) # Foreign key to link the mood log to a user
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE')) # Foreign key to link the mood log to a user
     date = Column(Date, nullable=False,index=True) # Date of the mood log
     mood = Column(String) # Mood of the user
     stress_level = Column(Integer)  # Stress level of the user
     notes = Column(Text) # Any additional notes about the mood log
     user = relationship("User", back_populates="mood_logs") # Relationship with the User class (many-to-one)
+    __table_args__ = (Index('ix_mood_logs_user_id_date', 'user_id', 'date'),) # Per-user date range scans
+
+# Per-user-per-day rollups of the log tables, maintained incrementally by rollups.py.
+# Text key columns store '' instead of NULL so that every rollup row has a usable primary key.
+
+class DailyNutrition(Base):
+    '''This class represents the daily_nutrition rollup table in the database'''
+    __tablename__ = 'daily_nutrition'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True) # User the meals belong to
+    day = Column(Date, primary_key=True) # Day the meals were logged
+    meals = Column(Integer, nullable=False, default=0) # Number of nutrition logs
+    calories = Column(Integer, nullable=False, default=0) # Calories consumed
+    proteins = Column(Float, nullable=False, default=0) # Proteins consumed in grams
+    carbs = Column(Float, nullable=False, default=0) # Carbohydrates consumed in grams
+    fats = Column(Float, nullable=False, default=0) # Fats consumed in grams
+
+class DailyWorkout(Base):
+    '''This class represents the daily_workouts rollup table in the database'''
+    __tablename__ = 'daily_workouts'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True) # User the workouts belong to
+    day = Column(Date, primary_key=True) # Day of the workouts
+    type = Column(String, primary_key=True) # Type of the workouts
+    intensity = Column(String, primary_key=True) # Intensity of the workouts
+    sessions = Column(Integer, nullable=False, default=0) # Number of workouts
+    minutes = Column(Float, nullable=False, default=0) # Total duration in minutes
+    calories_burned = Column(Float, nullable=False, default=0) # Total calories burned
+
+class DailySleep(Base):
+    '''This class represents the daily_sleep rollup table in the database'''
+    __tablename__ = 'daily_sleep'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True) # User the nights belong to
+    day = Column(Date, primary_key=True) # Day the nights started
+    quality = Column(String, primary_key=True) # Quality of the nights
+    nights = Column(Integer, nullable=False, default=0) # Number of sleep records
+    hours = Column(Float, nullable=False, default=0) # Total hours slept
+    deep_hours = Column(Float, nullable=False, default=0) # Total hours of deep sleep
+
+class DailyMood(Base):
+    '''This class represents the daily_moods rollup table in the database'''
+    __tablename__ = 'daily_moods'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True) # User the mood logs belong to
+    day = Column(Date, primary_key=True) # Day of the mood logs
+    mood = Column(String, primary_key=True) # Mood logged
+    entries = Column(Integer, nullable=False, default=0) # Number of mood logs
+    stress_total = Column(Float, nullable=False, default=0) # Sum of the logged stress levels
+    stress_entries = Column(Integer, nullable=False, default=0) # Number of mood logs with a stress level
+
+# Leaderboard snapshots, recomputed from the rollup tables by leaderboards.py so that a user's rank
+# is a point lookup rather than a ranking of every user on each request.
+
+class LeaderboardSnapshot(Base):
+    '''This class represents the leaderboard_snapshots table in the database'''
+    __tablename__ = 'leaderboard_snapshots'
+    metric = Column(String, primary_key=True) # Metric the users are ranked by
+    period = Column(String, primary_key=True) # Length of the period ranked ('week' or 'month')
+    period_start = Column(Date, primary_key=True) # First day of the period
+    refreshed_at = Column(DateTime, nullable=False) # When the rankings of the period were last computed
+    users = Column(Integer, nullable=False, default=0) # Number of users ranked
+
+class LeaderboardEntry(Base):
+    '''This class represents the leaderboard_entries table in the database'''
+    __tablename__ = 'leaderboard_entries'
+    metric = Column(String, primary_key=True) # Metric the users are ranked by
+    period = Column(String, primary_key=True) # Length of the period ranked ('week' or 'month')
+    period_start = Column(Date, primary_key=True) # First day of the period
+    cohort = Column(String, primary_key=True) # Cohort the user is ranked within, e.g. 'all' or 'age:30-39/gender:Female'
+    user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True) # User ranked
+    value = Column(Float, nullable=False) # The user's score over the period
+    rank = Column(Integer, nullable=False) # 1 for the best score of the cohort; equal scores share a rank
+    cohort_size = Column(Integer, nullable=False) # Number of users ranked in the cohort
+    top_fraction = Column(Float, nullable=False) # Share of the cohort scoring at least as well, e.g. 0.1 for the top 10%
+    __table_args__ = (
+        Index('ix_leaderboard_entries_rank', 'metric', 'period', 'period_start', 'cohort', 'rank', 'user_id'), # Top-k of a cohort, in order
+        Index('ix_leaderboard_entries_user_id', 'user_id', 'period', 'period_start', 'metric', 'cohort'), # Every ranking of one user, in order
+    )
 
 def create_database():
     '''Create the database and the tables'''
-    engine = create_engine('sqlite:///health_fitness_app.db', echo=True) # Create a new SQLite database using the create_engine() function
+    engine = get_engine() # Create the SQLite database configured in database.py (WAL mode and tuned pragmas)
+    setup_database(engine)
+
+def setup_database(engine):
+    '''Create or upgrade the schema of one database: tables, migrations, indexes and the search index'''
     Base.metadata.create_all(engine) # Create the tables in the database using the metadata.create_all() method
+    add_missing_columns(engine) # Add columns introduced after the tables were first created
+    add_cascading_foreign_keys(engine) # Recreate tables whose foreign keys predate ON DELETE CASCADE
+    backfill_sleep_durations(engine) # Fill duration_hours for sleep records written before it existed
+    create_missing_indexes(engine) # Add indexes introduced after the tables were first created
+    with engine.begin() as connection:
+        search.create_index(connection) # Full-text index of the notes and bios, kept in step by triggers
+
+def add_missing_columns(engine):
+    '''Add any nullable column declared on the models that is missing from an existing table'''
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable: # SQLite can only add columns that may be NULL
+                    connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}'))
+
+def _foreign_keys_to_rebuild(connection):
+    '''Tables whose foreign keys in the database lack the ON DELETE action declared on the model'''
+    inspector = inspect(connection)
+    tables = []
+    for table in Base.metadata.sorted_tables:
+        declared = {(key.parent.name, key.ondelete.upper()) for key in table.foreign_keys if key.ondelete}
+        existing = {(name, (key['options'].get('ondelete') or '').upper())
+                    for key in inspector.get_foreign_keys(table.name) for name in key['constrained_columns']}
+        if declared - existing:
+            tables.append(table)
+    return tables
+
+def add_cascading_foreign_keys(engine):
+    '''Recreate the tables whose foreign keys lack ON DELETE CASCADE, keeping their rows.
+
+    SQLite cannot alter a constraint, so each table is rebuilt as its model declares it, its rows are
+    copied over and the old table is dropped, all in one transaction with foreign keys switched off.
+    Indexes and search triggers go with the old tables; create_missing_indexes() and
+    search.create_index() put them back.
+    '''
+    with engine.connect() as connection:
+        tables = _foreign_keys_to_rebuild(connection)
+        existing = {table.name: {column['name'] for column in inspect(connection).get_columns(table.name)} for table in tables}
+    if not tables:
+        return
+    script = ['PRAGMA foreign_keys=OFF;', 'BEGIN;']
+    for table in tables:
+        rebuilt = f'{table.name}_rebuilt'
+        columns = ', '.join(column.name for column in table.columns if column.name in existing[table.name])
+        create = str(CreateTable(table).compile(engine)).strip().replace(f'CREATE TABLE {table.name} ', f'CREATE TABLE {rebuilt} ', 1)
+        script += [f'{create};', f'INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name};',
+                   f'DROP TABLE {table.name};', f'ALTER TABLE {rebuilt} RENAME TO {table.name};']
+    script += ['COMMIT;', 'PRAGMA foreign_keys=ON;']
+    connection = engine.raw_connection() # executescript() runs the explicit transaction without the driver's implicit BEGINs
+    try:
+        connection.driver_connection.executescript('\n'.join(script))
+    except BaseException:
+        connection.invalidate() # Never return a connection left inside the transaction or with foreign keys off to the pool
+        raise
+    finally:
+        connection.close()
+
+def backfill_sleep_durations(engine):
+    '''Compute duration_hours for sleep records that do not have one yet'''
+    with engine.begin() as connection:
+        connection.execute(text('UPDATE sleep_records SET duration_hours = (julianday(end_time) - julianday(start_time)) * 24 '
+                                'WHERE duration_hours IS NULL AND end_time IS NOT NULL'))
+
+def create_missing_indexes(engine):
+    '''Create any index declared on the models that is missing from an existing database'''
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True) # create_all() skips indexes of tables that already exist
 
 if __name__ == '__main__':
     create_database() # Call the create_database() function to create the database and the tables
@@ -0,0 +1,149 @@
+'''Engine factory shared by every module that talks to the database.
+
+Settings are read from, in order of precedence, HEALTH_APP_* environment variables (for example
+HEALTH_APP_URL or HEALTH_APP_MMAP_SIZE), the [database] section of the INI file named by
+HEALTH_APP_CONFIG (default: health_fitness_app.ini, if it exists) and DEFAULT_SETTINGS below.
+
+Every connection is tuned through a connect event: WAL journaling so readers never wait for the
+writer, synchronous=NORMAL, a larger page cache, memory-mapped I/O, in-memory temp tables, a
+busy timeout and enforced foreign keys. get_engine(read_only=True) returns a separate pool of
+query-only connections.
+session_scope() hands every call its own session from a sessionmaker bound to one of these engines.
+get_async_engine() and async_session_scope() do the same for asyncio code, over the aiosqlite driver.
+'''
+import configparser
+import os
+from contextlib import contextmanager, asynccontextmanager
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+DEFAULT_SETTINGS = {
+    'url': 'sqlite:///health_fitness_app.db', # Database to connect to
+    'echo': 'false', # Log every SQL statement
+    'journal_mode': 'WAL', # Readers see the last commit while the writer appends to the WAL file
+    'synchronous': 'NORMAL', # Durable at checkpoints; safe from corruption in WAL mode
+    'cache_size_kib': '65536', # Page cache per connection
+    'mmap_size': '268435456', # Bytes of the file read through memory-mapped I/O
+    'temp_store': 'MEMORY', # Sorts and temporary B-trees stay in memory
+    'busy_timeout_ms': '5000', # How long a connection waits for a lock before failing
+    'foreign_keys': 'ON', # Enforce foreign keys, so deleting a user cascades to their rows in the database itself
+    'pool_size': '5', # Connections kept open per engine
+    'max_overflow': '10', # Extra connections allowed under load
+    'shards': '', # Comma-separated shard database URLs; empty keeps every user in `url`
+    'shard_directory': 'sqlite:///health_fitness_directory.db', # Database mapping each user to a shard
+    'slow_query_ms': '100', # Statements at least this slow are logged with their query plan (instrumentation.py)
+    'metrics_file': '', # Instrumentation measurements are written here at exit; .json for JSON, else Prometheus text
+}
+
+CONFIG_ENV = 'HEALTH_APP_CONFIG'
+DEFAULT_CONFIG_PATH = 'health_fitness_app.ini'
+
+def load_settings(config_path=None):
+    '''Merge the defaults, the config file and the environment into one settings dict'''
+    settings = dict(DEFAULT_SETTINGS)
+    config_path = config_path or os.environ.get(CONFIG_ENV, DEFAULT_CONFIG_PATH)
+    parser = configparser.ConfigParser()
+    if parser.read(config_path) and parser.has_section('database'):
+        settings.update(parser['database'])
+    for name in DEFAULT_SETTINGS:
+        value = os.environ.get('HEALTH_APP_' + name.upper())
+        if value is not None:
+            settings[name] = value
+    return settings
+
+def _pragmas(settings, read_only):
+    '''PRAGMA statements run on every new connection'''
+    pragmas = [
+        f"PRAGMA busy_timeout={int(settings['busy_timeout_ms'])}",
+        f"PRAGMA cache_size=-{int(settings['cache_size_kib'])}",
+        f"PRAGMA mmap_size={int(settings['mmap_size'])}",
+        f"PRAGMA temp_store={settings['temp_store']}",
+        f"PRAGMA foreign_keys={settings['foreign_keys']}",
+    ]
+    if read_only:
+        pragmas.append('PRAGMA query_only=ON')
+    else: # The journal mode is stored in the file, so only the writer sets it
+        pragmas += [f"PRAGMA journal_mode={settings['journal_mode']}", f"PRAGMA synchronous={settings['synchronous']}"]
+    return pragmas
+
+def _read_only_url(url):
+    '''Open a file database through a read-only SQLite URI'''
+    return url.set(database=f'file:{url.database}', query={'mode': 'ro', 'uri': 'true'})
+
+def _is_file_database(url):
+    return url.get_backend_name() == 'sqlite' and url.database not in (None, '', ':memory:')
+
+def _engine_arguments(url, read_only, config_path, overrides):
+    '''Resolve the URL, create_engine() options and connection pragmas from the settings'''
+    settings = load_settings(config_path)
+    settings.update({name: str(value) for name, value in overrides.items()})
+    url = make_url(url or settings['url'])
+    options = {'echo': settings['echo'].lower() in ('1', 'true', 'yes')}
+    if _is_file_database(url):
+        options.update(pool_size=int(settings['pool_size']), max_overflow=int(settings['max_overflow']))
+        if read_only:
+            url = _read_only_url(url)
+    return url, options, _pragmas(settings, read_only and _is_file_database(url))
+
+def _apply_pragmas(engine, pragmas):
+    @event.listens_for(engine, 'connect')
+    def _configure_connection(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+def get_engine(url=None, read_only=False, config_path=None, **overrides):
+    '''Create an engine configured from the settings; `overrides` replace individual settings'''
+    url, options, pragmas = _engine_arguments(url, read_only, config_path, overrides)
+    engine = create_engine(url, **options)
+    _apply_pragmas(engine, pragmas)
+    return engine
+
+def get_async_engine(url=None, read_only=False, config_path=None, **overrides):
+    '''Async counterpart of get_engine(); SQLite URLs are switched to the aiosqlite driver'''
+    url, options, pragmas = _engine_arguments(url, read_only, config_path, overrides)
+    if url.get_backend_name() == 'sqlite':
+        url = url.set(drivername='sqlite+aiosqlite')
+    if 'pool_size' in options: # aiosqlite would otherwise open (and tune) a new connection for every checkout
+        options['poolclass'] = AsyncAdaptedQueuePool
+    engine = create_async_engine(url, **options)
+    _apply_pragmas(engine.sync_engine, pragmas) # Pool events are registered on the synchronous core of the engine
+    return engine
+
+@contextmanager
+def session_scope(factory, session=None):
+    '''Yield `session` if the caller passed one, otherwise a new session from `factory`.
+
+    A session created here belongs to the current call only: it is committed when the block
+    succeeds, rolled back when it raises and always closed, so concurrent callers in different
+    threads never share a session and its identity map never outlives the call.
+    '''
+    if session is not None:
+        yield session
+        return
+    session = factory()
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+@asynccontextmanager
+async def async_session_scope(factory, session=None):
+    '''Async counterpart of session_scope() for an async_sessionmaker'''
+    if session is not None:
+        yield session
+        return
+    async with factory() as session: # Closed on the way out
+        try:
+            yield session
+            await session.commit()
+        except BaseException:
+            await session.rollback()
+            raise
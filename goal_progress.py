@@ -0,0 +1,231 @@
+'''Measurable fitness goals whose progress is kept up to date as logs are written.
+
+A goal with a `metric` has a `target` to meet over the days from its start_date to its target_date
+inclusive: a total to reach (workout minutes, sessions or calories burned), a ceiling on the calories
+eaten per logged day on average, or a floor on the hours slept per night on average. Instead of
+rescanning the logs of that window on every progress query, each goal carries two counters, `progress`
+(the summed measure) and `progress_count` (the workouts, days with meals or nights counted).
+rollups.apply_rows() hands every change it makes to the daily rollups to apply_totals(), so ORM writes
+and ingest batches adjust the counters in the same transaction. One SELECT on the partial index of measurable goals finds which of
+the writing users have a goal of an affected metric whose window holds the logged days, and only those
+metrics get an UPDATE, so the writes of users without measurable goals cost a single index probe. The
+counters of a new goal, or of one whose target changes, are seeded from the rollup tables, and
+evaluate() turns them into a status in constant time.
+
+Totals are marked completed as soon as their progress reaches the target, and unmarked if a deleted log
+takes them back below it. Averages are taken over the days or nights that have logs, and only decided
+once the window has passed, so evaluate() reports them as on track or behind until then. Goals without
+a metric keep their completed flag set by hand.
+
+rollups.rebuild() rebuilds the counters of the users it rebuilds, and retention purges (purge.py before)
+rebuild those of the goals whose window starts before the cutoff, so the counters always agree with
+what the rollup tables hold.
+
+    python3 goal_progress.py rebuild   # Recompute the counters of every measurable goal from the rollup tables
+    python3 goal_progress.py check     # List goals whose counters disagree with the rollup tables
+'''
+import sys
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
+from sqlalchemy import event, inspect, select, update, func, and_, or_, bindparam, tuple_
+from database import get_engine
+from create import FitnessGoal, DailyWorkout, DailyNutrition, DailySleep
+
+TOLERANCE = 1e-6 # Relative difference below which incremental and recomputed float sums are considered equal, as in rollups.py
+
+TOTAL, DAILY_CEILING, NIGHTLY_AVERAGE = 'total', 'daily ceiling', 'nightly average'
+ACHIEVED, MISSED, ON_TRACK, BEHIND, NOT_STARTED = 'achieved', 'missed', 'on track', 'behind', 'not started'
+
+@dataclass(frozen=True)
+class Target:
+    '''How progress towards one kind of measurable goal is counted'''
+    table: object # Daily rollup table the counters are summed from
+    measure: str # Rollup column summed into progress
+    counter: str # Rollup column summed into progress_count; DAILY_CEILING targets count the days on which it is positive instead
+    kind: str # TOTAL to reach, DAILY_CEILING not to exceed per day, or NIGHTLY_AVERAGE to reach per night
+
+TARGETS = {
+    'workout_minutes': Target(DailyWorkout.__table__, 'minutes', 'sessions', TOTAL),
+    'workout_sessions': Target(DailyWorkout.__table__, 'sessions', 'sessions', TOTAL),
+    'calories_burned': Target(DailyWorkout.__table__, 'calories_burned', 'sessions', TOTAL),
+    'daily_calories': Target(DailyNutrition.__table__, 'calories', 'meals', DAILY_CEILING),
+    'sleep_hours': Target(DailySleep.__table__, 'hours', 'nights', NIGHTLY_AVERAGE),
+}
+
+GOAL_COLUMNS = ('user_id', 'metric', 'target', 'start_date', 'target_date') # Changing any of them reseeds the counters
+
+@dataclass(frozen=True)
+class GoalProgress:
+    '''Where a measurable goal stands on a given day'''
+    metric: str
+    value: float # Total so far, or the average per logged day or night for DAILY_CEILING and NIGHTLY_AVERAGE targets
+    target: float
+    status: str # ACHIEVED, MISSED, ON_TRACK, BEHIND or NOT_STARTED
+
+    @property
+    def percent(self):
+        '''Value as a percentage of the target'''
+        return 100 * self.value / self.target if self.target else 0
+
+def evaluate(goal, day=None):
+    '''GoalProgress of a measurable goal on `day` (default: today), from its counters alone; None for goals without a metric'''
+    if goal.metric is None:
+        return None
+    target = TARGETS[goal.metric]
+    day = day or date.today()
+    progress, count = goal.progress or 0, goal.progress_count or 0
+    window_days = (goal.target_date - goal.start_date).days + 1
+    elapsed_days = min((day - goal.start_date).days + 1, window_days)
+    closed = day > goal.target_date
+    if target.kind == TOTAL:
+        value, met = progress, progress >= goal.target
+        if met or closed:
+            return GoalProgress(goal.metric, value, goal.target, ACHIEVED if met else MISSED)
+        on_pace = progress * window_days >= goal.target * max(elapsed_days, 0) # At least the share of the target the elapsed days call for
+    elif target.kind == DAILY_CEILING:
+        value = progress / count if count else 0 # Days without meals logged are unknown rather than fasted
+        on_pace = value <= goal.target
+        met = count > 0 and on_pace
+    else:
+        value = progress / count if count else 0
+        met = on_pace = count > 0 and value >= goal.target
+    if closed:
+        return GoalProgress(goal.metric, value, goal.target, ACHIEVED if met else MISSED)
+    if elapsed_days <= 0:
+        return GoalProgress(goal.metric, value, goal.target, NOT_STARTED)
+    return GoalProgress(goal.metric, value, goal.target, ON_TRACK if on_pace else BEHIND)
+
+def _window_sums(target, user_id, start, end):
+    '''Scalar subqueries summing the measure and the counter of `target` over a user's rollup rows from start to end inclusive'''
+    table = target.table
+    window = and_(table.c.user_id == user_id, table.c.day >= start, table.c.day <= end)
+    if target.kind == DAILY_CEILING:
+        count = select(func.count()).where(window, table.c[target.counter] > 0) # One rollup row per day
+    else:
+        count = select(func.coalesce(func.sum(table.c[target.counter]), 0)).where(window)
+    return select(func.coalesce(func.sum(table.c[target.measure]), 0)).where(window).scalar_subquery(), count.scalar_subquery()
+
+def _seed(connection, goal):
+    '''Set the counters of a measurable goal from the rollup rows already logged in its window'''
+    if goal.metric not in TARGETS:
+        raise ValueError(f"Unknown goal metric {goal.metric!r}; expected one of {tuple(TARGETS)}")
+    if goal.target is None or goal.target_date is None:
+        raise ValueError(f"A {goal.metric} goal needs a target and a target_date")
+    if goal.start_date is None:
+        goal.start_date = date.today()
+    target = TARGETS[goal.metric]
+    goal.progress, goal.progress_count = connection.execute(select(*_window_sums(target, goal.user_id, goal.start_date, goal.target_date))).one()
+    if target.kind == TOTAL:
+        goal.completed = goal.progress >= goal.target
+
+def _before_insert(mapper, connection, target):
+    if target.metric is not None:
+        _seed(connection, target)
+
+def _before_update(mapper, connection, target):
+    attributes = inspect(target).attrs
+    if target.metric is not None and any(attributes[name].history.has_changes() for name in GOAL_COLUMNS):
+        _seed(connection, target)
+
+event.listen(FitnessGoal, 'before_insert', _before_insert)
+event.listen(FitnessGoal, 'before_update', _before_update)
+
+@lru_cache(maxsize=None)
+def _tracked_statement():
+    '''SELECT of the (user_id, metric) pairs with a goal whose window overlaps [first, last]; built once, as every logged write runs it'''
+    goals = FitnessGoal.__table__
+    return select(goals.c.user_id, goals.c.metric).distinct().\
+        where(goals.c.user_id.in_(bindparam('user_ids', expanding=True)), goals.c.metric.in_(bindparam('metrics', expanding=True)),
+              goals.c.target_date >= bindparam('first'), goals.c.start_date <= bindparam('last'))
+
+@lru_cache(maxsize=None)
+def _update_statement(name):
+    '''UPDATE adding `amount` and `count` to the counters of a user's `name` goals whose window holds the day; built once per metric'''
+    goals = FitnessGoal.__table__
+    window = and_(goals.c.user_id == bindparam('g_user_id'), goals.c.start_date <= bindparam('g_day'), goals.c.target_date >= bindparam('g_day'))
+    progress = goals.c.progress + bindparam('amount')
+    values = [(goals.c.progress, progress), (goals.c.progress_count, goals.c.progress_count + bindparam('count'))]
+    if TARGETS[name].kind == TOTAL:
+        values.append((goals.c.completed, progress >= goals.c.target))
+    return update(goals).where(goals.c.metric == name, window).ordered_values(*values)
+
+def apply_totals(connection, table, totals):
+    '''Add the changes rollups.apply_rows() made to `table`, {(user_id, day, ...): measure deltas}, to the goals counting that day'''
+    targets = [(name, target) for name, target in TARGETS.items() if target.table is table]
+    if not targets:
+        return
+    days = {}
+    for key, measures in totals.items():
+        total = days.setdefault(key[:2], dict.fromkeys(measures, 0)) # Rollup keys after (user_id, day) do not matter to goals
+        for name, value in measures.items():
+            total[name] += value
+    logged = [day for _, day in days]
+    tracked = set(connection.execute(_tracked_statement(), {'user_ids': list({user_id for user_id, _ in days}), 'metrics': [name for name, _ in targets],
+                                                            'first': min(logged), 'last': max(logged)}))
+    for name, target in targets:
+        changed = {key: measures for key, measures in days.items() if (key[0], name) in tracked and (measures[target.measure] or measures[target.counter])}
+        if not changed:
+            continue
+        counts = _day_counts(connection, target, changed) if target.kind == DAILY_CEILING else {key: measures[target.counter] for key, measures in changed.items()}
+        connection.execute(_update_statement(name), [{'g_user_id': user_id, 'g_day': day, 'amount': measures[target.measure], 'count': counts[(user_id, day)]}
+                                                     for (user_id, day), measures in changed.items()])
+
+def _day_counts(connection, target, changed):
+    '''+1 for each (user_id, day) of `changed` that got its first log, -1 for each that lost its last one, else 0'''
+    table = target.table # apply_rows() calls apply_totals() before deleting emptied rollup rows, so every changed day still has its row
+    after = dict(((user_id, day), count) for user_id, day, count in connection.execute(
+        select(table.c.user_id, table.c.day, table.c[target.counter]).where(tuple_(table.c.user_id, table.c.day).in_(list(changed)))))
+    return {key: (after[key] > 0) - (after[key] - measures[target.counter] > 0) for key, measures in changed.items()}
+
+def _measurable(user_ids, before=None):
+    goals = FitnessGoal.__table__
+    conditions = [goals.c.metric.isnot(None)]
+    if user_ids is not None:
+        conditions.append(goals.c.user_id.in_(user_ids))
+    if before is not None:
+        conditions.append(goals.c.start_date < before)
+    return and_(*conditions)
+
+def rebuild(connection, user_ids=None, before=None):
+    '''Recompute the counters of the measurable goals of `user_ids` (default: every user), optionally only of goals starting before `before`'''
+    goals = FitnessGoal.__table__
+    for name, target in TARGETS.items():
+        progress, count = _window_sums(target, goals.c.user_id, goals.c.start_date, goals.c.target_date)
+        values = {'progress': progress, 'progress_count': count}
+        if target.kind == TOTAL:
+            values['completed'] = progress >= goals.c.target
+        connection.execute(update(goals).where(_measurable(user_ids, before), goals.c.metric == name).values(**values))
+
+def check(connection, user_ids=None):
+    '''Return (goal id, (progress, progress_count), expected) for every measurable goal whose counters disagree with the rollup tables'''
+    goals = FitnessGoal.__table__
+    mismatches = []
+    for name, target in TARGETS.items():
+        progress, count = _window_sums(target, goals.c.user_id, goals.c.start_date, goals.c.target_date)
+        expected = select(goals.c.id, goals.c.progress, goals.c.progress_count, progress.label('expected_progress'), count.label('expected_count')).\
+            where(_measurable(user_ids), goals.c.metric == name).subquery()
+        differs = or_(func.abs(expected.c.expected_progress - func.coalesce(expected.c.progress, 0)) > TOLERANCE * func.max(1, func.abs(expected.c.expected_progress)),
+                      expected.c.expected_count != func.coalesce(expected.c.progress_count, 0))
+        for row in connection.execute(select(expected).where(differs)):
+            mismatches.append((row.id, (row.progress, row.progress_count), (row.expected_progress, row.expected_count)))
+    return mismatches
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    engine = get_engine() # Create an engine that connects to the configured database
+    with engine.begin() as connection:
+        if command == 'rebuild':
+            rebuild(connection)
+            print("Goal progress rebuilt from the rollup tables.")
+        elif command == 'check':
+            mismatches = check(connection)
+            for goal_id, stored, expected in mismatches:
+                print(f"goal {goal_id}: counters {stored}, expected {expected}")
+            print(f"{len(mismatches)} inconsistent goal(s) found")
+            sys.exit(1 if mismatches else 0)
+        else:
+            sys.exit(f"Unknown command {command!r}; expected 'rebuild' or 'check'")
+
+if __name__ == '__main__':
+    main()
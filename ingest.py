@@ -0,0 +1,174 @@
+'''Write-batching ingest queue for bursts of workout, meal, sleep and mood events from wearables.
+
+Producers call IngestQueue.submit() (or the log_workout_and_update_goals() shortcut) and return at
+once; a background thread coalesces the queued events into micro-batches, closed when they reach
+`batch_size` events or when the oldest event has waited `max_latency` seconds. Each batch is written
+in one transaction: one executemany INSERT per log table, the matching rollup adjustments and one
+set-based UPDATE for every goal status change in the batch.
+
+The queue holds at most `max_pending` events, so submit() blocks (and with a timeout raises queue.Full)
+when producers outrun the database. A batch that fails is split in halves and retried until the
+offending events are isolated; they are kept in `dead_letters` with their error instead of taking
+the rest of the batch down with them.
+
+    with IngestQueue() as ingest:
+        ingest.submit(Workout, {'user_id': 1, 'date': date.today(), 'duration': 30})
+    print(ingest.stats())
+'''
+import queue
+import threading
+import time
+from sqlalchemy import insert, update, case, tuple_, and_
+from create import FitnessGoal, Workout, NutritionLog, SleepRecord, MoodLog, sleep_duration_hours
+from database import get_engine
+from cache import invalidate_all_caches
+import rollups
+
+LOG_MODELS = (Workout, NutritionLog, SleepRecord, MoodLog) # Tables events can be submitted for
+_STOP = object() # Queued by close() after the last event
+
+class IngestQueue:
+    '''Bounded queue of log events written by one background thread in micro-batches'''
+
+    def __init__(self, engine=None, batch_size=1000, max_latency=0.05, max_pending=10000):
+        self.engine = engine or get_engine()
+        self.batch_size = batch_size # Events per batch at most
+        self.max_latency = max_latency # Seconds the first event of a batch waits for more to join it
+        self._queue = queue.Queue(maxsize=max_pending) # Bounded, which is what pushes back on producers
+        self.dead_letters = [] # (event, error) for every event that could not be written
+        self._lock = threading.Lock()
+        self._metrics = {'submitted': 0, 'written': 0, 'failed': 0, 'batches': 0, 'retries': 0, 'write_seconds': 0.0}
+        self._started = time.perf_counter()
+        self._worker = threading.Thread(target=self._run, name='ingest-writer', daemon=True)
+        self._worker.start()
+
+    def submit(self, model, values, timeout=None):
+        '''Queue one log row, given as a dict of column values; blocks while the queue is full'''
+        if model not in LOG_MODELS:
+            raise ValueError(f"Cannot ingest {model.__name__} events")
+        self._put((model, dict(values)), timeout)
+
+    def update_goal(self, user_id, goal_id, completed, timeout=None):
+        '''Queue a status change of one of the user's fitness goals'''
+        self._put((FitnessGoal, {'id': goal_id, 'user_id': user_id, 'completed': completed}), timeout)
+
+    def log_workout_and_update_goals(self, user_id, workout_data, goal_updates=None, timeout=None):
+        '''Queued counterpart of insert_data.log_workout_and_update_goals()'''
+        self.submit(Workout, dict(workout_data, user_id=user_id), timeout)
+        for goal_id, completed in (goal_updates or {}).items():
+            self.update_goal(user_id, goal_id, completed, timeout)
+
+    def _put(self, event, timeout):
+        self._queue.put(event, timeout=timeout)
+        with self._lock:
+            self._metrics['submitted'] += 1
+
+    def flush(self):
+        '''Wait until every event submitted so far has been written or dead-lettered'''
+        self._queue.join()
+
+    def close(self):
+        '''Write the remaining events and stop the background thread'''
+        self._queue.put(_STOP)
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def stats(self):
+        '''Throughput and error counters since the queue was created'''
+        with self._lock:
+            metrics = dict(self._metrics)
+        elapsed = time.perf_counter() - self._started
+        metrics['pending'] = self._queue.qsize()
+        metrics['events_per_second'] = metrics['written'] / elapsed if elapsed else 0.0
+        metrics['mean_batch_size'] = metrics['written'] / metrics['batches'] if metrics['batches'] else 0.0
+        return metrics
+
+    def _next_batch(self):
+        '''Block for the first event, then gather more until the batch is full or its deadline passes.
+
+        Returns the batch and whether close() was called; the stop marker is acknowledged here.
+        '''
+        batch, deadline = [], None
+        while len(batch) < self.batch_size:
+            try:
+                if deadline is None:
+                    event = self._queue.get()
+                else:
+                    remaining = deadline - time.monotonic()
+                    event = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if event is _STOP:
+                self._queue.task_done()
+                return batch, True
+            batch.append(event)
+            deadline = deadline or time.monotonic() + self.max_latency
+        return batch, False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, stopping = self._next_batch()
+            if not batch:
+                continue
+            started = time.perf_counter()
+            self._write_isolating_errors(batch)
+            with self._lock:
+                self._metrics['batches'] += 1
+                self._metrics['write_seconds'] += time.perf_counter() - started
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_isolating_errors(self, events):
+        '''Write the events in one transaction, bisecting on failure down to the events at fault'''
+        try:
+            write_batch(self.engine, events)
+        except Exception as error:
+            if len(events) == 1:
+                with self._lock:
+                    self.dead_letters.append((events[0], error))
+                    self._metrics['failed'] += 1
+                return
+            with self._lock:
+                self._metrics['retries'] += 1
+            middle = len(events) // 2
+            self._write_isolating_errors(events[:middle])
+            self._write_isolating_errors(events[middle:])
+            return
+        with self._lock:
+            self._metrics['written'] += len(events)
+
+def write_batch(engine, events):
+    '''Write (model, values) events in one transaction and invalidate the summaries they touch'''
+    rows, goals = {}, {}
+    for model, values in events:
+        if model is FitnessGoal:
+            goals[(values['id'], values['user_id'])] = values['completed'] # The last change to a goal wins
+        else:
+            if model is SleepRecord: # Core inserts bypass the ORM event that fills the stored duration
+                values = dict(values, duration_hours=sleep_duration_hours(values.get('start_time'), values.get('end_time')))
+            rows.setdefault(model, []).append(values)
+
+    touched = set()
+    with engine.begin() as connection:
+        for model, model_rows in rows.items():
+            columns = set(rollups.ROLLUPS[model].columns).union(*model_rows) # executemany needs the same keys in every row
+            model_rows = [dict.fromkeys(columns) | values for values in model_rows]
+            connection.execute(insert(model), model_rows)
+            rollups.apply_rows(connection, model, model_rows) # Core inserts bypass the ORM events that maintain the rollups
+            touched.update((values['user_id'], model.__tablename__) for values in model_rows)
+        if goals:
+            changes = [(and_(FitnessGoal.id == goal_id, FitnessGoal.user_id == user_id), completed) # Keyed by owner, so another user's change cannot win
+                       for (goal_id, user_id), completed in goals.items()]
+            connection.execute(update(FitnessGoal).
+                               where(tuple_(FitnessGoal.id, FitnessGoal.user_id).in_(list(goals))).
+                               values(completed=case(*changes, else_=FitnessGoal.completed)))
+            touched.update((user_id, FitnessGoal.__tablename__) for _, user_id in goals)
+
+    for user_id, table in touched: # Core writes bypass the session events that invalidate the caches
+        invalidate_all_caches(user_id, (table,))
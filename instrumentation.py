@@ -0,0 +1,382 @@
+'''Per-call timing, SQL statement counts and a slow-query log for the reporting and logging functions.
+
+Functions decorated with @instrumented record, per call, their wall time, the number of SQL
+statements they issued, the time those statements took, the rows they read and the rows they wrote.
+Calls are aggregated per function into histograms (count, sum, buckets and estimated quantiles).
+Statements are attributed to the innermost running call and every call enclosing it, through a
+context variable, so concurrent threads and nested calls are accounted for separately.
+
+Statements are observed through SQLAlchemy engine events on every engine of the process. Rows read
+are counted by the cursors of the SQLite connections, as rows returned by SELECT are not known when
+a statement finishes executing. Importing this module therefore has a process-wide side effect: its
+do_connect listener, registered on the Engine class, opens every new connection of every pysqlite
+engine (including ones not made by database.get_engine()) with CountingConnection as its factory,
+unless the engine passes its own `factory` in connect_args.
+
+Statements slower than the `slow_query_ms` setting are logged to the `health_app.slow_queries`
+logger together with their EXPLAIN QUERY PLAN. cProfile runs of chosen functions are opt-in through
+enable_profiling(). snapshot() returns everything as a dict; to_json(), to_prometheus(), write()
+and serve() export it, and the `metrics_file` setting writes it when the process exits:
+
+    HEALTH_APP_METRICS_FILE=metrics.prom python3 query_data.py
+'''
+import atexit
+import bisect
+import cProfile
+import functools
+import inspect
+import json
+import logging
+import pstats
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from database import load_settings
+
+SECONDS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Upper bounds of the time histograms
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 10000, 100000) # Upper bounds of the statement and row histograms
+SLOW_QUERIES_KEPT = 100 # Most recent slow queries kept for snapshot()
+
+logger = logging.getLogger('health_app.slow_queries')
+_current = ContextVar('instrumented_call', default=None) # Innermost instrumented call running in this context
+
+class Histogram:
+    '''Cumulative-bucket histogram of observed values, in the style of Prometheus'''
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # The last one counts values above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        '''Estimate the q-quantile by interpolating inside the bucket that holds it'''
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[index - 1] if index else min(self.min, self.buckets[0])
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        cumulative, total = {}, 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            cumulative[str(bound)] = total
+        cumulative['+Inf'] = self.count
+        return {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99), 'buckets': cumulative}
+
+class Call:
+    '''Measurements of one running call of an instrumented function'''
+    __slots__ = ('parent', 'statements', 'sql_seconds', 'rows_read', 'rows_written')
+
+    def __init__(self, parent):
+        self.parent = parent
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.rows_read = 0
+        self.rows_written = 0
+
+class FunctionStats:
+    '''Aggregated measurements of every call of one function'''
+
+    def __init__(self):
+        self.errors = 0
+        self.seconds = Histogram(SECONDS_BUCKETS)
+        self.sql_seconds = Histogram(SECONDS_BUCKETS)
+        self.statements = Histogram(COUNT_BUCKETS)
+        self.rows_read = Histogram(COUNT_BUCKETS)
+        self.rows_written = Histogram(COUNT_BUCKETS)
+
+    def record(self, call, seconds, failed):
+        self.errors += failed
+        self.seconds.observe(seconds)
+        self.sql_seconds.observe(call.sql_seconds)
+        self.statements.observe(call.statements)
+        self.rows_read.observe(call.rows_read)
+        self.rows_written.observe(call.rows_written)
+
+    def summary(self):
+        return {'calls': self.seconds.count, 'errors': self.errors, 'seconds': self.seconds.summary(),
+                'sql_seconds': self.sql_seconds.summary(), 'statements': self.statements.summary(),
+                'rows_read': self.rows_read.summary(), 'rows_written': self.rows_written.summary()}
+
+_lock = threading.Lock()
+_functions = {} # Qualified function name -> FunctionStats
+_slow_queries = deque(maxlen=SLOW_QUERIES_KEPT)
+_slow_query_count = 0
+_slow_query_seconds = int(load_settings()['slow_query_ms']) / 1000
+_profiled = set() # Names of the functions run under cProfile, or {'*'} for every function
+_profiles = {} # Qualified function name -> pstats.Stats accumulated over its profiled calls
+
+def _record(name, call, seconds, failed, profile=None):
+    with _lock:
+        stats = _functions.get(name)
+        if stats is None:
+            stats = _functions[name] = FunctionStats()
+        stats.record(call, seconds, failed)
+        if profile is not None:
+            if name in _profiles:
+                _profiles[name].add(profile)
+            else:
+                _profiles[name] = pstats.Stats(profile)
+
+def _profiler(name):
+    '''A started cProfile.Profile when `name` is profiled and no other profiled call is running, else None'''
+    if not _profiled or (name not in _profiled and '*' not in _profiled) or _current.get() is not None:
+        return None # cProfile cannot nest, so only outermost calls are profiled
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+def instrumented(function):
+    '''Record the wall time, SQL statements and rows read and written of every call of `function`'''
+    name = f'{function.__module__}.{function.__qualname__}'
+
+    if inspect.isgeneratorfunction(function):
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            call = Call(_current.get())
+            seconds, failed = 0.0, False
+            generator = function(*args, **kwargs)
+            try:
+                while True: # Only the time spent producing items counts, not the time the caller spends on them
+                    token = _current.set(call)
+                    started = time.perf_counter()
+                    try:
+                        item = next(generator)
+                    except StopIteration:
+                        return
+                    except BaseException:
+                        failed = True
+                        raise
+                    finally:
+                        seconds += time.perf_counter() - started
+                        _current.reset(token)
+                    yield item
+            finally:
+                token = _current.set(call)
+                try:
+                    generator.close() # Runs the generator's cleanup when the caller stops early
+                finally:
+                    _current.reset(token)
+                    _record(name, call, seconds, failed)
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        profile = _profiler(name)
+        call = Call(_current.get())
+        token = _current.set(call)
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = function(*args, **kwargs)
+            failed = False
+            return result
+        finally:
+            seconds = time.perf_counter() - started
+            _current.reset(token)
+            if profile is not None:
+                profile.disable()
+            _record(name, call, seconds, failed, profile)
+    return wrapper
+
+def _count_rows(rows, written):
+    call = _current.get()
+    while call is not None:
+        if written:
+            call.rows_written += rows
+        else:
+            call.rows_read += rows
+        call = call.parent
+
+class CountingCursor(sqlite3.Cursor):
+    '''Cursor that adds the rows it returns to the running instrumented calls'''
+    returns_written_rows = False # Set for INSERT/UPDATE/DELETE ... RETURNING, whose rowcount is unknown until fetched
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _count_rows(1, self.returns_written_rows)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _count_rows(len(rows), self.returns_written_rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _count_rows(len(rows), self.returns_written_rows)
+        return rows
+
+class CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+@event.listens_for(Engine, 'do_connect') # Global on purpose: see the module docstring
+def _use_counting_cursors(dialect, connection_record, cargs, cparams):
+    if dialect.driver == 'pysqlite':
+        cparams.setdefault('factory', CountingConnection)
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    if context is not None: # Kept on the statement's own context, so a statement that raises leaves nothing behind
+        context._instrumentation_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_instrumentation_started', None)
+    seconds = time.perf_counter() - started if started is not None else 0.0
+    modifies = context is not None and (context.isinsert or context.isupdate or context.isdelete)
+    returning = modifies and cursor.description is not None
+    if isinstance(cursor, CountingCursor):
+        cursor.returns_written_rows = returning
+    written = cursor.rowcount if modifies and not returning and cursor.rowcount > 0 else 0
+    call = _current.get()
+    while call is not None:
+        call.statements += 1
+        call.sql_seconds += seconds
+        call.rows_written += written
+        call = call.parent
+    if seconds >= _slow_query_seconds:
+        _log_slow_query(connection, statement, parameters[0] if executemany and parameters else parameters, seconds)
+
+def _log_slow_query(connection, statement, parameters, seconds):
+    '''Log a slow statement with its query plan, read on a cursor of the pooled connection so no events fire again'''
+    plan = []
+    if connection.dialect.name == 'sqlite':
+        dbapi_connection = connection.connection.dbapi_connection
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            cursor = sqlite3.Cursor(dbapi_connection) # A plain cursor, so the plan rows are not counted as rows read
+        else:
+            cursor = connection.connection.cursor() # A DBAPI cursor, which the aiosqlite adapter also runs synchronously
+        try:
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters or ())
+            plan = [row[3] for row in cursor.fetchall()]
+        except connection.dialect.dbapi.Error: # Statements such as PRAGMA or DDL have no plan
+            plan = []
+        finally:
+            cursor.close()
+    global _slow_query_count
+    entry = {'seconds': seconds, 'statement': statement, 'plan': plan, 'at': time.time()}
+    with _lock:
+        _slow_query_count += 1
+        _slow_queries.append(entry)
+    logger.warning("Slow query (%.1f ms): %s\n%s", seconds * 1000, statement, '\n'.join(plan))
+
+def set_slow_query_threshold(milliseconds):
+    '''Log statements that take at least `milliseconds`, overriding the `slow_query_ms` setting'''
+    global _slow_query_seconds
+    _slow_query_seconds = milliseconds / 1000
+
+def enable_profiling(*names):
+    '''Run the given functions (qualified names, e.g. 'query_data.get_user_workouts'; none for all) under cProfile'''
+    _profiled.update(names or ('*',))
+
+def disable_profiling():
+    _profiled.clear()
+
+def profile_stats(name):
+    '''pstats.Stats accumulated over the profiled calls of a function, or None'''
+    with _lock:
+        return _profiles.get(name)
+
+def reset():
+    '''Forget every measurement, slow query and profile'''
+    global _slow_query_count
+    with _lock:
+        _functions.clear()
+        _slow_queries.clear()
+        _profiles.clear()
+        _slow_query_count = 0
+
+def snapshot():
+    '''Every measurement as a JSON-serializable dict'''
+    with _lock:
+        return {'functions': {name: stats.summary() for name, stats in sorted(_functions.items())},
+                'slow_queries': {'count': _slow_query_count, 'threshold_seconds': _slow_query_seconds, 'recent': list(_slow_queries)}}
+
+def to_json():
+    return json.dumps(snapshot(), indent=2)
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def to_prometheus():
+    '''Every measurement in the Prometheus text exposition format'''
+    data = snapshot()
+    lines = []
+    for metric, key, help_text in (
+        ('health_app_function_seconds', 'seconds', 'Wall time of instrumented function calls'),
+        ('health_app_function_sql_seconds', 'sql_seconds', 'Time spent executing SQL statements per call'),
+        ('health_app_function_statements', 'statements', 'SQL statements issued per call'),
+        ('health_app_function_rows_read', 'rows_read', 'Rows returned to the caller per call'),
+        ('health_app_function_rows_written', 'rows_written', 'Rows inserted, updated or deleted per call'),
+    ):
+        lines += [f'# HELP {metric} {help_text}', f'# TYPE {metric} histogram']
+        for name, stats in data['functions'].items():
+            histogram = stats[key]
+            for bound, count in histogram['buckets'].items():
+                lines.append(f'{metric}_bucket{{function="{_label(name)}",le="{bound}"}} {count}')
+            lines.append(f'{metric}_sum{{function="{_label(name)}"}} {histogram["sum"]}')
+            lines.append(f'{metric}_count{{function="{_label(name)}"}} {histogram["count"]}')
+    lines += ['# HELP health_app_function_errors_total Calls that raised', '# TYPE health_app_function_errors_total counter']
+    lines += [f'health_app_function_errors_total{{function="{_label(name)}"}} {stats["errors"]}' for name, stats in data['functions'].items()]
+    lines += ['# HELP health_app_slow_queries_total Statements slower than the slow-query threshold', '# TYPE health_app_slow_queries_total counter',
+              f"health_app_slow_queries_total {data['slow_queries']['count']}"]
+    return '\n'.join(lines) + '\n'
+
+def write(path):
+    '''Write the measurements to `path`, as JSON for a .json file and in the Prometheus format otherwise'''
+    with open(path, 'w') as output:
+        output.write(to_json() if str(path).endswith('.json') else to_prometheus())
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body, content_type = to_prometheus(), 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body, content_type = to_json(), 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, format, *args): # Scrapes would otherwise be logged to stderr
+        pass
+
+def serve(port=9464, host='127.0.0.1'):
+    '''Serve /metrics (Prometheus) and /metrics.json from a daemon thread; return the server, whose shutdown() stops it'''
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    return server
+
+_metrics_file = load_settings()['metrics_file']
+if _metrics_file:
+    atexit.register(write, _metrics_file)
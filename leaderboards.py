@@ -0,0 +1,225 @@
+'''Cohort leaderboards: where a user ranks among users of the same age band and gender.
+
+Rankings are computed per metric and period (a Monday-to-Sunday week or a calendar month) by one
+statement over the daily rollup tables: every user's score for the period, ranked within each
+cohort with the RANK(), COUNT() and CUME_DIST() window functions. The result replaces the
+snapshot of that period in leaderboard_entries in one transaction, so readers always see a
+complete ranking. A user's ranks are then a point lookup on the (user_id, period, period_start)
+index, and the top of a cohort a range scan of the (metric, period, period_start, cohort, rank)
+index, however many users there are.
+
+Cohorts are 'all', age bands of AGE_BAND_YEARS ('age:30-39'), genders ('gender:Female') and both
+('age:30-39/gender:Female'). With sharding configured, ShardRouter.refresh_leaderboards() collects
+the cohort scores of every shard, ranks them together with rank() and stores each user's rankings on
+the user's shard, so ranks and percentiles are global; ShardRouter.leaderboard_top() merges the top
+of each shard by rank. Refresh the current periods periodically, e.g. from cron:
+
+    python3 leaderboards.py refresh                            # Current week and month of every metric
+    python3 leaderboards.py top workout_minutes week age:30-39  # Top 10 of a cohort this week
+'''
+import sys
+from itertools import groupby
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta
+from sqlalchemy import select, delete, insert, func, literal, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from create import User, DailyWorkout, DailySleep, LeaderboardEntry, LeaderboardSnapshot
+from database import get_engine
+import rollups # Registers the events that keep the daily rollup tables in step with the log tables
+
+AGE_BAND_YEARS = 10 # Width of the age cohorts
+ALL_USERS = 'all' # Cohort of every ranked user
+TOP_K = 10 # Default length of a top list
+
+@dataclass(frozen=True)
+class Metric:
+    '''How users are scored for one leaderboard; higher scores rank first'''
+    table: type # Daily rollup model the score is computed from
+    score: object # Aggregate over the user's rollup rows of the period
+    default: float = None # Score of users without rollup rows in the period; None leaves them unranked
+
+METRICS = {
+    'workout_minutes': Metric(DailyWorkout, func.sum(DailyWorkout.minutes), 0),
+    'workout_sessions': Metric(DailyWorkout, func.sum(DailyWorkout.sessions), 0),
+    'calories_burned': Metric(DailyWorkout, func.sum(DailyWorkout.calories_burned), 0),
+    'sleep_hours': Metric(DailySleep, func.sum(DailySleep.hours) / func.sum(DailySleep.nights)), # Average night, among users who logged one
+}
+
+PERIODS = ('week', 'month')
+
+@dataclass(frozen=True)
+class Ranking:
+    '''A user's place in one cohort of one leaderboard'''
+    metric: str
+    cohort: str
+    user_id: int
+    value: float
+    rank: int # 1 for the best score; equal scores share a rank
+    cohort_size: int
+    top_fraction: float # Share of the cohort scoring at least as well
+
+    @property
+    def top_percent(self):
+        '''The "top N%" the user is in'''
+        return 100 * self.top_fraction
+
+def period_window(period, day):
+    '''Half-open [start, end) range of the week or month containing `day`'''
+    if period == 'week':
+        start = day - timedelta(days=day.weekday())
+        return start, start + timedelta(days=7)
+    if period == 'month':
+        start = day.replace(day=1)
+        return start, (start + timedelta(days=32)).replace(day=1)
+    raise ValueError(f"Unknown period {period!r}; expected one of {PERIODS}")
+
+def age_band(age):
+    '''First age of the band `age` falls in'''
+    return age // AGE_BAND_YEARS * AGE_BAND_YEARS
+
+def cohorts_of(age, gender):
+    '''Labels of the cohorts a user with this age and gender is ranked in'''
+    labels = [ALL_USERS]
+    if age is not None:
+        labels.append(f'age:{age_band(age)}-{age_band(age) + AGE_BAND_YEARS - 1}')
+    if gender is not None:
+        labels.append(f'gender:{gender}')
+    if age is not None and gender is not None:
+        labels.append(f'{labels[1]}/{labels[2]}')
+    return labels
+
+def _cohorts(members):
+    '''(cohort label, user_id, value) of every member in each of their cohorts'''
+    band = members.c.age // AGE_BAND_YEARS * AGE_BAND_YEARS
+    has_age, has_gender = members.c.age.isnot(None), members.c.gender.isnot(None)
+    levels = [
+        (literal(ALL_USERS), ()),
+        (func.printf('age:%d-%d', band, band + AGE_BAND_YEARS - 1), (has_age,)),
+        (func.printf('gender:%s', members.c.gender), (has_gender,)),
+        (func.printf('age:%d-%d/gender:%s', band, band + AGE_BAND_YEARS - 1, members.c.gender), (has_age, has_gender)),
+    ]
+    return union_all(*[select(label.label('cohort'), members.c.user_id, members.c.value).where(*conditions)
+                       for label, conditions in levels])
+
+def members_statement(metric_name, start, end):
+    '''SELECT of (cohort, user_id, value) for every scored user and each of their cohorts over [start, end)'''
+    metric = METRICS[metric_name]
+    table = metric.table
+    scores = select(table.user_id, metric.score.label('value')).\
+        where(table.day >= start, table.day < end).group_by(table.user_id).subquery('scores')
+    if metric.default is None:
+        members = select(User.id.label('user_id'), User.age, User.gender, scores.c.value).join(scores, scores.c.user_id == User.id)
+    else:
+        members = select(User.id.label('user_id'), User.age, User.gender, func.coalesce(scores.c.value, metric.default).label('value')).\
+            outerjoin(scores, scores.c.user_id == User.id)
+    return _cohorts(members.subquery('members'))
+
+def ranking_statement(metric_name, start, end):
+    '''SELECT of (cohort, user_id, value, rank, cohort_size, top_fraction) for every user and cohort over [start, end)'''
+    cohorts = members_statement(metric_name, start, end).subquery('cohorts')
+    ordered = {'partition_by': cohorts.c.cohort, 'order_by': cohorts.c.value.desc()}
+    return select(cohorts.c.cohort, cohorts.c.user_id, cohorts.c.value, func.rank().over(**ordered).label('rank'),
+                  func.count().over(partition_by=cohorts.c.cohort).label('cohort_size'), func.cume_dist().over(**ordered).label('top_fraction'))
+
+def rank(members):
+    '''(cohort, user_id, value, rank, cohort_size, top_fraction) of (cohort, user_id, value) rows, ranked as ranking_statement() does'''
+    rankings = []
+    for cohort, rows in groupby(sorted(members, key=lambda row: (row[0], -row[2])), key=lambda row: row[0]):
+        rows = list(rows)
+        ahead = 0 # Users of the cohort scoring better than the current group of equal scores
+        for value, peers in groupby(rows, key=lambda row: row[2]):
+            peers = list(peers)
+            rankings.extend((cohort, user_id, value, ahead + 1, len(rows), (ahead + len(peers)) / len(rows)) for _, user_id, _ in peers)
+            ahead += len(peers)
+    return rankings
+
+def _replace(connection, key, fill, users=None):
+    '''Delete the entries of the snapshot `key`, call fill(connection) to insert the new ones and record the snapshot'''
+    entries = LeaderboardEntry.__table__
+    connection.execute(delete(entries).where(*[entries.c[name] == value for name, value in key.items()]))
+    fill(connection)
+    if users is None:
+        users = connection.execute(select(func.count()).select_from(entries).
+                                   where(*[entries.c[name] == value for name, value in key.items()], entries.c.cohort == ALL_USERS)).scalar()
+    snapshot = sqlite_insert(LeaderboardSnapshot.__table__).values(**key, refreshed_at=datetime.now(), users=users)
+    connection.execute(snapshot.on_conflict_do_update(index_elements=list(key), set_={'refreshed_at': snapshot.excluded.refreshed_at, 'users': users}))
+    return users
+
+def refresh(connection, metric_name, period, day=None):
+    '''Replace the snapshot of the `period` containing `day` (default: today) for one metric; return the number of users ranked'''
+    start, end = period_window(period, day or date.today())
+    ranked = ranking_statement(metric_name, start, end).subquery('ranked')
+    columns = ['metric', 'period', 'period_start', 'cohort', 'user_id', 'value', 'rank', 'cohort_size', 'top_fraction']
+    fill = lambda connection: connection.execute(insert(LeaderboardEntry.__table__).
+                                                 from_select(columns, select(literal(metric_name), literal(period), literal(start), *ranked.c)))
+    return _replace(connection, {'metric': metric_name, 'period': period, 'period_start': start}, fill)
+
+def store(connection, metric_name, period, day, rankings, users):
+    '''Replace the snapshot of the `period` containing `day` with `rankings` rows computed elsewhere, e.g. by rank() over several shards'''
+    start, _ = period_window(period, day or date.today())
+    key = {'metric': metric_name, 'period': period, 'period_start': start}
+    rows = [{**key, 'cohort': cohort, 'user_id': user_id, 'value': value, 'rank': place, 'cohort_size': size, 'top_fraction': fraction}
+            for cohort, user_id, value, place, size, fraction in rankings]
+    fill = lambda connection: rows and connection.execute(insert(LeaderboardEntry.__table__), rows) # An empty executemany is an error
+    return _replace(connection, key, fill, users)
+
+def refresh_all(engine, day=None, metrics=tuple(METRICS), periods=PERIODS):
+    '''Refresh every metric and period containing `day`, each in its own transaction; return {(metric, period): users}'''
+    counts = {}
+    for metric_name in metrics:
+        for period in periods:
+            with engine.begin() as connection:
+                counts[(metric_name, period)] = refresh(connection, metric_name, period, day)
+    return counts
+
+def prune(connection, before):
+    '''Delete the snapshots of periods starting before `before`'''
+    for model in (LeaderboardEntry, LeaderboardSnapshot):
+        connection.execute(delete(model.__table__).where(model.__table__.c.period_start < before))
+
+def _rankings(rows):
+    return [Ranking(*row) for row in rows]
+
+def _select_rankings():
+    return select(LeaderboardEntry.metric, LeaderboardEntry.cohort, LeaderboardEntry.user_id, LeaderboardEntry.value,
+                  LeaderboardEntry.rank, LeaderboardEntry.cohort_size, LeaderboardEntry.top_fraction)
+
+def user_rankings(session, user_id, period='week', day=None, metrics=None):
+    '''Every ranking of a user in the snapshot of the `period` containing `day`, by metric and then cohort'''
+    start, _ = period_window(period, day or date.today())
+    statement = _select_rankings().\
+        where(LeaderboardEntry.user_id == user_id, LeaderboardEntry.period == period, LeaderboardEntry.period_start == start)
+    if metrics is not None:
+        statement = statement.where(LeaderboardEntry.metric.in_(metrics))
+    return _rankings(session.execute(statement.order_by(LeaderboardEntry.metric, LeaderboardEntry.cohort)))
+
+def top(session, metric_name, period='week', cohort=ALL_USERS, k=TOP_K, day=None):
+    '''The `k` best-ranked users of a cohort in the snapshot of the `period` containing `day`'''
+    start, _ = period_window(period, day or date.today())
+    statement = _select_rankings().\
+        where(LeaderboardEntry.metric == metric_name, LeaderboardEntry.period == period,
+              LeaderboardEntry.period_start == start, LeaderboardEntry.cohort == cohort).\
+        order_by(LeaderboardEntry.rank, LeaderboardEntry.user_id).limit(k)
+    return _rankings(session.execute(statement))
+
+def main():
+    import sharding # Imported here, as sharding.py builds on this module
+    command = sys.argv[1] if len(sys.argv) > 1 else 'refresh'
+    router = sharding.router_from_settings() # None unless users are spread over several databases
+    engine = get_engine() # Create an engine that connects to the configured database
+    if command == 'refresh':
+        day = date.fromisoformat(sys.argv[2]) if len(sys.argv) > 2 else None
+        counts = router.refresh_leaderboards(day) if router else refresh_all(engine, day)
+        for (metric_name, period), users in counts.items():
+            print(f"{metric_name} ({period}): {users} user(s) ranked")
+    elif command == 'top' and len(sys.argv) > 3:
+        cohort = sys.argv[4] if len(sys.argv) > 4 else ALL_USERS
+        with engine.connect() as connection:
+            rankings = router.leaderboard_top(sys.argv[2], sys.argv[3], cohort) if router else top(connection, sys.argv[2], sys.argv[3], cohort)
+            for ranking in rankings:
+                print(f"#{ranking.rank} user {ranking.user_id}: {ranking.value:.1f} (top {ranking.top_percent:.0f}% of {ranking.cohort_size})")
+    else:
+        sys.exit("Usage: leaderboards.py refresh [YYYY-MM-DD] | leaderboards.py top METRIC week|month [COHORT]")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''Bulk deletion of users and of old log rows, for account deletion and data-retention jobs.
+
+Deleting a User through the session hands its rows to ON DELETE CASCADE, which removes them in
+the same statement. That is fine for one account, but purging many users, or one with years of
+logs, that way holds the writer lock for the whole cascade. The functions below delete instead in
+chunks of at most `chunk_size` rows, each in its own short transaction, so other writers get the
+lock between chunks and a purge that is interrupted can simply be run again.
+
+A purge removes whole rollup rows, since a purged user has no days left and a cutoff removes whole
+days. A cutoff deletes the log rows first and the rollup days after them, in chunks of their own, so
+an interrupted purge never leaves logs behind whose days have no rollup; rollups.check() agrees with
+the log tables again once a purge has finished. A cutoff then rebuilds the
+progress counters of the measurable goals whose window starts before it, so goal_progress.check()
+agrees too. The search index follows through its triggers, and the summary caches of the users
+concerned are invalidated after each chunk.
+
+    python3 purge.py users 12 15 16       # Delete these users and everything they logged
+    python3 purge.py before 2022-01-01    # Delete workouts, meals, nights and moods logged before that day
+'''
+import sys
+from datetime import date, datetime, time
+from sqlalchemy import select, delete, literal_column
+from create import User, FitnessGoal, Workout, NutritionLog, SleepRecord, MoodLog
+from database import get_engine
+from cache import invalidate_all_caches, TRACKED_TABLES
+import rollups
+import goal_progress
+import sharding
+
+PURGE_CHUNK_SIZE = 5000 # Rows deleted per transaction
+USER_BATCH_SIZE = 500 # Users whose rows are deleted together, bounding the IN list of every statement
+
+LOG_TIMES = {Workout: Workout.date, NutritionLog: NutritionLog.date, SleepRecord: SleepRecord.start_time, MoodLog: MoodLog.date} # Column compared with a retention cutoff
+
+def _delete_chunk(connection, table, condition, chunk_size):
+    '''Delete up to `chunk_size` rows of `table` matching `condition`; return the user ids of the deleted rows'''
+    rowid = literal_column('rowid') # Rollup tables have composite keys, so chunks are chosen by rowid
+    chosen = select(rowid).select_from(table).where(condition).limit(chunk_size)
+    return connection.execute(delete(table).where(rowid.in_(chosen)).returning(table.c.user_id)).scalars().all()
+
+def _purge(engine, table, condition, chunk_size):
+    '''Delete every row of `table` matching `condition`, one chunk per transaction; return the number deleted'''
+    deleted = 0
+    while True:
+        with engine.begin() as connection:
+            user_ids = _delete_chunk(connection, table, condition, chunk_size)
+        if table.name in TRACKED_TABLES:
+            for user_id in set(user_ids) - {None}:
+                invalidate_all_caches(user_id, (table.name,))
+        deleted += len(user_ids)
+        if len(user_ids) < chunk_size:
+            return deleted
+
+def purge_users(engine, user_ids, chunk_size=PURGE_CHUNK_SIZE):
+    '''Delete users with their goals, logs, rollups and search entries; return the number of users deleted'''
+    user_ids = sorted(set(user_ids))
+    tables = [rollup.table for rollup in rollups.ROLLUPS.values()] + [model.__table__ for model in (*LOG_TIMES, FitnessGoal)]
+    deleted = 0
+    for start in range(0, len(user_ids), USER_BATCH_SIZE):
+        batch = user_ids[start:start + USER_BATCH_SIZE]
+        for table in tables:
+            _purge(engine, table, table.c.user_id.in_(batch), chunk_size)
+        with engine.begin() as connection: # Only the user rows are left; ON DELETE CASCADE catches rows written meanwhile
+            deleted += connection.execute(delete(User.__table__).where(User.id.in_(batch))).rowcount
+        for user_id in batch:
+            invalidate_all_caches(user_id, TRACKED_TABLES)
+    return deleted
+
+def purge_before(engine, cutoff, models=tuple(LOG_TIMES), chunk_size=PURGE_CHUNK_SIZE):
+    '''Delete the log rows of `models` dated before `cutoff`, with their rollup days; return the number deleted per table.
+
+    Logs written meanwhile with a date before `cutoff` are not supported: the rollup days and goal
+    counters they update may be purged or rebuilt without them, so run retention jobs when nothing backdates logs.
+    '''
+    moment = datetime.combine(cutoff, time()) # Nights count from the day they started, like their rollups
+    counts = {}
+    for model in models:
+        bound = moment if model is SleepRecord else cutoff
+        counts[model.__tablename__] = _purge(engine, model.__table__, LOG_TIMES[model] < bound, chunk_size)
+        rollup_table = rollups.ROLLUPS[model].table
+        _purge(engine, rollup_table, rollup_table.c.day < cutoff, chunk_size) # Only once their logs are gone
+    with engine.begin() as connection: # Goals counting purged days lose their progress from those days
+        goal_progress.rebuild(connection, before=cutoff)
+    return counts
+
+def main():
+    command, arguments = (sys.argv[1], sys.argv[2:]) if len(sys.argv) > 1 else (None, [])
+    router = sharding.router_from_settings()
+    engines = list(router.engines.values()) if router else [get_engine()] # Every shard holds a part of the users and their logs
+    if command == 'users' and arguments:
+        user_ids = [int(argument) for argument in arguments]
+        deleted = sum(purge_users(engine, user_ids) for engine in engines)
+        if router:
+            router.forget_users(user_ids)
+        print(f"Deleted {deleted} user(s) and their data.")
+    elif command == 'before' and len(arguments) == 1:
+        counts = {}
+        for engine in engines:
+            for table, count in purge_before(engine, date.fromisoformat(arguments[0])).items():
+                counts[table] = counts.get(table, 0) + count
+        for table, count in counts.items():
+            print(f"{table}: {count} rows deleted")
+    else:
+        sys.exit("Usage: purge.py users USER_ID... | purge.py before YYYY-MM-DD")
+
+if __name__ == '__main__':
+    main()
@@ -1,89 +1,199 @@
-from sqlalchemy import create_engine, func
+from sqlalchemy import select, or_, and_
 from sqlalchemy.orm import sessionmaker
 from create import Base, User, FitnessGoal, Workout, NutritionLog, SleepRecord, MoodLog
-from datetime import datetime, timedelta
+from datetime import datetime, date as date_type, timedelta
+from database import get_engine, session_scope
+import summaries
+import goal_progress
+import leaderboards
+from cache import SummaryCache
+import sharding
+from instrumentation import instrumented # Times every public function below and counts its SQL statements and rows
 
 # Establish a connection to the database
-engine = create_engine('sqlite:///health_fitness_app.db') # Create an engine that connects to the database
-Session = sessionmaker(bind=engine) # Create a session to interact with the database
-session = Session() # Create an instance of the session
-
-def get_user_workouts(user_id):
+engine = get_engine(read_only=True) # Reports only read, so they use the pool of query-only connections that never wait for the writer
+router = sharding.router_from_settings() # None unless the `shards` setting spreads users over several databases
+# Session factory; every call below acquires its own session from it, and the rows it returns stay readable after it closes
+Session = router.sessionmaker(read_only=True, expire_on_commit=False) if router else sessionmaker(bind=engine, expire_on_commit=False)
+summary_cache = SummaryCache() # Summaries are reused until a write touches the user's tables they read
+STREAM_CHUNK_SIZE = 1000 # Rows fetched from the cursor at a time by the iter_* generators
+
+# Every date filter below is a half-open [start, end) range on the raw column so that
+# SQLite can seek the composite (user_id, date) indexes instead of scanning the table.
+
+def _as_date(value):
+    """Coerce a date, datetime or ISO 'YYYY-MM-DD' string into a date"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date_type):
+        return value
+    return date_type.fromisoformat(value)
+
+def _day_window(day):
+    """Half-open [start, end) range covering a single day"""
+    start = _as_date(day)
+    return start, start + timedelta(days=1)
+
+def _date_window(start_date, end_date):
+    """Half-open [start, end) range covering an inclusive pair of dates"""
+    return _as_date(start_date), _as_date(end_date) + timedelta(days=1)
+
+def _month_window(month, year):
+    """Half-open [start, end) range covering a calendar month"""
+    start = date_type(year, month, 1)
+    end = date_type(year + 1, 1, 1) if month == 12 else date_type(year, month + 1, 1)
+    return start, end
+
+def _last_month_window():
+    """Half-open [start, end) range covering the 30 days before today and today itself"""
+    today = date_type.today()
+    return today - timedelta(days=30), today + timedelta(days=1)
+
+def _cached_summary(summary, tables, session, user_id, start, end):
+    """Read-through the summary cache for one of the summaries functions"""
+    return summary_cache.get_or_compute(summary.__name__, user_id, (start, end), tables,
+                                        lambda: summary(session, user_id, start, end))
+
+def _after(date_column, id_column, cursor):
+    """Keyset condition for the rows ordered by (date, id) after a (date, id) cursor"""
+    day, row_id = cursor
+    if day is None: # SQLite sorts NULL dates first, so every dated row comes after them
+        return or_(date_column.isnot(None), id_column > row_id)
+    day = _as_date(day)
+    return and_(date_column >= day, or_(date_column > day, id_column > row_id)) # The >= bound lets SQLite seek the (user_id, date) index
+
+def _history(model, date_column, user_id, after=None):
+    """A user's rows ordered by (date, id), optionally after a keyset cursor"""
+    statement = select(model).where(model.user_id == user_id).order_by(date_column, model.id)
+    return statement if after is None else statement.where(_after(date_column, model.id, after))
+
+def _page(session, statement, date_column_name, limit):
+    """Return up to `limit` rows and the cursor of the next page, or None on the last page"""
+    rows = session.scalars(statement.limit(limit + 1)).all() # One extra row tells whether another page follows
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], (getattr(last, date_column_name), last.id)
+
+@instrumented
+def iter_user_workouts(user_id, session=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Stream all workouts for a specific user, oldest first, `chunk_size` rows at a time"""
+    with session_scope(Session, session) as session:
+        yield from session.scalars(_history(Workout, Workout.date, user_id).execution_options(yield_per=chunk_size))
+
+@instrumented
+def get_user_workouts_page(user_id, after=None, limit=50, session=None):
+    """Return (workouts, next_cursor): up to `limit` workouts after the (date, id) cursor `after`"""
+    with session_scope(Session, session) as session:
+        return _page(session, _history(Workout, Workout.date, user_id, after), 'date', limit)
+
+@instrumented
+def iter_user_fitness_goals(user_id, session=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Stream all fitness goals for a user ordered by target date, `chunk_size` rows at a time"""
+    with session_scope(Session, session) as session:
+        yield from session.scalars(_history(FitnessGoal, FitnessGoal.target_date, user_id).execution_options(yield_per=chunk_size))
+
+@instrumented
+def get_user_fitness_goals_page(user_id, after=None, limit=50, session=None):
+    """Return (goals, next_cursor): up to `limit` goals after the (target_date, id) cursor `after`"""
+    with session_scope(Session, session) as session:
+        return _page(session, _history(FitnessGoal, FitnessGoal.target_date, user_id, after), 'target_date', limit)
+
+@instrumented
+def get_user_workouts(user_id, session=None):
     """Retrieve all workouts for a specific user"""
-    workouts = session.query(Workout).filter(Workout.user_id == user_id).all()
-    for workout in workouts:
+    for workout in iter_user_workouts(user_id, session):
         print(f"Workout ID: {workout.id}, Type: {workout.type}, Duration: {workout.duration} minutes, Date: {workout.date}")
 
-def get_average_sleep_duration(user_id):
+@instrumented
+def get_average_sleep_duration(user_id, session=None):
     """Calculate the average sleep duration for a user over the last month"""
-    one_month_ago = datetime.now() - timedelta(days=30)
-    average_duration = session.query(func.avg(func.julianday(SleepRecord.end_time) - func.julianday(SleepRecord.start_time)) * 24).\
-        filter(SleepRecord.user_id == user_id, SleepRecord.start_time >= one_month_ago).scalar()
-    print(f"Average Sleep Duration (hours) for the last month: {average_duration:.2f}")
-
-def get_nutrition_summary(user_id, date):
+    with session_scope(Session, session) as session:
+        start, end = _last_month_window()
+        average_duration = _cached_summary(summaries.sleep_overview, ('sleep_records',), session, user_id, start, end).average_hours
+        if average_duration is None:
+            print("No sleep records for the last month")
+            return
+        print(f"Average Sleep Duration (hours) for the last month: {average_duration:.2f}")
+
+@instrumented
+def get_nutrition_summary(user_id, date, session=None):
     """Summarize nutrition for a specific day"""
-    logs = session.query(NutritionLog).filter(NutritionLog.user_id == user_id, func.date(NutritionLog.date) == date).all()
-    total_calories = 0
-    for log in logs:
-        total_calories += log.calories
-        print(f"Meal: {log.meal_type}, Calories: {log.calories}")
-    print(f"Total Calories for {date}: {total_calories}")
-
-def get_user_fitness_goals(user_id):
+    with session_scope(Session, session) as session:
+        start, end = _day_window(date)
+        logs = session.query(NutritionLog).filter(NutritionLog.user_id == user_id, NutritionLog.date >= start, NutritionLog.date < end).all()
+        total_calories = 0
+        for log in logs:
+            total_calories += log.calories
+            print(f"Meal: {log.meal_type}, Calories: {log.calories}")
+        print(f"Total Calories for {date}: {total_calories}")
+
+@instrumented
+def get_user_fitness_goals(user_id, session=None):
     """List all fitness goals for a user"""
-    goals = session.query(FitnessGoal).filter(FitnessGoal.user_id == user_id).all()
-    for goal in goals:
+    for goal in iter_user_fitness_goals(user_id, session):
         print(f"Goal: {goal.goal}, Target Date: {goal.target_date}")
 
-def get_detailed_nutrition_summary(user_id, start_date, end_date):
+@instrumented
+def get_detailed_nutrition_summary(user_id, start_date, end_date, session=None):
     """Provide a detailed summary of nutrition between specified dates"""
-    logs = session.query(NutritionLog).filter(NutritionLog.user_id == user_id, NutritionLog.date.between(start_date, end_date)).all()
-    total_calories, total_proteins, total_carbs, total_fats = 0, 0, 0, 0
-    for log in logs:
-        total_calories += log.calories
-        total_proteins += log.proteins
-        total_carbs += log.carbs
-        total_fats += log.fats
-    print(f"Nutrition Summary from {start_date} to {end_date}:")
-    print(f"Total Calories: {total_calories}, Proteins: {total_proteins}g, Carbs: {total_carbs}g, Fats: {total_fats}g")
-
-def get_monthly_workout_summary(user_id, current_month, current_year):
+    with session_scope(Session, session) as session:
+        start, end = _date_window(start_date, end_date)
+        summary = _cached_summary(summaries.nutrition_summary, ('nutrition_logs',), session, user_id, start, end)
+        print(f"Nutrition Summary from {start_date} to {end_date}:")
+        print(f"Total Calories: {summary.calories}, Proteins: {summary.proteins}g, Carbs: {summary.carbs}g, Fats: {summary.fats}g")
+
+@instrumented
+def get_monthly_workout_summary(user_id, current_month, current_year, session=None):
     """Monthly summary of workouts including total duration and average intensity"""
-    workouts = session.query(Workout).filter(Workout.user_id == user_id, func.extract('month', Workout.date) == current_month, func.extract('year', Workout.date) == current_year).all()
-    total_duration = sum([workout.duration for workout in workouts])
-    average_intensity = {workout.intensity for workout in workouts}
-    print(f"Total Workout Duration this Month: {total_duration} minutes")
-    print(f"Workout Intensities Encountered: {', '.join(average_intensity)}")
-
-def get_sleep_quality_overview(user_id):
+    with session_scope(Session, session) as session:
+        start, end = _month_window(current_month, current_year)
+        summary = _cached_summary(summaries.workout_summary, ('workouts',), session, user_id, start, end)
+        print(f"Total Workout Duration this Month: {summary.total_duration} minutes")
+        print(f"Workout Intensities Encountered: {', '.join(summary.intensities)}")
+
+@instrumented
+def get_sleep_quality_overview(user_id, session=None):
     """Overview of sleep quality distribution over the last month"""
-    one_month_ago = datetime.now() - timedelta(days=30)
-    sleep_records = session.query(SleepRecord).filter(SleepRecord.user_id == user_id, SleepRecord.start_time >= one_month_ago).all()
-    quality_counts = {"Poor": 0, "Fair": 0, "Good": 0, "Excellent": 0}
-    for record in sleep_records:
-        quality_counts[record.quality] += 1
-    print("Sleep Quality Overview:")
-    for quality, count in quality_counts.items():
-        print(f"{quality}: {count} nights")
-
-def get_user_mood_trends(user_id):
+    with session_scope(Session, session) as session:
+        start, end = _last_month_window()
+        overview = _cached_summary(summaries.sleep_overview, ('sleep_records',), session, user_id, start, end)
+        print("Sleep Quality Overview:")
+        for quality, count in overview.quality_counts.items():
+            print(f"{quality}: {count} nights")
+
+@instrumented
+def get_user_mood_trends(user_id, session=None):
     """Analyze mood trends for a user over the last month"""
-    one_month_ago = datetime.now() - timedelta(days=30)
-    mood_logs = session.query(MoodLog).filter(MoodLog.user_id == user_id, MoodLog.date >= one_month_ago).all()
-    mood_counts = {}
-    for log in mood_logs:
-        mood_counts[log.mood] = mood_counts.get(log.mood, 0) + 1
-    print("Mood Trends Over the Last Month:")
-    for mood, count in mood_counts.items():
-        print(f"{mood}: {count} days")
-
-def get_progress_towards_fitness_goals(user_id):
+    with session_scope(Session, session) as session:
+        start, end = _last_month_window()
+        trends = _cached_summary(summaries.mood_trends, ('mood_logs',), session, user_id, start, end)
+        print("Mood Trends Over the Last Month:")
+        for mood, count in trends.mood_counts.items():
+            print(f"{mood}: {count} days")
+
+@instrumented
+def get_progress_towards_fitness_goals(user_id, session=None):
     """Track progress towards fitness goals"""
-    goals = session.query(FitnessGoal).filter(FitnessGoal.user_id == user_id).all()
-    for goal in goals:
-        status = "Completed" if goal.completed else "In Progress"
-        print(f"Goal: {goal.goal}, Status: {status}, Target Date: {goal.target_date}")
+    for goal in iter_user_fitness_goals(user_id, session):
+        progress = goal_progress.evaluate(goal) # Constant time: the counters are kept up to date as logs are written
+        if progress is None:
+            status = "Completed" if goal.completed else "In Progress"
+            print(f"Goal: {goal.goal}, Status: {status}, Target Date: {goal.target_date}")
+        else:
+            print(f"Goal: {goal.goal}, Status: {progress.status.title()}, Progress: {progress.value:.1f}/{progress.target:g} "
+                  f"{goal.metric} ({progress.percent:.0f}%), Target Date: {goal.target_date}")
+
+@instrumented
+def get_user_leaderboard_ranks(user_id, period='week', session=None):
+    """Where the user ranks this week (or month) on every leaderboard, among all users and within their cohorts"""
+    with session_scope(Session, session) as session:
+        rankings = leaderboards.user_rankings(session, user_id, period) # One index lookup in the latest snapshot
+        if not rankings:
+            print(f"No leaderboard rankings for this {period} yet")
+            return
+        for ranking in rankings:
+            print(f"{ranking.metric} ({ranking.cohort}): #{ranking.rank} of {ranking.cohort_size}, top {ranking.top_percent:.0f}%")
 
 if __name__ == '__main__':
     user_id = 1  # Example user ID
@@ -115,3 +225,6 @@ if __name__ == '__main__':
 
     print("\nProgress Towards Fitness Goals:")
     get_progress_towards_fitness_goals(user_id)
+
+    print("\nLeaderboard Ranks This Week:")
+    get_user_leaderboard_ranks(user_id)
@@ -0,0 +1,219 @@
+'''Per-user-per-day rollups of the log tables, maintained incrementally on write.
+
+Importing this module registers mapper events on Workout, NutritionLog, SleepRecord and MoodLog, so
+every ORM insert, update or delete adjusts the matching rollup row in the same transaction. Writes
+that bypass the ORM unit of work (Core inserts such as bulk_data.py, Query.update()/delete()) must
+call apply_rows() themselves or rebuild the affected users afterwards. Every change apply_rows() makes
+is passed on to the progress counters of measurable fitness goals (goal_progress.py), and rebuild()
+rebuilds those counters too.
+
+    python3 rollups.py rebuild   # Recompute every rollup from the raw log tables
+    python3 rollups.py check     # List rollup rows that disagree with the raw log tables
+'''
+import sys
+from dataclasses import dataclass
+from datetime import datetime
+from sqlalchemy import event, inspect, select, delete, insert, func, and_, or_, case, literal, bindparam
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database import get_engine
+from create import Workout, NutritionLog, SleepRecord, MoodLog, DailyNutrition, DailyWorkout, DailySleep, DailyMood
+import goal_progress
+
+TOLERANCE = 1e-6 # Relative difference below which incremental and recomputed float sums are considered equal
+
+@dataclass(frozen=True)
+class Rollup:
+    '''How one log table is rolled up into its daily table'''
+    model: type # Log model the rollup is computed from
+    table: object # Rollup table
+    keys: tuple # Rollup key columns after user_id and day
+    counter: str # Measure counting the contributing log rows; the rollup row is removed when it drops to zero
+    columns: tuple # Log attributes read to compute a contribution
+    contribution: object # Function mapping the log attributes to (key, measures)
+    expected: object # Function returning the grouped SELECT that recomputes the rollup from the log table
+
+    @property
+    def key_names(self):
+        return ('user_id', 'day') + self.keys
+
+    @property
+    def measure_names(self):
+        return tuple(column.name for column in self.table.columns if column.name not in self.key_names)
+
+def _day(value):
+    '''Rollups are keyed by calendar day'''
+    return value.date() if isinstance(value, datetime) else value
+
+def _text(value):
+    return value if value is not None else ''
+
+def _number(value):
+    return value if value is not None else 0
+
+def _workout_contribution(values):
+    return ((values['user_id'], _day(values['date']), _text(values['type']), _text(values['intensity'])),
+            {'sessions': 1, 'minutes': _number(values['duration']), 'calories_burned': _number(values['calories_burned'])})
+
+def _workout_expected():
+    type_, intensity = func.coalesce(Workout.type, ''), func.coalesce(Workout.intensity, '')
+    return select(Workout.user_id, Workout.date.label('day'), type_.label('type'), intensity.label('intensity'),
+                  func.count().label('sessions'), func.coalesce(func.sum(Workout.duration), 0).label('minutes'),
+                  func.coalesce(func.sum(Workout.calories_burned), 0).label('calories_burned')).\
+        where(Workout.user_id.isnot(None)).group_by(Workout.user_id, Workout.date, type_, intensity)
+
+def _nutrition_contribution(values):
+    return ((values['user_id'], _day(values['date'])),
+            {'meals': 1, 'calories': _number(values['calories']), 'proteins': _number(values['proteins']),
+             'carbs': _number(values['carbs']), 'fats': _number(values['fats'])})
+
+def _nutrition_expected():
+    return select(NutritionLog.user_id, NutritionLog.date.label('day'), func.count().label('meals'),
+                  func.coalesce(func.sum(NutritionLog.calories), 0).label('calories'), func.coalesce(func.sum(NutritionLog.proteins), 0).label('proteins'),
+                  func.coalesce(func.sum(NutritionLog.carbs), 0).label('carbs'), func.coalesce(func.sum(NutritionLog.fats), 0).label('fats')).\
+        where(NutritionLog.user_id.isnot(None)).group_by(NutritionLog.user_id, NutritionLog.date)
+
+def _sleep_contribution(values):
+    return ((values['user_id'], _day(values['start_time']), _text(values['quality'])),
+            {'nights': 1, 'hours': _number(values['duration_hours']), 'deep_hours': _number(values['deep_sleep_duration'])})
+
+def _sleep_expected():
+    day, quality = func.date(SleepRecord.start_time), func.coalesce(SleepRecord.quality, '')
+    hours = SleepRecord.duration_hours
+    return select(SleepRecord.user_id, day.label('day'), quality.label('quality'), func.count().label('nights'),
+                  func.coalesce(func.sum(hours), 0).label('hours'), func.coalesce(func.sum(SleepRecord.deep_sleep_duration), 0).label('deep_hours')).\
+        where(SleepRecord.user_id.isnot(None)).group_by(SleepRecord.user_id, day, quality)
+
+def _mood_contribution(values):
+    stress = values['stress_level']
+    return ((values['user_id'], _day(values['date']), _text(values['mood'])),
+            {'entries': 1, 'stress_total': _number(stress), 'stress_entries': 0 if stress is None else 1})
+
+def _mood_expected():
+    mood = func.coalesce(MoodLog.mood, '')
+    return select(MoodLog.user_id, MoodLog.date.label('day'), mood.label('mood'), func.count().label('entries'),
+                  func.coalesce(func.sum(MoodLog.stress_level), 0).label('stress_total'), func.count(MoodLog.stress_level).label('stress_entries')).\
+        where(MoodLog.user_id.isnot(None)).group_by(MoodLog.user_id, MoodLog.date, mood)
+
+ROLLUPS = {
+    Workout: Rollup(Workout, DailyWorkout.__table__, ('type', 'intensity'), 'sessions',
+                    ('user_id', 'date', 'type', 'intensity', 'duration', 'calories_burned'), _workout_contribution, _workout_expected),
+    NutritionLog: Rollup(NutritionLog, DailyNutrition.__table__, (), 'meals',
+                         ('user_id', 'date', 'calories', 'proteins', 'carbs', 'fats'), _nutrition_contribution, _nutrition_expected),
+    SleepRecord: Rollup(SleepRecord, DailySleep.__table__, ('quality',), 'nights',
+                        ('user_id', 'start_time', 'duration_hours', 'quality', 'deep_sleep_duration'), _sleep_contribution, _sleep_expected),
+    MoodLog: Rollup(MoodLog, DailyMood.__table__, ('mood',), 'entries',
+                    ('user_id', 'date', 'mood', 'stress_level'), _mood_contribution, _mood_expected),
+}
+
+def apply_rows(connection, model, rows, sign=1):
+    '''Add (sign=1) or remove (sign=-1) the contribution of log rows, given as attribute mappings, to the rollups'''
+    rollup = ROLLUPS[model]
+    totals = {}
+    for values in rows:
+        if values['user_id'] is None:
+            continue
+        key, measures = rollup.contribution(values)
+        total = totals.setdefault(key, dict.fromkeys(measures, 0))
+        for name, value in measures.items():
+            total[name] += sign * value
+    if not totals:
+        return
+
+    table = rollup.table
+    statement = sqlite_insert(table)
+    statement = statement.on_conflict_do_update(index_elements=list(rollup.key_names),
+                                                set_={name: table.c[name] + statement.excluded[name] for name in rollup.measure_names})
+    connection.execute(statement, [dict(zip(rollup.key_names, key), **measures) for key, measures in totals.items()])
+    goal_progress.apply_totals(connection, table, totals) # Goals counting these days move with their rollup rows
+
+    emptied = [dict(zip(['k_' + name for name in rollup.key_names], key)) for key, measures in totals.items() if measures[rollup.counter] < 0]
+    if emptied: # Only a removal can bring a rollup row down to zero
+        connection.execute(delete(table).where(table.c[rollup.counter] <= 0, *[table.c[name] == bindparam('k_' + name) for name in rollup.key_names]), emptied)
+
+def _values(target, rollup):
+    return {name: getattr(target, name) for name in rollup.columns}
+
+def _changed(target, rollup):
+    '''Whether an update touches any column the rollup depends on'''
+    attributes = inspect(target).attrs
+    return any(attributes[name].history.has_changes() for name in rollup.columns)
+
+def _after_insert(mapper, connection, target):
+    rollup = ROLLUPS[mapper.class_]
+    apply_rows(connection, rollup.model, [_values(target, rollup)])
+
+def _before_update(mapper, connection, target):
+    rollup = ROLLUPS[mapper.class_]
+    if _changed(target, rollup): # The row still holds its old values, which the session may never have loaded
+        table = rollup.model.__table__
+        old = connection.execute(select(*[table.c[name] for name in rollup.columns]).where(table.c.id == target.id)).mappings().first()
+        apply_rows(connection, rollup.model, [old], sign=-1)
+
+def _after_update(mapper, connection, target):
+    rollup = ROLLUPS[mapper.class_]
+    if _changed(target, rollup):
+        apply_rows(connection, rollup.model, [_values(target, rollup)])
+
+def _before_delete(mapper, connection, target):
+    rollup = ROLLUPS[mapper.class_]
+    apply_rows(connection, rollup.model, [_values(target, rollup)], sign=-1)
+
+for _model in ROLLUPS:
+    event.listen(_model, 'after_insert', _after_insert)
+    event.listen(_model, 'before_update', _before_update)
+    event.listen(_model, 'after_update', _after_update)
+    event.listen(_model, 'before_delete', _before_delete)
+
+def _expected(rollup, user_ids):
+    statement = rollup.expected()
+    if user_ids is not None:
+        statement = statement.where(rollup.model.user_id.in_(user_ids))
+    return statement
+
+def rebuild(connection, user_ids=None):
+    '''Recompute the rollups of `user_ids` (default: every user) from the raw log tables'''
+    for rollup in ROLLUPS.values():
+        table = rollup.table
+        clear = delete(table)
+        if user_ids is not None:
+            clear = clear.where(table.c.user_id.in_(user_ids))
+        connection.execute(clear)
+        connection.execute(insert(table).from_select(list(rollup.key_names + rollup.measure_names), _expected(rollup, user_ids)))
+    goal_progress.rebuild(connection, user_ids) # The goal counters follow the rollup rows
+
+def check(connection, user_ids=None):
+    '''Return (table, key, problem) for every rollup row that is missing, stale or orphaned'''
+    mismatches = []
+    for rollup in ROLLUPS.values():
+        stored, expected = rollup.table, _expected(rollup, user_ids).subquery()
+        joined = and_(*[expected.c[name] == stored.c[name] for name in rollup.key_names])
+        differs = or_(*[func.abs(expected.c[name] - stored.c[name]) > TOLERANCE * func.max(1, func.abs(expected.c[name])) for name in rollup.measure_names])
+        missing_or_stale = select(*[expected.c[name] for name in rollup.key_names], case((stored.c.user_id.is_(None), 'missing'), else_='stale')).\
+            select_from(expected.outerjoin(stored, joined)).where(or_(stored.c.user_id.is_(None), differs))
+        orphaned = select(*[stored.c[name] for name in rollup.key_names], literal('orphaned')).\
+            select_from(stored.outerjoin(expected, joined)).where(expected.c.user_id.is_(None))
+        if user_ids is not None:
+            orphaned = orphaned.where(stored.c.user_id.in_(user_ids))
+        for statement in (missing_or_stale, orphaned):
+            for row in connection.execute(statement):
+                mismatches.append((stored.name, tuple(row[:-1]), row[-1]))
+    return mismatches
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'check'
+    engine = get_engine() # Create an engine that connects to the configured database
+    with engine.begin() as connection:
+        if command == 'rebuild':
+            rebuild(connection)
+            print("Rollups rebuilt from the log tables.")
+        elif command == 'check':
+            mismatches = check(connection)
+            for table, key, problem in mismatches:
+                print(f"{table} {key}: {problem}")
+            print(f"{len(mismatches)} inconsistent rollup row(s) found")
+            sys.exit(1 if mismatches else 0)
+        else:
+            sys.exit(f"Unknown command {command!r}; expected 'rebuild' or 'check'")
+
+if __name__ == '__main__':
+    main()
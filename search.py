@@ -0,0 +1,178 @@
+'''Full-text search over the notes of workouts, nutrition logs, sleep records and mood logs and the users' bios.
+
+The notes are indexed in the SQLite FTS5 table `notes_fts`, which SQL triggers keep in step with the
+source tables on every insert, update and delete, whether the rows are written through the ORM, the
+ingest queue or plain executemany. Each entry is keyed by rowid = source id * 8 + source code, so a
+trigger finds its entry with a rowid lookup. Besides the text, every entry holds an `owner` token
+(u<user id>): restricting a search to a user is then an intersection of two FTS5 doclists rather than
+a filter over every hit of the search terms.
+
+    python3 search.py rebuild               # (Re)create the index from the source tables
+    python3 search.py query "knee pain" --user 42
+'''
+import argparse
+from dataclasses import dataclass
+from sqlalchemy import select, table, column, func, null, or_, and_, text
+from sqlalchemy.orm import Session
+from database import get_engine
+
+# (code, kind, table, text column, user column, day, day columns); `code` is the low 3 bits of the rowid, {row}
+# stands for NEW, OLD or the table itself and the day columns are those the day is computed from
+SOURCES = (
+    (1, 'workout', 'workouts', 'notes', 'user_id', '{row}.date', ('date',)),
+    (2, 'nutrition', 'nutrition_logs', 'notes', 'user_id', '{row}.date', ('date',)),
+    (3, 'sleep', 'sleep_records', 'notes', 'user_id', 'date({row}.start_time)', ('start_time',)), # The day the night started
+    (4, 'mood', 'mood_logs', 'notes', 'user_id', '{row}.date', ('date',)),
+    (5, 'bio', 'users', 'bio', 'id', 'NULL', ()),
+)
+KINDS = {source[1]: source[0] for source in SOURCES}
+SNIPPET_TOKENS = 12 # Tokens of context around the matched terms in a hit's snippet
+
+notes_fts = table('notes_fts', column('rowid'), column('notes_fts'), column('body'), column('kind'),
+                  column('user_id'), column('day'))
+
+@dataclass(frozen=True)
+class Hit:
+    """One matching note"""
+    kind: str # 'workout', 'nutrition', 'sleep', 'mood' or 'bio'
+    source_id: int # Id of the row in the source table (the user id for a bio)
+    user_id: int
+    day: str # ISO date of the log, None for a bio
+    snippet: str # The matched terms in [brackets] with some context
+    rank: float # bm25 score, lower being a better match; None for unranked searches
+
+def _entry(source, row):
+    '''(column values of the index entry, note expression) of a `row` (new, old or the table) of a source table'''
+    code, kind, table_name, text_column, user_column, day, _ = source
+    return f"{row}.id * 8 + {code}, {row}.{text_column}, 'u' || {row}.{user_column}, '{kind}', {row}.{user_column}, {day.format(row=row)}", f'{row}.{text_column}'
+
+def _indexed_columns(source):
+    '''Columns of a source table the index entry is computed from; updates of any other column leave the entry alone'''
+    text_column, user_column, day_columns = source[3], source[4], source[6]
+    return list(dict.fromkeys(['id', text_column, user_column, *day_columns]))
+
+def _statements():
+    '''DDL of the FTS5 table and of the triggers that keep it in step with its sources'''
+    statements = ["CREATE VIRTUAL TABLE IF NOT EXISTS notes_fts USING fts5("
+                  "body, owner, kind UNINDEXED, user_id UNINDEXED, day UNINDEXED, "
+                  "tokenize = 'porter unicode61 remove_diacritics 2')"]
+    for source in SOURCES:
+        code, table_name = source[0], source[2]
+        new_values, new_text = _entry(source, 'new')
+        insert = f"INSERT INTO notes_fts (rowid, body, owner, kind, user_id, day) SELECT {new_values} WHERE {new_text} IS NOT NULL;"
+        delete = f"DELETE FROM notes_fts WHERE rowid = old.id * 8 + {code};"
+        statements += [
+            f"CREATE TRIGGER IF NOT EXISTS {table_name}_notes_insert AFTER INSERT ON {table_name} BEGIN {insert} END",
+            f"CREATE TRIGGER IF NOT EXISTS {table_name}_notes_delete AFTER DELETE ON {table_name} BEGIN {delete} END",
+            f"CREATE TRIGGER IF NOT EXISTS {table_name}_notes_update AFTER UPDATE OF {', '.join(_indexed_columns(source))} ON {table_name} "
+            f"BEGIN {delete} {insert} END",
+        ]
+    return statements
+
+def index_exists(connection):
+    return connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'notes_fts'").scalar() is not None
+
+def create_index(connection):
+    '''Create the search index and its triggers if they are missing, indexing any existing notes'''
+    existed = index_exists(connection)
+    for source in SOURCES: # Update triggers created before they were limited to the indexed columns fire on every update
+        name = f'{source[2]}_notes_update'
+        trigger = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (name,)).scalar()
+        if trigger is not None and ' UPDATE OF ' not in trigger:
+            connection.exec_driver_sql(f"DROP TRIGGER {name}")
+    for statement in _statements():
+        connection.exec_driver_sql(statement)
+    if not existed:
+        _fill(connection)
+
+def drop_triggers(connection):
+    '''Stop maintaining the index, e.g. during a bulk load that rebuilds it afterwards'''
+    for source in SOURCES:
+        table_name = source[2]
+        for action in ('insert', 'delete', 'update'):
+            connection.exec_driver_sql(f"DROP TRIGGER IF EXISTS {table_name}_notes_{action}")
+
+def _fill(connection):
+    for source in SOURCES:
+        table_name = source[2]
+        values, note = _entry(source, table_name)
+        connection.exec_driver_sql(f"INSERT INTO notes_fts (rowid, body, owner, kind, user_id, day) SELECT {values} FROM {table_name} WHERE {note} IS NOT NULL")
+    connection.exec_driver_sql("INSERT INTO notes_fts (notes_fts) VALUES ('optimize')") # Merge the segments into one b-tree
+
+def rebuild(connection):
+    '''Drop and recreate the index and its triggers from the source tables'''
+    drop_triggers(connection)
+    connection.exec_driver_sql("DROP TABLE IF EXISTS notes_fts")
+    create_index(connection)
+
+def match_expression(query, user_id=None):
+    '''FTS5 query for the words of `query` (all required; a trailing * matches a prefix), optionally of one user only'''
+    terms = []
+    for word in query.split():
+        prefix = word.endswith('*')
+        word = word.rstrip('*').replace('"', '""')
+        if word:
+            terms.append(f'"{word}"' + ('*' if prefix else ''))
+    if not terms:
+        raise ValueError("The search query has no words")
+    expression = f"body : ({' '.join(terms)})"
+    return expression if user_id is None else f'owner : "u{int(user_id)}" AND {expression}'
+
+def search_notes(session, query, user_id=None, start=None, end=None, kinds=None, ranked=True, after=None, limit=20):
+    """Return (hits, next_cursor): up to `limit` notes matching `query` after the cursor `after`.
+
+    Hits come best first by bm25, or with `ranked=False` newest first by rowid, which lets FTS5 stop
+    after one page instead of scoring every match of common words across all users. `start` and `end`
+    keep the logs of the half-open [start, end) range of days, which leaves out bios.
+    """
+    rank = func.bm25(notes_fts.c.notes_fts)
+    statement = select(notes_fts.c.rowid, notes_fts.c.kind, notes_fts.c.user_id, notes_fts.c.day,
+                       func.snippet(notes_fts.c.notes_fts, 0, '[', ']', '…', SNIPPET_TOKENS), (rank if ranked else null()).label('score')).\
+        where(notes_fts.c.notes_fts.op('MATCH')(match_expression(query, user_id))).\
+        order_by(*([rank, notes_fts.c.rowid] if ranked else [notes_fts.c.rowid.desc()])).limit(limit + 1) # One extra row tells whether another page follows
+    if start is not None:
+        statement = statement.where(notes_fts.c.day >= start.isoformat())
+    if end is not None:
+        statement = statement.where(notes_fts.c.day < end.isoformat())
+    if kinds is not None:
+        statement = statement.where(notes_fts.c.kind.in_(list(kinds)))
+    if after is not None:
+        score, rowid = after
+        if ranked:
+            statement = statement.where(or_(rank > score, and_(rank == score, notes_fts.c.rowid > rowid)))
+        else:
+            statement = statement.where(notes_fts.c.rowid < rowid)
+    rows = session.execute(statement).all()
+    hits = [Hit(kind, rowid // 8, user_id, day, snippet, score) for rowid, kind, user_id, day, snippet, score in rows[:limit]]
+    if len(rows) <= limit:
+        return hits, None
+    last = rows[limit - 1]
+    return hits, (last.score, last.rowid)
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintain and query the full-text index of notes and bios')
+    parser.add_argument('--database', default=None, help='SQLite URL (default: the configured database)')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('rebuild', help='recreate the index from the source tables')
+    query = commands.add_parser('query', help='search the notes')
+    query.add_argument('text', help='words to search for; a trailing * matches a prefix')
+    query.add_argument('--user', type=int, default=None, help='only the notes of this user')
+    query.add_argument('--kind', action='append', choices=list(KINDS), help='only notes of this kind (repeatable)')
+    query.add_argument('--newest', action='store_true', help='newest notes first instead of best matches first')
+    query.add_argument('--limit', type=int, default=20, help='hits to show')
+    args = parser.parse_args()
+
+    engine = get_engine(args.database)
+    if args.command == 'rebuild':
+        with engine.begin() as connection:
+            rebuild(connection)
+            print(f"Indexed {connection.execute(text('SELECT count(*) FROM notes_fts')).scalar()} notes.")
+    else:
+        with Session(engine) as session:
+            hits, _ = search_notes(session, args.text, user_id=args.user, kinds=args.kind, ranked=not args.newest, limit=args.limit)
+        for hit in hits:
+            print(f"{hit.kind:<10} #{hit.source_id:<8} user {hit.user_id:<8} {hit.day or '':<10} {hit.snippet}")
+    engine.dispose()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,293 @@
+'''Horizontal sharding of user data across several SQLite database files.
+
+Every shard holds the full schema of create.py and all the rows of the users assigned to it, so
+writes for users on different shards never wait for the same writer lock. A small directory
+database maps each user id to its shard and hands out user ids, which stay unique across shards.
+
+ShardRouter.sessionmaker() returns a factory of SQLAlchemy ShardedSessions that route every
+statement transparently: new rows go to the shard of their user_id, and queries that restrict
+user_id (or users.id) with = or IN run on those users' shards only; any other query runs on every
+shard and the results are concatenated. insert_data.py and query_data.py use such a factory when
+the `shards` setting lists shard URLs (see database.py), for example
+
+    HEALTH_APP_SHARDS=sqlite:///shard0.db,sqlite:///shard1.db python3 insert_data.py
+
+Cross-user reports fan out over a process pool with ShardRouter.map_shards(), and move_user() /
+rebalance() move users between shards, for instance after a shard has been added:
+
+    python3 sharding.py create      # Create the schema in every configured shard
+    python3 sharding.py status      # Users per shard
+    python3 sharding.py rebalance   # Even out the number of users per shard
+'''
+import heapq
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date
+from functools import lru_cache
+from itertools import islice
+from operator import attrgetter, itemgetter
+from sqlalchemy import MetaData, Table, Column, Integer, event, select, insert, delete, update, func
+from sqlalchemy.ext.horizontal_shard import ShardedSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, BindParameter
+from create import Base, User, setup_database
+from database import get_engine, load_settings
+from cache import invalidate_all_caches, TRACKED_TABLES
+import summaries
+import leaderboards
+
+COPY_CHUNK_SIZE = 1000 # Rows copied per executemany when a user moves
+
+directory_metadata = MetaData() # Schema of the directory database, separate from the shards' schema
+user_shards = Table('user_shards', directory_metadata,
+                    Column('user_id', Integer, primary_key=True), # Allocated here, so user ids are unique across shards
+                    Column('shard', Integer, nullable=False, index=True)) # Index of the shard holding the user's rows
+
+def _user_ids_in(statement):
+    '''User ids a statement is restricted to by user_id = / IN or users.id = / IN, or an empty set'''
+    user_ids = set()
+    for element in visitors.iterate(statement):
+        if not isinstance(element, BinaryExpression) or not isinstance(element.right, BindParameter):
+            continue
+        column = element.left
+        if getattr(column, 'key', None) != 'user_id' and not (getattr(column, 'key', None) == 'id' and getattr(getattr(column, 'table', None), 'name', None) == 'users'):
+            continue
+        value = element.right.effective_value
+        if element.operator is operators.eq:
+            user_ids.add(value)
+        elif element.operator is operators.in_op:
+            user_ids.update(value)
+    return user_ids
+
+class ShardRouter:
+    '''Maps users to shard databases and routes sessions, reports and moves accordingly'''
+
+    def __init__(self, shard_urls, directory_url):
+        self.shard_urls = list(shard_urls)
+        self.engines = {shard: get_engine(url) for shard, url in enumerate(self.shard_urls)}
+        self.read_engines = {shard: get_engine(url, read_only=True) for shard, url in enumerate(self.shard_urls)}
+        self.directory = get_engine(directory_url)
+        directory_metadata.create_all(self.directory)
+        self._shards = {} # user_id -> shard, filled from the directory as users are routed
+        self._lock = threading.Lock()
+
+    def create_all(self):
+        '''Create or upgrade the schema of create.py, search index included, in every shard'''
+        for engine in self.engines.values():
+            setup_database(engine)
+
+    def dispose(self):
+        for engine in [*self.engines.values(), *self.read_engines.values(), self.directory]:
+            engine.dispose()
+
+    def default_shard(self, user_id):
+        '''Shard of a user the directory does not know yet'''
+        return (user_id - 1) % len(self.shard_urls)
+
+    def shard_for(self, user_id):
+        '''Shard holding the rows of `user_id`'''
+        with self._lock:
+            shard = self._shards.get(user_id)
+        if shard is None:
+            with self.directory.connect() as connection:
+                shard = connection.execute(select(user_shards.c.shard).where(user_shards.c.user_id == user_id)).scalar()
+            if shard is None:
+                return self.default_shard(user_id) # Not cached, so a later registration is picked up
+            with self._lock:
+                self._shards[user_id] = shard
+        return shard
+
+    def allocate_user_id(self):
+        '''Reserve the next user id and place it on a shard, round-robin'''
+        last = select(func.coalesce(func.max(user_shards.c.user_id), 0)).scalar_subquery()
+        statement = insert(user_shards).from_select(['user_id', 'shard'], select(last + 1, last % len(self.shard_urls))).\
+            returning(user_shards.c.user_id, user_shards.c.shard)
+        with self.directory.begin() as connection:
+            user_id, shard = connection.execute(statement).one()
+        with self._lock:
+            self._shards[user_id] = shard
+        return user_id
+
+    def register(self, user_id):
+        '''Record a user created with an explicit id on its default shard, unless it is already known'''
+        with self.directory.begin() as connection:
+            if connection.execute(select(user_shards.c.shard).where(user_shards.c.user_id == user_id)).scalar() is None:
+                connection.execute(insert(user_shards).values(user_id=user_id, shard=self.default_shard(user_id)))
+
+    def _shard_chooser(self, mapper, instance, clause=None):
+        if instance is not None:
+            user_id = instance.id if isinstance(instance, User) else instance.user_id
+            if user_id is not None:
+                return self.shard_for(user_id)
+        user_ids = _user_ids_in(clause) if clause is not None else set()
+        if len(user_ids) == 1:
+            return self.shard_for(user_ids.pop())
+        raise ValueError("Cannot choose a shard for a statement that is not restricted to one user")
+
+    def _identity_chooser(self, mapper, primary_key, *, lazy_loaded_from, **kw):
+        if lazy_loaded_from is not None and lazy_loaded_from.identity_token is not None:
+            return [lazy_loaded_from.identity_token]
+        if mapper.class_ is User:
+            return [self.shard_for(primary_key[0])]
+        return list(self.engines) # Log row ids are only unique within a shard
+
+    def _execute_chooser(self, orm_context):
+        user_ids = _user_ids_in(orm_context.statement)
+        if user_ids:
+            return sorted({self.shard_for(user_id) for user_id in user_ids})
+        return list(self.engines)
+
+    def _assign_new_users(self, session, flush_context, instances):
+        '''Give every new user a directory-allocated id before the flush routes its rows'''
+        for instance in session.new:
+            if isinstance(instance, User):
+                if instance.id is None:
+                    instance.id = self.allocate_user_id()
+                else:
+                    self.register(instance.id)
+
+    def sessionmaker(self, read_only=False, **options):
+        '''Factory of sessions that route every statement to the shards of the users it concerns'''
+        factory = sessionmaker(class_=ShardedSession, shards=self.read_engines if read_only else self.engines,
+                               shard_chooser=self._shard_chooser, identity_chooser=self._identity_chooser,
+                               execute_chooser=self._execute_chooser, **options)
+        event.listen(factory, 'before_flush', self._assign_new_users)
+        return factory
+
+    def map_shards(self, function, *args, processes=None):
+        '''Call function(session, *args) on every shard in a pool of worker processes; return the results in shard order'''
+        with ProcessPoolExecutor(processes or len(self.shard_urls)) as pool:
+            return list(pool.map(_run_on_shard, self.shard_urls, [function] * len(self.shard_urls), [args] * len(self.shard_urls)))
+
+    def user_summaries(self, start, end, cohort=None, processes=None):
+        '''(user_id, Dashboard) for every user (or every user of `cohort`) on every shard, ordered by user id'''
+        per_shard = self.map_shards(_shard_user_summaries, start, end, cohort, processes=processes)
+        return list(heapq.merge(*per_shard, key=itemgetter(0)))
+
+    def refresh_leaderboards(self, day=None, metrics=tuple(leaderboards.METRICS), periods=leaderboards.PERIODS, processes=None):
+        '''Rank the users of every shard together and store each user's rankings on their shard; return {(metric, period): users}'''
+        windows = {(metric_name, period): leaderboards.period_window(period, day or date.today()) for metric_name in metrics for period in periods}
+        per_shard = self.map_shards(_shard_leaderboard_members, windows, processes=processes)
+        counts = {}
+        for metric_name, period in windows:
+            rankings = leaderboards.rank([row for members in per_shard for row in members[(metric_name, period)]])
+            counts[(metric_name, period)] = users = sum(cohort == leaderboards.ALL_USERS for cohort, *_ in rankings)
+            for (shard, engine), members in zip(self.engines.items(), per_shard):
+                held = {user_id for _, user_id, _ in members[(metric_name, period)]}
+                with engine.begin() as connection: # The users were read from this shard, so their rankings are stored back on it
+                    leaderboards.store(connection, metric_name, period, day, [row for row in rankings if row[1] in held], users)
+        return counts
+
+    def leaderboard_top(self, metric_name, period='week', cohort=leaderboards.ALL_USERS, k=leaderboards.TOP_K, day=None):
+        '''The `k` best-ranked users of a cohort across every shard, from the snapshots refresh_leaderboards() stored'''
+        per_shard = []
+        for engine in self.read_engines.values():
+            with Session(engine) as session:
+                per_shard.append(leaderboards.top(session, metric_name, period, cohort, k, day)) # A shard's top k holds its share of the overall top k
+        return list(islice(heapq.merge(*per_shard, key=attrgetter('rank', 'user_id')), k))
+
+    def user_counts(self):
+        '''Number of users per shard, from the directory'''
+        counts = dict.fromkeys(self.engines, 0)
+        with self.directory.connect() as connection:
+            for shard, count in connection.execute(select(user_shards.c.shard, func.count()).group_by(user_shards.c.shard)):
+                counts[shard] = count
+        return counts
+
+    def move_user(self, user_id, target):
+        '''Move every row of a user to the `target` shard.
+
+        The rows are copied in one transaction on the target, the directory is switched and only then
+        are the rows deleted from the source, so the user is readable at every step. Log rows and goals
+        get new ids on the target, since ids of those tables are only unique within a shard. Writes for
+        the user must be paused while it moves.
+        '''
+        source = self.shard_for(user_id)
+        if source == target:
+            return
+        tables = [(table, table.c.id if table.name == 'users' else table.c.user_id)
+                  for table in Base.metadata.sorted_tables if table.name == 'users' or 'user_id' in table.c]
+        with self.engines[source].connect() as source_connection, self.engines[target].begin() as target_connection:
+            for table, owner in tables:
+                names = [column.name for column in table.columns if table.name == 'users' or column.name != 'id' or not column.primary_key]
+                rows = source_connection.execute(select(*[table.c[name] for name in names]).where(owner == user_id)).mappings()
+                while chunk := rows.fetchmany(COPY_CHUNK_SIZE):
+                    target_connection.execute(insert(table), [dict(row) for row in chunk])
+        with self.directory.begin() as connection:
+            connection.execute(update(user_shards).where(user_shards.c.user_id == user_id).values(shard=target))
+        with self._lock:
+            self._shards[user_id] = target
+        with self.engines[source].begin() as source_connection:
+            for table, owner in reversed(tables): # Children before the user row
+                source_connection.execute(delete(table).where(owner == user_id))
+        invalidate_all_caches(user_id, TRACKED_TABLES)
+
+    def forget_users(self, user_ids):
+        '''Remove deleted users from the directory'''
+        user_ids = list(user_ids)
+        with self.directory.begin() as connection:
+            connection.execute(delete(user_shards).where(user_shards.c.user_id.in_(user_ids)))
+        with self._lock:
+            for user_id in user_ids:
+                self._shards.pop(user_id, None)
+
+    def rebalance(self):
+        '''Move users from the fullest shards to the emptiest until every shard holds about as many; return the moves'''
+        counts = self.user_counts()
+        moves = []
+        while True:
+            fullest, emptiest = max(counts, key=counts.get), min(counts, key=counts.get)
+            if counts[fullest] - counts[emptiest] <= 1:
+                return moves
+            with self.directory.connect() as connection:
+                user_id = connection.execute(select(func.max(user_shards.c.user_id)).where(user_shards.c.shard == fullest)).scalar()
+            self.move_user(user_id, emptiest)
+            counts[fullest] -= 1
+            counts[emptiest] += 1
+            moves.append((user_id, fullest, emptiest))
+
+def _run_on_shard(url, function, args):
+    '''Worker process side of map_shards()'''
+    engine = get_engine(url, read_only=True)
+    try:
+        with Session(engine) as session:
+            return function(session, *args)
+    finally:
+        engine.dispose()
+
+def _shard_user_summaries(session, start, end, cohort):
+    return list(summaries.iter_user_summaries(session, start, end, cohort=cohort))
+
+def _shard_leaderboard_members(session, windows):
+    return {key: [tuple(row) for row in session.execute(leaderboards.members_statement(key[0], *window))] for key, window in windows.items()}
+
+@lru_cache(maxsize=None)
+def _router(shard_urls, directory_url):
+    return ShardRouter(shard_urls, directory_url)
+
+def router_from_settings(config_path=None):
+    '''The process-wide ShardRouter for the configured shards, or None when sharding is not configured'''
+    settings = load_settings(config_path)
+    shard_urls = tuple(url.strip() for url in settings['shards'].split(',') if url.strip())
+    return _router(shard_urls, settings['shard_directory']) if shard_urls else None
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'status'
+    router = router_from_settings()
+    if router is None:
+        sys.exit("Sharding is not configured; set HEALTH_APP_SHARDS or the `shards` setting")
+    if command == 'create':
+        router.create_all()
+        print(f"Schema created in {len(router.shard_urls)} shard(s).")
+    elif command == 'rebalance':
+        for user_id, source, target in router.rebalance():
+            print(f"User {user_id}: shard {source} -> shard {target}")
+    elif command != 'status':
+        sys.exit(f"Unknown command {command!r}; expected 'create', 'status' or 'rebalance'")
+    for shard, count in router.user_counts().items():
+        print(f"Shard {shard} ({router.shard_urls[shard]}): {count} user(s)")
+
+if __name__ == '__main__':
+    main()
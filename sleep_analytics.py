@@ -0,0 +1,86 @@
+from dataclasses import dataclass
+from datetime import date, datetime, time
+from sqlalchemy import select, func, case, cast, literal, Integer
+from create import SleepRecord
+
+# Every metric is one statement over a user's sleep records, read through the (user_id, start_time)
+# index for a window of nights or the (user_id, duration_hours) index for duration thresholds. The
+# stored duration_hours column spares SQLite from evaluating julianday() twice per row. Windows are
+# half-open [start, end) ranges of days on the night's start.
+
+TARGET_HOURS = 8.0 # Sleep a night should provide; shortfalls add up to the sleep debt
+SHORT_NIGHT_HOURS = 6.0 # Nights below this are counted as short
+
+@dataclass(frozen=True)
+class WeeklySleep:
+    """Average sleep of the nights starting in one week"""
+    week: date # Monday the week starts on
+    nights: int
+    average_hours: float
+    average_deep_hours: float = None # None if no night of the week recorded deep sleep
+
+@dataclass(frozen=True)
+class SleepDebt:
+    """Hours slept short of a nightly target over a date window"""
+    nights: int = 0
+    debt_hours: float = 0 # Sum over the nights of the hours missing to reach the target
+    short_nights: int = 0 # Nights shorter than SHORT_NIGHT_HOURS
+
+@dataclass(frozen=True)
+class BedtimeConsistency:
+    """How regular bedtimes are over a date window"""
+    nights: int = 0
+    mean_bedtime: time = None
+    stddev_minutes: float = None # Standard deviation of bedtimes; lower is more consistent
+
+@dataclass(frozen=True)
+class DeepSleepRatio:
+    """Share of sleep spent in deep sleep over a date window"""
+    nights: int = 0 # Nights that recorded deep sleep
+    deep_hours: float = 0
+    total_hours: float = 0
+    ratio: float = None
+
+def _nights(user_id, start, end):
+    """Conditions selecting a user's nights starting on days in [start, end)"""
+    return (SleepRecord.user_id == user_id, SleepRecord.start_time >= datetime.combine(start, time.min),
+            SleepRecord.start_time < datetime.combine(end, time.min))
+
+def weekly_averages(session, user_id, start, end):
+    """Average sleep and deep sleep per Monday-to-Sunday week with nights in [start, end), oldest first"""
+    week = func.date(SleepRecord.start_time, '-6 days', 'weekday 1') # Monday on or before the night's start
+    statement = select(week, func.count(), func.avg(SleepRecord.duration_hours), func.avg(SleepRecord.deep_sleep_duration)).\
+        where(*_nights(user_id, start, end)).group_by(week).order_by(week)
+    return [WeeklySleep(date.fromisoformat(monday), nights, hours, deep) for monday, nights, hours, deep in session.execute(statement)]
+
+def sleep_debt(session, user_id, start, end, target_hours=TARGET_HOURS):
+    """Hours missing to `target_hours` summed over the nights in [start, end), and the number of short nights"""
+    shortfall = func.max(literal(target_hours) - SleepRecord.duration_hours, 0) # Two-argument max() is SQLite's scalar maximum
+    statement = select(func.count(SleepRecord.duration_hours), func.coalesce(func.sum(shortfall), 0),
+                       func.coalesce(func.sum(case((SleepRecord.duration_hours < SHORT_NIGHT_HOURS, 1), else_=0)), 0)).\
+        where(*_nights(user_id, start, end))
+    return SleepDebt(*session.execute(statement).one())
+
+def bedtime_consistency(session, user_id, start, end):
+    """Mean bedtime and its standard deviation over the nights in [start, end)"""
+    julian = func.julianday(SleepRecord.start_time)
+    minutes = (julian - cast(julian, Integer)) * 1440 # Julian days start at noon, so bedtimes around midnight stay contiguous
+    statement = select(func.count(), func.avg(minutes), func.avg(minutes * minutes)).where(*_nights(user_id, start, end))
+    nights, mean, mean_square = session.execute(statement).one()
+    if not nights:
+        return BedtimeConsistency()
+    clock = int(round(mean + 720)) % 1440 # Minutes after midnight
+    return BedtimeConsistency(nights, time(clock // 60, clock % 60), max(mean_square - mean * mean, 0) ** 0.5)
+
+def deep_sleep_ratio(session, user_id, start, end):
+    """Deep sleep as a share of total sleep over the nights in [start, end) that recorded it"""
+    statement = select(func.count(), func.coalesce(func.sum(SleepRecord.deep_sleep_duration), 0), func.coalesce(func.sum(SleepRecord.duration_hours), 0)).\
+        where(*_nights(user_id, start, end), SleepRecord.deep_sleep_duration.isnot(None))
+    nights, deep, total = session.execute(statement).one()
+    return DeepSleepRatio(nights, deep, total, deep / total if total else None)
+
+def short_nights(session, user_id, under_hours=SHORT_NIGHT_HOURS):
+    """Every sleep record of a user shorter than `under_hours`, shortest first"""
+    statement = select(SleepRecord).where(SleepRecord.user_id == user_id, SleepRecord.duration_hours < under_hours).\
+        order_by(SleepRecord.duration_hours)
+    return session.scalars(statement).all()
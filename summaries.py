@@ -0,0 +1,211 @@
+from dataclasses import dataclass, field
+from sqlalchemy import select, func, literal, null, union_all
+from create import User, DailyNutrition, DailyWorkout, DailySleep, DailyMood
+import rollups # Registers the events that keep the daily rollup tables in step with the log tables
+
+# Every summary is one GROUP BY statement evaluated inside SQLite over the daily rollup tables,
+# so a window costs one row per day and category rather than one per log entry. Windows are
+# half-open [start, end) ranges of days, served by the rollups' (user_id, day, ...) primary keys.
+
+SLEEP_QUALITIES = ("Poor", "Fair", "Good", "Excellent") # Always reported, even with zero nights
+
+@dataclass(frozen=True)
+class NutritionSummary:
+    """Nutrition totals over a date window"""
+    meals: int = 0
+    calories: float = 0
+    proteins: float = 0
+    carbs: float = 0
+    fats: float = 0
+
+@dataclass(frozen=True)
+class WorkoutSummary:
+    """Workout totals over a date window"""
+    sessions: int = 0
+    total_duration: float = 0
+    calories_burned: float = 0
+    intensities: tuple = () # Distinct intensities encountered, sorted
+
+@dataclass(frozen=True)
+class SleepOverview:
+    """Sleep quality distribution and duration over a date window"""
+    quality_counts: dict = field(default_factory=lambda: dict.fromkeys(SLEEP_QUALITIES, 0))
+    nights: int = 0
+    average_hours: float = None # None when there are no nights in the window
+
+@dataclass(frozen=True)
+class MoodTrends:
+    """Mood distribution and stress over a date window"""
+    mood_counts: dict = field(default_factory=dict)
+    entries: int = 0
+    average_stress: float = None # None when there are no mood logs in the window
+
+@dataclass(frozen=True)
+class Dashboard:
+    """Every dashboard panel for one user and one date window"""
+    nutrition: NutritionSummary
+    workouts: WorkoutSummary
+    sleep: SleepOverview
+    mood: MoodTrends
+
+@dataclass(frozen=True)
+class Cohort:
+    """Users selected by an inclusive age range and/or gender"""
+    min_age: int = None
+    max_age: int = None
+    gender: str = None
+
+    def user_ids(self):
+        """Select the ids of the users in the cohort, ordered by id"""
+        statement = select(User.id)
+        if self.min_age is not None:
+            statement = statement.where(User.age >= self.min_age)
+        if self.max_age is not None:
+            statement = statement.where(User.age <= self.max_age)
+        if self.gender is not None:
+            statement = statement.where(User.gender == self.gender)
+        return statement.order_by(User.id)
+
+def _select(user_column, users, per_user, columns, group_by=()):
+    """Select `columns` for one user (an id), several users (a list or subquery) or every user (None).
+
+    With `per_user` the rows are grouped by user and ordered by user id, with the id as the first column.
+    """
+    statement = select(*([user_column] if per_user else []), *columns)
+    if isinstance(users, int):
+        statement = statement.where(user_column == users)
+    elif users is not None:
+        statement = statement.where(user_column.in_(users))
+    grouping = ([user_column] if per_user else []) + list(group_by)
+    if grouping:
+        statement = statement.group_by(*grouping)
+    return statement.order_by(user_column) if per_user else statement
+
+def _nutrition_statement(users, start, end, per_user=False):
+    """panel, key, count, calories, proteins, carbs, fats"""
+    return _select(DailyNutrition.user_id, users, per_user, [
+        literal("nutrition").label("panel"), null().label("key"), func.coalesce(func.sum(DailyNutrition.meals), 0).label("n"),
+        func.coalesce(func.sum(DailyNutrition.calories), 0).label("a"), func.coalesce(func.sum(DailyNutrition.proteins), 0).label("b"),
+        func.coalesce(func.sum(DailyNutrition.carbs), 0).label("c"), func.coalesce(func.sum(DailyNutrition.fats), 0).label("d"),
+    ]).where(DailyNutrition.day >= start, DailyNutrition.day < end)
+
+def _workout_statement(users, start, end, per_user=False):
+    """panel, intensity, sessions, minutes, calories burned"""
+    return _select(DailyWorkout.user_id, users, per_user, [
+        literal("workouts"), DailyWorkout.intensity, func.sum(DailyWorkout.sessions), func.sum(DailyWorkout.minutes),
+        func.sum(DailyWorkout.calories_burned), null(), null(),
+    ], [DailyWorkout.intensity]).where(DailyWorkout.day >= start, DailyWorkout.day < end)
+
+def _sleep_statement(users, start, end, per_user=False):
+    """panel, quality, nights, hours slept"""
+    return _select(DailySleep.user_id, users, per_user, [
+        literal("sleep"), DailySleep.quality, func.sum(DailySleep.nights), func.sum(DailySleep.hours), null(), null(), null(),
+    ], [DailySleep.quality]).where(DailySleep.day >= start, DailySleep.day < end)
+
+def _mood_statement(users, start, end, per_user=False):
+    """panel, mood, entries, summed stress level, entries with a stress level"""
+    return _select(DailyMood.user_id, users, per_user, [
+        literal("mood"), DailyMood.mood, func.sum(DailyMood.entries), func.sum(DailyMood.stress_total), func.sum(DailyMood.stress_entries), null(), null(),
+    ], [DailyMood.mood]).where(DailyMood.day >= start, DailyMood.day < end)
+
+def _build_nutrition(rows):
+    for _, _, meals, calories, proteins, carbs, fats in rows:
+        return NutritionSummary(meals, calories, proteins, carbs, fats)
+    return NutritionSummary()
+
+def _build_workouts(rows):
+    sessions, duration, calories = 0, 0, 0
+    intensities = set()
+    for _, intensity, count, minutes, burned, _, _ in rows:
+        sessions, duration, calories = sessions + count, duration + minutes, calories + burned
+        if intensity: # Rollups store a missing intensity as ''
+            intensities.add(intensity)
+    return WorkoutSummary(sessions, duration, calories, tuple(sorted(intensities)))
+
+def _build_sleep(rows):
+    quality_counts = dict.fromkeys(SLEEP_QUALITIES, 0)
+    nights, hours = 0, 0
+    for _, quality, count, slept, _, _, _ in rows:
+        if quality:
+            quality_counts[quality] = quality_counts.get(quality, 0) + count
+        nights, hours = nights + count, hours + (slept or 0)
+    return SleepOverview(quality_counts, nights, hours / nights if nights else None)
+
+def _build_mood(rows):
+    mood_counts = {}
+    entries, stress, rated = 0, 0, 0
+    for _, mood, count, stress_total, stress_count, _, _ in rows:
+        if mood:
+            mood_counts[mood] = count
+        entries, stress, rated = entries + count, stress + (stress_total or 0), rated + stress_count
+    return MoodTrends(mood_counts, entries, stress / rated if rated else None)
+
+def nutrition_summary(session, user_id, start, end):
+    """Total meals, calories and macros logged in [start, end)"""
+    return _build_nutrition(session.execute(_nutrition_statement(user_id, start, end)).all())
+
+def workout_summary(session, user_id, start, end):
+    """Workout sessions, minutes, calories burned and intensities in [start, end)"""
+    return _build_workouts(session.execute(_workout_statement(user_id, start, end)).all())
+
+def sleep_overview(session, user_id, start, end):
+    """Nights per sleep quality and average sleep duration for nights starting on days in [start, end)"""
+    return _build_sleep(session.execute(_sleep_statement(user_id, start, end)).all())
+
+def mood_trends(session, user_id, start, end):
+    """Entries per mood and average stress level in [start, end)"""
+    return _build_mood(session.execute(_mood_statement(user_id, start, end)).all())
+
+def dashboard(session, user_id, start, end):
+    """Every dashboard panel for a user, fetched with a single UNION ALL statement"""
+    statement = union_all(_nutrition_statement(user_id, start, end), _workout_statement(user_id, start, end),
+                          _sleep_statement(user_id, start, end), _mood_statement(user_id, start, end))
+    panels = {"nutrition": [], "workouts": [], "sleep": [], "mood": []}
+    for row in session.execute(statement):
+        panels[row[0]].append(tuple(row))
+    return Dashboard(_build_nutrition(panels["nutrition"]), _build_workouts(panels["workouts"]),
+                     _build_sleep(panels["sleep"]), _build_mood(panels["mood"]))
+
+_PANEL_STATEMENTS = {"nutrition": _nutrition_statement, "workouts": _workout_statement, "sleep": _sleep_statement, "mood": _mood_statement}
+
+class _UserRows:
+    """Cursor over rows ordered by user id that hands out the rows of one user at a time"""
+
+    def __init__(self, result):
+        self.rows = iter(result)
+        self.pending = next(self.rows, None)
+
+    def take(self, user_id):
+        """Rows of `user_id` without the leading user id column, skipping rows of earlier users"""
+        taken = []
+        while self.pending is not None and self.pending[0] <= user_id:
+            if self.pending[0] == user_id:
+                taken.append(tuple(self.pending[1:]))
+            self.pending = next(self.rows, None)
+        return taken
+
+def _merge_panels(connection, user_ids, users, start, end):
+    """Merge one grouped scan per log table into (user_id, Dashboard) pairs for `user_ids` in id order"""
+    streams = {panel: _UserRows(connection.execute(statement(users, start, end, per_user=True))) for panel, statement in _PANEL_STATEMENTS.items()}
+    for user_id in user_ids:
+        yield user_id, Dashboard(_build_nutrition(streams["nutrition"].take(user_id)), _build_workouts(streams["workouts"].take(user_id)),
+                                 _build_sleep(streams["sleep"].take(user_id)), _build_mood(streams["mood"].take(user_id)))
+
+def iter_user_summaries(session, start, end, user_ids=None, cohort=None, chunk_size=500):
+    """Yield (user_id, Dashboard) for many users in [start, end), ordered by user id.
+
+    Pass either a list of `user_ids` or a `Cohort`; with neither every user is summarized. Each log
+    table is read with one grouped scan (one per chunk of `chunk_size` ids when a list is given) and the
+    rows are streamed, so memory stays bounded however many users are reported. Users without any
+    logs in the window are yielded with empty summaries.
+    """
+    connection = session.connection() # Core results stream from the cursor instead of being buffered by the ORM
+    if user_ids is not None:
+        ids = sorted(set(user_ids))
+        for offset in range(0, len(ids), chunk_size): # Keeps the IN lists under SQLite's bound-parameter limit
+            chunk = ids[offset:offset + chunk_size]
+            yield from _merge_panels(connection, chunk, chunk, start, end)
+        return
+    users = (cohort or Cohort()).user_ids()
+    log_filter = users if cohort is not None else None # Without a cohort the scans need no user filter at all
+    yield from _merge_panels(connection, connection.execute(users).scalars(), log_filter, start, end)
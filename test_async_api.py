@@ -0,0 +1,62 @@
+import asyncio
+from datetime import date
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import Session
+from create import Base, NutritionLog, MoodLog
+from cache import SummaryCache
+from database import get_engine, get_async_engine
+import async_api
+import query_data
+import rollups
+import summaries
+
+MARCH = (date(2024, 3, 1), date(2024, 4, 1))
+
+@pytest.fixture
+def url(tmp_path, monkeypatch):
+    '''A file database with the async API's session factories pointed at it.'''
+    url = f"sqlite:///{tmp_path / 'async.db'}"
+    writer = get_engine(url)
+    Base.metadata.create_all(writer)
+    writer.dispose()
+    monkeypatch.setattr(query_data, "summary_cache", SummaryCache())
+    engines = [get_async_engine(url), get_async_engine(url, read_only=True)]
+    monkeypatch.setattr(async_api, "WriteSession", async_sessionmaker(engines[0], expire_on_commit=False))
+    monkeypatch.setattr(async_api, "ReadSession", async_sessionmaker(engines[1], expire_on_commit=False))
+    yield url
+    for engine in engines:
+        asyncio.run(engine.dispose())
+
+def test_async_writes_match_the_synchronous_reports(url):
+    '''The concurrently gathered dashboard equals the synchronous one, and writes keep the rollups exact.'''
+    async def scenario():
+        user_id = await async_api.register_user_with_goals({"name": "Ada Async", "email": "ada@example.com"},
+                                                           [{"goal": "Swim weekly", "target_date": date(2024, 6, 1)}])
+        goals = await async_api.get_user_fitness_goals(user_id)
+        assert await async_api.log_workout_and_update_goals(user_id, {"date": date(2024, 3, 4), "duration": 45, "intensity": "High"}, {goals[0].id: True})
+        await async_api.log_entries([NutritionLog(user_id=user_id, date=date(2024, 3, 4), meal_type="Lunch", calories=650, proteins=30, carbs=70, fats=20),
+                                     MoodLog(user_id=user_id, date=date(2024, 3, 5), mood="Calm", stress_level=3)])
+        progress = await async_api.get_progress_towards_fitness_goals(user_id)
+        return user_id, progress, await async_api.get_dashboard(user_id, *MARCH)
+
+    user_id, progress, dashboard = asyncio.run(scenario())
+    assert progress == [("Swim weekly", "Completed", date(2024, 6, 1))]
+    engine = get_engine(url)
+    with Session(engine) as session:
+        assert dashboard == summaries.dashboard(session, user_id, *MARCH)
+        assert rollups.check(session.connection()) == []
+    engine.dispose()
+    assert dashboard.workouts.total_duration == 45 and dashboard.nutrition.calories == 650 and dashboard.mood.entries == 1
+
+def test_async_writes_invalidate_cached_summaries(url):
+    '''A workout logged through the async API is visible in the next cached monthly summary.'''
+    async def scenario():
+        user_id = await async_api.register_user_with_goals({"name": "Cy Cached", "email": "cy@example.com"}, [])
+        before = await async_api.get_monthly_workout_summary(user_id, 3, 2024)
+        await async_api.log_workout_and_update_goals(user_id, {"date": date(2024, 3, 9), "duration": 30, "intensity": "Low"}, {})
+        return before, await async_api.get_monthly_workout_summary(user_id, 3, 2024)
+
+    before, after = asyncio.run(scenario())
+    assert before.sessions == 0
+    assert after.sessions == 1 and after.intensities == ("Low",)
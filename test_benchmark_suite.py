@@ -0,0 +1,59 @@
+import contextlib
+import io
+import itertools
+import random
+from datetime import date
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, FitnessGoal
+from database import get_engine
+from benchmark_suite import compare, calibrate, run_phase, _arguments
+import insert_data
+
+def run(calibration_ms=100.0, **phases):
+    defaults = {'p50_ms': 10.0, 'throughput': 100.0, 'statements_per_call': 2.0, 'peak_kib': 100.0, 'calibration_ms': calibration_ms}
+    return {'results': {'1': {name: {'warm': dict(defaults, **metrics)} for name, metrics in phases.items()}}}
+
+def flagged(baseline, current, threshold, memory_threshold=None):
+    return {(name, metric) for _, name, _, metric, _, _ in compare(baseline, current, threshold, memory_threshold)}
+
+def test_compare_flags_regressions_beyond_the_threshold():
+    '''Latency must regress with throughput; statements and memory are compared on their own.'''
+    baseline = run(fast={}, queries={}, memory={}, steady={})
+    current = run(fast={'p50_ms': 14.0, 'throughput': 70.0}, queries={'statements_per_call': 3.0},
+                  memory={'peak_kib': 300.0}, steady={'p50_ms': 11.0, 'throughput': 95.0})
+    assert flagged(baseline, current, 0.25) == {('fast', 'p50_ms'), ('fast', 'throughput'), ('queries', 'statements_per_call'), ('memory', 'peak_kib')}
+    assert ('memory', 'peak_kib') not in flagged(baseline, current, 0.25, memory_threshold=5)
+
+def test_compare_discounts_a_slower_machine():
+    '''A machine that runs the calibration workload slower is discounted, up to MAX_DRIFT; new cases are not compared.'''
+    baseline = run(**{name: {} for name in 'abc'})
+    current = run(calibration_ms=160.0, **{name: {'p50_ms': 16.0, 'throughput': 62.5} for name in 'abc'}, d={'p50_ms': 99.0})
+    assert compare(baseline, current, 0.25) == []
+    current = run(calibration_ms=400.0, **{name: {'p50_ms': 40.0, 'throughput': 25.0} for name in 'abc'})
+    assert len(compare(baseline, current, 0.25)) == 6 # A fourfold slowdown is more than drift
+    assert calibrate(rounds=1) > 0
+
+def test_compare_flags_a_change_that_slows_every_phase():
+    '''Uniformly slower phases on an unchanged machine are a regression, not drift.'''
+    baseline = run(**{name: {} for name in 'abc'})
+    current = run(**{name: {'p50_ms': 20.0, 'throughput': 50.0} for name in 'abc'})
+    assert flagged(baseline, current, 0.25) == {(name, metric) for name in 'abc' for metric in ('p50_ms', 'throughput')}
+
+def test_sampled_goal_updates_reach_the_ingest_path(monkeypatch):
+    '''The sampled goal_updates are passed to log_workout_and_update_goals, so its goal SELECT and UPDATE are measured.'''
+    engine = get_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    factory = sessionmaker(bind=engine, expire_on_commit=False)
+    with factory() as session:
+        session.add_all([User(id=1, name="Bo Bench", email="bo@example.com"), FitnessGoal(id=1, user_id=1, goal="Run a 10k", target_date=date(2024, 12, 31))])
+        session.commit()
+    monkeypatch.setattr(insert_data, "DBSession", factory)
+    values = _arguments(random.Random(0), 1, 1, itertools.count())
+    assert values['goal_updates'] == {1: True}
+    with contextlib.redirect_stdout(io.StringIO()):
+        without_goals = run_phase(insert_data.log_workout_and_update_goals, [dict(values, goal_updates={})])
+        with_goals = run_phase(insert_data.log_workout_and_update_goals, [values])
+    assert with_goals['statements_per_call'] == without_goals['statements_per_call'] + 2 # The goal's SELECT and its status UPDATE
+    with factory() as session:
+        assert session.get(FitnessGoal, 1).completed
+    engine.dispose()
@@ -0,0 +1,34 @@
+from datetime import date, datetime
+from sqlalchemy import create_engine, select, text
+from sqlalchemy.orm import Session
+from create import SleepRecord, User
+import bulk_data
+
+def dump(engine):
+    '''Return every generated row so two databases can be compared.'''
+    with engine.connect() as connection:
+        return {table: connection.execute(text(f"SELECT * FROM {table} ORDER BY id")).all() for table in ['users', 'fitness_goals'] + bulk_data.LOG_TABLES}
+
+def test_generate_is_deterministic_across_workers(tmp_path):
+    '''The same seed gives the same rows whether partitions are built in one or several processes.'''
+    serial = create_engine(f"sqlite:///{tmp_path / 'serial.db'}")
+    parallel = create_engine(f"sqlite:///{tmp_path / 'parallel.db'}")
+    arguments = dict(users=30, log_rows=2400, seed=7, anchor=date(2024, 6, 30), partition_rows=500)
+    counts = bulk_data.generate(serial, workers=1, **arguments)
+    bulk_data.generate(parallel, workers=2, **arguments)
+
+    assert counts['users'] == 30
+    assert sum(counts[table] for table in bulk_data.LOG_TABLES) == 2400
+    assert dump(serial) == dump(parallel)
+
+def test_generated_rows_load_through_the_orm(tmp_path):
+    '''Rows written with executemany use the same storage format as the ORM models.'''
+    engine = create_engine(f"sqlite:///{tmp_path / 'load.db'}")
+    bulk_data.generate(engine, users=5, log_rows=200, seed=1, anchor=date(2024, 6, 30))
+
+    with Session(engine) as session:
+        record = session.scalars(select(SleepRecord)).first()
+        assert isinstance(record.start_time, datetime)
+        assert record.end_time > record.start_time
+        assert record.duration_hours == (record.end_time - record.start_time).total_seconds() / 3600
+        assert session.scalar(select(User).where(User.email == "user5@example.com")) is not None
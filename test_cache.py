@@ -0,0 +1,76 @@
+import pytest
+from datetime import date
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, Workout, MoodLog
+from cache import SummaryCache, SharedCacheBackend
+import summaries
+
+WINDOW = (date(2024, 3, 1), date(2024, 4, 1))
+
+@pytest.fixture
+def session():
+    '''A fresh in-memory database with two users.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all([User(id=1, name="Cora Cache", email="cora@example.com"), User(id=2, name="Finn Fresh", email="finn@example.com")])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def cached_workouts(summary_cache, session, user_id):
+    return summary_cache.get_or_compute("workout_summary", user_id, WINDOW, ("workouts",),
+                                        lambda: summaries.workout_summary(session, user_id, *WINDOW))
+
+def test_writes_invalidate_only_the_touched_user_and_table(session):
+    '''A workout for user 1 drops user 1's workout summary and nothing else.'''
+    summary_cache = SummaryCache()
+    cached_workouts(summary_cache, session, 1)
+    cached_workouts(summary_cache, session, 2)
+    summary_cache.get_or_compute("mood_trends", 1, WINDOW, ("mood_logs",), lambda: summaries.mood_trends(session, 1, *WINDOW))
+    assert cached_workouts(summary_cache, session, 1).sessions == 0
+    assert summary_cache.stats()["hits"] == 1
+
+    session.add(Workout(user_id=1, date=date(2024, 3, 5), duration=40, intensity="High"))
+    session.commit()
+
+    assert cached_workouts(summary_cache, session, 1).sessions == 1
+    stats = summary_cache.stats()
+    assert (stats["misses"], stats["invalidations"], stats["size"]) == (4, 1, 3)
+    cached_workouts(summary_cache, session, 2)
+    summary_cache.get_or_compute("mood_trends", 1, WINDOW, ("mood_logs",), lambda: pytest.fail("mood summary should still be cached"))
+
+def test_rollback_invalidates_results_read_after_the_flush(session):
+    '''A result computed from flushed but rolled-back rows is not served afterwards.'''
+    summary_cache = SummaryCache()
+    session.add(MoodLog(user_id=1, date=date(2024, 3, 5), mood="Happy"))
+    session.flush()
+    compute = lambda: summaries.mood_trends(session, 1, *WINDOW)
+    assert summary_cache.get_or_compute("mood_trends", 1, WINDOW, ("mood_logs",), compute).entries == 1
+    session.rollback()
+    assert summary_cache.get_or_compute("mood_trends", 1, WINDOW, ("mood_logs",), compute).entries == 0
+
+def test_lru_eviction_and_ttl():
+    '''The cache holds at most max_entries and forgets entries after ttl seconds.'''
+    now = [0.0]
+    summary_cache = SummaryCache(max_entries=2, ttl=10, clock=lambda: now[0])
+    for user_id in (1, 2, 1, 3): # User 1 is used again, so user 2 is the least recently used
+        summary_cache.get_or_compute("summary", user_id, WINDOW, ("workouts",), lambda: user_id)
+    assert summary_cache.stats()["evictions"] == 1
+    assert summary_cache.get_or_compute("summary", 1, WINDOW, ("workouts",), lambda: "recomputed") == 1
+    assert summary_cache.get_or_compute("summary", 2, WINDOW, ("workouts",), lambda: "recomputed") == "recomputed"
+
+    now[0] = 11.0
+    assert summary_cache.get_or_compute("summary", 1, WINDOW, ("workouts",), lambda: "expired") == "expired"
+
+def test_shared_backend_is_reused_and_invalidated_across_caches(tmp_path):
+    '''Two caches standing in for two processes share results and invalidations through one file.'''
+    first = SummaryCache(shared=SharedCacheBackend(str(tmp_path / "cache.db")))
+    second = SummaryCache(shared=SharedCacheBackend(str(tmp_path / "cache.db")))
+    assert first.get_or_compute("summary", 1, WINDOW, ("sleep_records",), lambda: "computed once") == "computed once"
+    assert second.get_or_compute("summary", 1, WINDOW, ("sleep_records",), lambda: pytest.fail("should be shared")) == "computed once"
+
+    first.invalidate(1, ("sleep_records",))
+    assert second.get_or_compute("summary", 1, WINDOW, ("sleep_records",), lambda: "recomputed") == "recomputed"
@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+import database
+
+def test_settings_precedence(tmp_path, monkeypatch):
+    '''Environment variables override the config file, which overrides the defaults.'''
+    config = tmp_path / "app.ini"
+    config.write_text("[database]\nurl = sqlite:///from_file.db\nmmap_size = 0\nbusy_timeout_ms = 100\n")
+    monkeypatch.setenv("HEALTH_APP_CONFIG", str(config))
+    monkeypatch.setenv("HEALTH_APP_BUSY_TIMEOUT_MS", "250")
+
+    settings = database.load_settings()
+    assert settings["url"] == "sqlite:///from_file.db"
+    assert settings["mmap_size"] == "0"
+    assert settings["busy_timeout_ms"] == "250"
+    assert settings["synchronous"] == database.DEFAULT_SETTINGS["synchronous"]
+
+def test_writer_and_read_only_engines(tmp_path, monkeypatch):
+    '''The writer enables WAL and the tuned pragmas; the read-only pool cannot write.'''
+    monkeypatch.setenv("HEALTH_APP_CONFIG", str(tmp_path / "missing.ini"))
+    url = f"sqlite:///{tmp_path / 'app.db'}"
+    writer, reader = database.get_engine(url), database.get_engine(url, read_only=True)
+    with writer.begin() as connection:
+        assert connection.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert connection.execute(text("PRAGMA synchronous")).scalar() == 1 # NORMAL
+        assert connection.execute(text("PRAGMA temp_store")).scalar() == 2 # MEMORY
+        connection.execute(text("CREATE TABLE notes (body TEXT)"))
+        connection.execute(text("INSERT INTO notes VALUES ('written')"))
+
+    with reader.connect() as connection:
+        assert connection.execute(text("SELECT body FROM notes")).scalar() == "written"
+        assert connection.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        with pytest.raises(OperationalError):
+            connection.execute(text("INSERT INTO notes VALUES ('rejected')"))
+    writer.dispose()
+    reader.dispose()
+
+def test_async_engines_share_the_tuning(tmp_path, monkeypatch):
+    '''The aiosqlite engines get the same pragmas, and the read-only one cannot write.'''
+    monkeypatch.setenv("HEALTH_APP_CONFIG", str(tmp_path / "missing.ini"))
+    url = f"sqlite:///{tmp_path / 'app.db'}"
+
+    async def scenario():
+        writer, reader = database.get_async_engine(url), database.get_async_engine(url, read_only=True)
+        async with writer.begin() as connection:
+            assert (await connection.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+            await connection.execute(text("CREATE TABLE notes (body TEXT)"))
+        async with reader.connect() as connection:
+            assert (await connection.execute(text("PRAGMA query_only"))).scalar() == 1
+            with pytest.raises(OperationalError):
+                await connection.execute(text("INSERT INTO notes VALUES ('rejected')"))
+        await writer.dispose()
+        await reader.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,81 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import event, update
+from sqlalchemy.orm import sessionmaker
+from database import get_engine
+from create import Base, User, FitnessGoal, Workout, NutritionLog, SleepRecord
+import rollups
+import goal_progress
+
+@pytest.fixture
+def session():
+    '''A fresh in-memory database with one user who worked out before setting any measurable goal.'''
+    engine = get_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    session.add(User(id=1, name="Gale Goal", email="gale@example.com"))
+    session.add_all([Workout(user_id=1, date=date(2024, 2, 28), duration=90), Workout(user_id=1, date=date(2024, 3, 2), duration=60)])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def test_counters_follow_every_write_without_rescanning(session):
+    '''New goals are seeded from the rollups; later writes move only the goals whose window holds the day.'''
+    minutes = FitnessGoal(user_id=1, goal="Train 3 hours", metric="workout_minutes", target=180, start_date=date(2024, 3, 1), target_date=date(2024, 3, 31))
+    later = FitnessGoal(user_id=1, goal="Train in April", metric="workout_minutes", target=60, start_date=date(2024, 4, 1), target_date=date(2024, 4, 30))
+    manual = FitnessGoal(user_id=1, goal="Learn to swim")
+    session.add_all([minutes, later, manual])
+    session.commit()
+    assert (minutes.progress, minutes.progress_count, minutes.completed) == (60, 1, False) # The February workout is outside the window
+
+    statements = []
+    event.listen(session.get_bind(), 'before_cursor_execute', lambda conn, cursor, statement, *args: statements.append(statement))
+    workout = Workout(user_id=1, date=date(2024, 3, 10), duration=120)
+    session.add(workout)
+    session.commit()
+    assert not any(statement.startswith("SELECT") and "workouts" in statement for statement in statements) # Counted, not recomputed
+    assert (minutes.progress, minutes.progress_count, minutes.completed) == (180, 2, True)
+    assert (later.progress, later.completed) == (0, False)
+    assert goal_progress.evaluate(minutes, date(2024, 3, 10)).status == goal_progress.ACHIEVED
+    assert goal_progress.evaluate(manual) is None
+
+    workout.date = date(2024, 4, 2) # Moves the minutes to the April goal
+    session.commit()
+    assert (minutes.progress, minutes.completed, later.progress, later.completed) == (60, False, 120, True)
+    session.delete(workout)
+    session.commit()
+    assert (later.progress, later.progress_count, later.completed) == (0, 0, False)
+    assert goal_progress.check(session.connection()) == []
+
+def test_averages_are_decided_when_the_window_closes(session):
+    '''Calorie ceilings average over the days with meals logged, sleep floors over the nights logged.'''
+    calories = FitnessGoal(user_id=1, goal="Eat lighter", metric="daily_calories", target=2000, start_date=date(2024, 3, 1), target_date=date(2024, 3, 4))
+    sleep = FitnessGoal(user_id=1, goal="Sleep 8 hours", metric="sleep_hours", target=8, start_date=date(2024, 3, 1), target_date=date(2024, 3, 4))
+    snack = NutritionLog(user_id=1, date=date(2024, 3, 2), calories=1000)
+    session.add_all([calories, sleep, snack,
+                     NutritionLog(user_id=1, date=date(2024, 3, 1), calories=1500), NutritionLog(user_id=1, date=date(2024, 3, 2), calories=2000),
+                     SleepRecord(user_id=1, start_time=datetime(2024, 3, 1, 22), end_time=datetime(2024, 3, 2, 7)),
+                     SleepRecord(user_id=1, start_time=datetime(2024, 3, 2, 23), end_time=datetime(2024, 3, 3, 6))])
+    session.commit()
+    assert (calories.progress, calories.progress_count) == (4500, 2) # Three meals on two days
+    progress = goal_progress.evaluate(calories, date(2024, 3, 2))
+    assert (progress.value, progress.status) == (2250, goal_progress.BEHIND)
+    assert goal_progress.evaluate(calories, date(2024, 3, 10)).status == goal_progress.MISSED # Days 3 and 4 went unlogged, not fasted
+    session.delete(snack)
+    session.commit()
+    assert (calories.progress, calories.progress_count) == (3500, 2) # March 2 still has a meal
+    assert goal_progress.evaluate(calories, date(2024, 3, 10)).status == goal_progress.ACHIEVED # 1750 calories a day
+    assert goal_progress.evaluate(sleep, date(2024, 3, 3)).value == 8
+    assert goal_progress.evaluate(sleep, date(2024, 2, 1)).status == goal_progress.NOT_STARTED
+
+    session.execute(update(FitnessGoal).values(progress=0, progress_count=0)) # Counters lost, e.g. after a restore
+    assert len(goal_progress.check(session.connection())) == 2
+    goal_progress.rebuild(session.connection())
+    assert goal_progress.check(session.connection()) == []
+    session.commit()
+    assert (sleep.progress, sleep.progress_count, calories.progress, calories.progress_count) == (16, 2, 3500, 2)
+
+    with pytest.raises(ValueError):
+        session.add(FitnessGoal(user_id=1, goal="Lift more", metric="kilograms_lifted", target=100, target_date=date(2024, 3, 31)))
+        session.flush()
@@ -0,0 +1,110 @@
+import queue
+import threading
+from datetime import date, datetime
+import pytest
+from sqlalchemy import event, func, select
+from sqlalchemy.orm import Session
+from create import Base, User, FitnessGoal, Workout, NutritionLog, SleepRecord
+from cache import SummaryCache
+from database import get_engine
+from ingest import IngestQueue
+import rollups
+import goal_progress
+import summaries
+
+MARCH = (date(2024, 3, 1), date(2024, 4, 1))
+
+@pytest.fixture
+def engine(tmp_path):
+    '''A file database with two users, one goal each and a measurable goal of the first.'''
+    engine = get_engine(f"sqlite:///{tmp_path / 'ingest.db'}")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        session.add_all([User(id=1, name="Wes Wearable", email="wes@example.com"), User(id=2, name="Bea Band", email="bea@example.com"),
+                         FitnessGoal(id=10, user_id=1, goal="Run daily"), FitnessGoal(id=20, user_id=2, goal="Sleep more"),
+                         FitnessGoal(id=11, user_id=1, goal="Train 10 hours", metric="workout_minutes", target=600,
+                                     start_date=date(2024, 3, 1), target_date=date(2024, 3, 31))])
+        session.commit()
+    yield engine
+    engine.dispose()
+
+def test_events_are_coalesced_into_batched_statements(engine):
+    '''200 events become one batch: one executemany per table, one goal UPDATE, and exact rollups.'''
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, statement, *args: statements.append(statement))
+    summary_cache = SummaryCache()
+    with Session(engine) as session:
+        summary_cache.get_or_compute("workout_summary", 1, MARCH, ("workouts",), lambda: summaries.workout_summary(session, 1, *MARCH))
+
+    with IngestQueue(engine, batch_size=1000, max_latency=1.0) as ingest:
+        for day in range(1, 26):
+            for user_id in (1, 2):
+                ingest.log_workout_and_update_goals(user_id, {"date": date(2024, 3, day), "duration": 30, "intensity": "High"}, {})
+                ingest.submit(NutritionLog, {"user_id": user_id, "date": date(2024, 3, day), "calories": 500})
+                ingest.submit(SleepRecord, {"user_id": user_id, "start_time": datetime(2024, 3, day, 23), "end_time": datetime(2024, 3, day + 1, 7)})
+        ingest.update_goal(1, 10, True)
+        ingest.update_goal(2, 10, False) # Goal 10 belongs to user 1, so this change is ignored
+        ingest.update_goal(2, 20, True)
+        ingest.update_goal(2, 20, False) # The last change wins
+    stats = ingest.stats()
+
+    assert stats["written"] == 154 and stats["batches"] == 1 and stats["failed"] == 0
+    assert sum(statement.startswith("INSERT INTO workouts") for statement in statements) == 1
+    assert sum(statement.startswith("UPDATE fitness_goals SET completed") for statement in statements) == 1
+    counter_updates, rollup_table = {}, None
+    for statement in statements:
+        if statement.startswith("INSERT INTO daily_"): # The rollup upsert, after which the goals fed by that table are updated
+            rollup_table = statement.split()[2]
+        elif statement.startswith("UPDATE fitness_goals SET progress"):
+            counter_updates[rollup_table] = counter_updates.get(rollup_table, 0) + 1
+    tracked = {"workout_minutes"} # The only measurable goal; the other metrics have no goal to update
+    expected = {}
+    for model in (Workout, NutritionLog, SleepRecord):
+        table = rollups.ROLLUPS[model].table
+        metrics = [name for name, target in goal_progress.TARGETS.items() if target.table is table and name in tracked]
+        if metrics:
+            expected[table.name] = len(metrics) # One executemany per metric with a goal
+    assert counter_updates == expected
+    with Session(engine) as session:
+        assert session.scalar(select(func.count()).select_from(Workout)) == 50
+        assert dict(session.execute(select(FitnessGoal.id, FitnessGoal.completed)).all()) == {10: True, 11: True, 20: False}
+        assert session.get(FitnessGoal, 11).progress == 750
+        assert goal_progress.check(session.connection()) == []
+        assert rollups.check(session.connection()) == []
+        cached = summary_cache.get_or_compute("workout_summary", 1, MARCH, ("workouts",), lambda: summaries.workout_summary(session, 1, *MARCH))
+    assert cached.sessions == 25 # The batch invalidated the summary cached before it
+
+def test_failing_events_are_isolated(engine):
+    '''An invalid event is dead-lettered while the rest of its batch is written.'''
+    with IngestQueue(engine, max_latency=1.0) as ingest:
+        for day in range(1, 9):
+            ingest.submit(Workout, {"user_id": 1, "date": date(2024, 3, day), "duration": 30})
+        ingest.submit(NutritionLog, {"user_id": 1, "date": None, "calories": 500}) # date is NOT NULL
+    stats = ingest.stats()
+
+    assert stats["written"] == 8 and stats["failed"] == 1 and stats["retries"] >= 1
+    assert ingest.dead_letters[0][0] == (NutritionLog, {"user_id": 1, "date": None, "calories": 500})
+    with Session(engine) as session:
+        assert session.scalar(select(func.count()).select_from(Workout)) == 8
+        assert rollups.check(session.connection()) == []
+
+def test_full_queue_pushes_back(engine):
+    '''submit() blocks while the writer is busy and the queue is full, and raises once its timeout expires.'''
+    writing = threading.Event()
+    release = threading.Event()
+
+    def stall(*args):
+        writing.set()
+        release.wait()
+    event.listen(engine, "before_cursor_execute", stall)
+
+    ingest = IngestQueue(engine, batch_size=1, max_latency=0, max_pending=2)
+    ingest.submit(Workout, {"user_id": 1, "date": date(2024, 3, 1)})
+    writing.wait()
+    ingest.submit(Workout, {"user_id": 1, "date": date(2024, 3, 2)})
+    ingest.submit(Workout, {"user_id": 1, "date": date(2024, 3, 3)})
+    with pytest.raises(queue.Full):
+        ingest.submit(Workout, {"user_id": 1, "date": date(2024, 3, 4)}, timeout=0.05)
+    release.set()
+    ingest.close()
+    assert ingest.stats()["written"] == 3
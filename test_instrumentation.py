@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import urllib.request
+from datetime import date
+import pytest
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+from create import Base, Workout
+from database import get_engine, get_async_engine, async_session_scope
+from cache import SummaryCache
+import instrumentation
+import insert_data
+import query_data
+
+@pytest.fixture
+def database(monkeypatch):
+    '''Point insert_data and query_data at a fresh in-memory database and start with no measurements.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(insert_data, "DBSession", Session)
+    monkeypatch.setattr(query_data, "Session", Session)
+    monkeypatch.setattr(query_data, "summary_cache", SummaryCache())
+    instrumentation.reset()
+    yield engine
+    instrumentation.reset()
+    engine.dispose()
+
+def register(goals):
+    return insert_data.register_user_with_goals({"name": "Ira Instrumented", "email": "ira@example.com"},
+                                                [{"goal": f"Goal {index}", "target_date": date(2024, 12, 31)} for index in range(goals)])
+
+def function(name):
+    return instrumentation.snapshot()['functions'][name]
+
+def test_statements_and_rows_per_call(database):
+    '''Statement counts expose the per-goal SELECT; rows read count for the generator and its caller.'''
+    user_id = register(3)
+    insert_data.log_workout_and_update_goals(user_id, {"date": date(2024, 3, 1), "duration": 30}, {1: True})
+    insert_data.log_workout_and_update_goals(user_id, {"date": date(2024, 3, 2), "duration": 30}, {1: True, 2: True, 3: True})
+    logged = function('insert_data.log_workout_and_update_goals')
+    assert logged['calls'] == 2 and logged['errors'] == 0
+    assert logged['statements']['max'] - logged['statements']['min'] >= 2 # One SELECT per goal id
+    assert logged['rows_written']['max'] >= 4 # The workout and three goals, besides the rollup rows
+    assert function('insert_data.register_user_with_goals')['rows_written']['sum'] >= 4
+
+    query_data.get_user_workouts(user_id)
+    assert function('query_data.iter_user_workouts')['rows_read']['sum'] == 2
+    outer = function('query_data.get_user_workouts')
+    assert outer['rows_read']['sum'] == 2 and outer['statements']['sum'] >= 1
+    assert outer['seconds']['count'] == 1 and outer['seconds']['sum'] >= outer['sql_seconds']['sum']
+
+def test_slow_queries_are_logged_with_their_plan(database, caplog):
+    '''Statements over the threshold are logged and kept with EXPLAIN QUERY PLAN.'''
+    user_id = register(1)
+    instrumentation.set_slow_query_threshold(0)
+    try:
+        with caplog.at_level(logging.WARNING, logger='health_app.slow_queries'):
+            query_data.get_user_workouts(user_id)
+    finally:
+        instrumentation.set_slow_query_threshold(100)
+    slow = instrumentation.snapshot()['slow_queries']
+    assert slow['count'] >= 1
+    select = next(entry for entry in slow['recent'] if entry['statement'].startswith('SELECT workouts'))
+    assert any('workouts' in step for step in select['plan'])
+    assert 'Slow query' in caplog.text
+
+def test_slow_query_plans_are_not_counted_as_rows_read(database):
+    '''The EXPLAIN QUERY PLAN rows of a slow statement stay out of the caller's rows read.'''
+    user_id = register(1)
+    insert_data.log_workout_and_update_goals(user_id, {"date": date(2024, 3, 1), "duration": 30}, {})
+    instrumentation.reset()
+    instrumentation.set_slow_query_threshold(0)
+    try:
+        query_data.get_user_workouts(user_id)
+    finally:
+        instrumentation.set_slow_query_threshold(100)
+    assert instrumentation.snapshot()['slow_queries']['count'] >= 1
+    assert function('query_data.get_user_workouts')['rows_read']['sum'] == 1
+
+def test_failing_statements_leave_no_timing_state(database):
+    '''A statement that raises does not leave its start time on the connection for the next one.'''
+    with database.connect() as connection:
+        with pytest.raises(Exception):
+            connection.exec_driver_sql("SELECT * FROM no_such_table")
+        connection.exec_driver_sql("SELECT 1")
+        assert not any(key.startswith('instrumentation') for key in connection.info)
+
+def test_slow_queries_on_the_async_driver(tmp_path, caplog):
+    '''The plan is read on aiosqlite connections too, instead of failing the statement.'''
+    url = f"sqlite:///{tmp_path / 'slow.db'}"
+    writer = get_engine(url)
+    Base.metadata.create_all(writer)
+    writer.dispose()
+
+    async def query():
+        engine = get_async_engine(url)
+        try:
+            async with async_session_scope(async_sessionmaker(engine)) as session:
+                return (await session.scalars(select(Workout).where(Workout.user_id == 1))).all()
+        finally:
+            await engine.dispose()
+
+    instrumentation.reset()
+    instrumentation.set_slow_query_threshold(0)
+    try:
+        with caplog.at_level(logging.WARNING, logger='health_app.slow_queries'):
+            assert asyncio.run(query()) == []
+    finally:
+        instrumentation.set_slow_query_threshold(100)
+    select_entry = next(entry for entry in instrumentation.snapshot()['slow_queries']['recent'] if entry['statement'].startswith('SELECT workouts'))
+    assert any('workouts' in step for step in select_entry['plan'])
+    instrumentation.reset()
+
+def test_exports_and_profiling(database, tmp_path):
+    '''JSON, Prometheus text, the HTTP endpoint and opt-in cProfile stats.'''
+    user_id = register(1)
+    instrumentation.enable_profiling('query_data.get_user_workouts')
+    try:
+        query_data.get_user_workouts(user_id)
+    finally:
+        instrumentation.disable_profiling()
+    assert instrumentation.profile_stats('query_data.get_user_workouts').total_calls > 0
+    assert instrumentation.profile_stats('insert_data.register_user_with_goals') is None
+
+    text = instrumentation.to_prometheus()
+    assert '# TYPE health_app_function_seconds histogram' in text
+    assert 'health_app_function_seconds_count{function="query_data.get_user_workouts"} 1' in text
+    assert 'health_app_function_statements_bucket{function="query_data.get_user_workouts",le="+Inf"} 1' in text
+    instrumentation.write(tmp_path / 'metrics.json')
+    assert json.loads((tmp_path / 'metrics.json').read_text())['functions']['query_data.get_user_workouts']['calls'] == 1
+
+    server = instrumentation.serve(port=0)
+    try:
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_port}/metrics') as response:
+            assert 'health_app_slow_queries_total' in response.read().decode()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def test_histogram_quantiles():
+    '''Quantiles interpolate inside buckets and stay within the observed range.'''
+    histogram = instrumentation.Histogram((1, 2, 5))
+    for value in (0.5, 1.5, 1.5, 4, 9):
+        histogram.observe(value)
+    summary = histogram.summary()
+    assert summary['buckets'] == {'1': 1, '2': 3, '5': 4, '+Inf': 5}
+    assert summary['min'] == 0.5 and summary['max'] == 9
+    assert 1 <= histogram.quantile(0.5) <= 2
+    assert histogram.quantile(1) == 9
@@ -0,0 +1,67 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from database import get_engine
+from create import Base, User, Workout, SleepRecord
+import leaderboards
+
+DAY = date(2024, 3, 6) # A Wednesday; its week starts on March 4
+
+@pytest.fixture
+def engine():
+    '''Ten users across two age bands and both genders, each with one workout on DAY; four of them slept.'''
+    engine = get_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with Session(engine) as session:
+        for user_id in range(1, 11):
+            session.add(User(id=user_id, name=f"User {user_id}", email=f"user{user_id}@example.com",
+                             age=None if user_id == 10 else 30 + user_id % 2 * 10, gender="Female" if user_id <= 5 else "Male"))
+            session.add(Workout(user_id=user_id, date=DAY, duration=10 * user_id))
+        for user_id, hours in ((1, 6), (2, 8), (3, 8), (4, 5)):
+            session.add(SleepRecord(user_id=user_id, start_time=datetime(2024, 3, 5, 23), end_time=datetime(2024, 3, 5 + (23 + hours) // 24, (23 + hours) % 24)))
+        session.commit()
+    yield engine
+    engine.dispose()
+
+def test_rankings_and_percentiles_per_cohort(engine):
+    '''RANK and CUME_DIST within each cohort; users without sleep are left off the average-sleep board.'''
+    counts = leaderboards.refresh_all(engine, DAY)
+    assert counts[('workout_minutes', 'week')] == 10 and counts[('sleep_hours', 'month')] == 4
+    with Session(engine) as session:
+        ranks = {(ranking.metric, ranking.cohort): ranking for ranking in leaderboards.user_rankings(session, 7, day=date(2024, 3, 10))}
+        assert leaderboards.cohorts_of(47, "Male") == ['all', 'age:40-49', 'gender:Male', 'age:40-49/gender:Male']
+        minutes = {cohort: (ranking.rank, ranking.cohort_size, ranking.top_percent) for (metric, cohort), ranking in ranks.items() if metric == 'workout_minutes'}
+        assert minutes == {'all': (4, 10, 40), 'age:40-49': (2, 5, 40), 'gender:Male': (4, 5, 80), 'age:40-49/gender:Male': (2, 2, 100)}
+        assert ('sleep_hours', 'all') not in ranks
+
+        sleepers = leaderboards.top(session, 'sleep_hours', 'week', day=DAY)
+        assert [(ranking.user_id, ranking.rank) for ranking in sleepers] == [(2, 1), (3, 1), (1, 3), (4, 4)] # Ties share a rank
+        assert [ranking.user_id for ranking in leaderboards.top(session, 'workout_minutes', 'month', 'age:40-49/gender:Female', k=2, day=DAY)] == [5, 3]
+
+def test_refresh_replaces_the_snapshot_and_lookups_use_the_indexes(engine):
+    '''A refresh after new activity updates the period in place; lookups are index searches.'''
+    leaderboards.refresh_all(engine, DAY, metrics=['workout_minutes'], periods=['week'])
+    with Session(engine) as session:
+        session.add(Workout(user_id=1, date=DAY, duration=500))
+        session.commit()
+    leaderboards.refresh_all(engine, DAY, metrics=['workout_minutes'], periods=['week'])
+    with Session(engine) as session:
+        assert [(ranking.user_id, ranking.value) for ranking in leaderboards.top(session, 'workout_minutes', k=1, day=DAY)] == [(1, 510)]
+        assert session.execute(text("SELECT count(*) FROM leaderboard_entries WHERE cohort = 'all'")).scalar() == 10
+        for query in ("SELECT * FROM leaderboard_entries WHERE user_id = 1 AND period = 'week' AND period_start = '2024-03-04' "
+                      "AND metric IN ('workout_minutes') ORDER BY metric, cohort",
+                      "SELECT * FROM leaderboard_entries WHERE metric = 'workout_minutes' AND period = 'week' AND period_start = '2024-03-04' "
+                      "AND cohort = 'all' ORDER BY rank, user_id LIMIT 10"):
+            plan = [row[3] for row in session.execute(text("EXPLAIN QUERY PLAN " + query))]
+            assert any("USING INDEX ix_leaderboard_entries_" in step for step in plan) and not any("TEMP B-TREE" in step for step in plan)
+
+def test_rank_matches_the_window_functions(engine):
+    '''rank(), which merges sharded leaderboards, agrees with RANK and CUME_DIST, ties included.'''
+    start, end = leaderboards.period_window('week', DAY)
+    with Session(engine) as session:
+        for metric_name in leaderboards.METRICS:
+            members = session.execute(leaderboards.members_statement(metric_name, start, end)).all()
+            ranked = session.execute(leaderboards.ranking_statement(metric_name, start, end)).all()
+            rounded = lambda rows: sorted((*row[:5], round(float(row[5]), 9)) for row in rows) # CUME_DIST comes back as a 10-digit Decimal
+            assert rounded(leaderboards.rank(members)) == rounded(ranked)
@@ -0,0 +1,102 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import select, func, text, event
+from sqlalchemy.orm import Session
+from database import get_engine
+from create import Base, User, FitnessGoal, Workout, NutritionLog, SleepRecord, MoodLog, DailyWorkout, DailySleep
+from cache import SummaryCache
+import create
+import rollups
+import goal_progress
+import search
+import purge
+
+@pytest.fixture
+def engine(tmp_path):
+    '''A database with the search index, foreign keys enforced and two users with a few days of logs.'''
+    engine = get_engine(f"sqlite:///{tmp_path / 'purge.db'}")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        search.create_index(connection)
+    with Session(engine) as session:
+        for user_id in (1, 2):
+            session.add(User(id=user_id, name=f"User {user_id}", email=f"user{user_id}@example.com", bio="Trail runner"))
+            session.add(FitnessGoal(user_id=user_id, goal="Run a marathon"))
+            for day in range(1, 6):
+                session.add_all([
+                    Workout(user_id=user_id, date=date(2024, 3, day), duration=30, type="Running", intensity="Low", notes="Hill run"),
+                    NutritionLog(user_id=user_id, date=date(2024, 3, day), calories=500),
+                    SleepRecord(user_id=user_id, start_time=datetime(2024, 3, day, 23), end_time=datetime(2024, 3, day + 1, 7), quality="Good"),
+                    MoodLog(user_id=user_id, date=date(2024, 3, day), mood="Calm", stress_level=2),
+                ])
+        session.commit()
+    yield engine
+    engine.dispose()
+
+def count(connection, model, user_id=None):
+    statement = select(func.count()).select_from(model)
+    return connection.execute(statement if user_id is None else statement.where(model.user_id == user_id)).scalar()
+
+def test_purge_users_in_chunks(engine):
+    '''Every row of the purged user goes, in chunks; rollups, search entries and cached summaries follow.'''
+    summary_cache = SummaryCache()
+    summary_cache.get_or_compute('workouts', 1, None, ('workouts',), lambda: 'stale')
+    assert purge.purge_users(engine, [1, 3], chunk_size=2) == 1
+    with engine.connect() as connection:
+        for model in (FitnessGoal, Workout, NutritionLog, SleepRecord, MoodLog, DailyWorkout, DailySleep):
+            assert count(connection, model, 1) == 0
+            assert count(connection, model, 2) > 0
+        assert connection.execute(text("SELECT count(*) FROM notes_fts WHERE user_id = 1")).scalar() == 0
+        assert rollups.check(connection) == []
+    assert summary_cache.get_or_compute('workouts', 1, None, ('workouts',), lambda: 'fresh') == 'fresh'
+
+def test_deleting_a_user_through_the_session_cascades_in_the_database(engine):
+    '''passive_deletes leaves the children to ON DELETE CASCADE instead of loading them.'''
+    statements = []
+    with Session(engine) as session:
+        user = session.get(User, 2)
+        event.listen(engine, 'before_cursor_execute', lambda connection, cursor, statement, *args: statements.append(statement))
+        session.delete(user)
+        session.commit()
+    assert [statement.split()[0] for statement in statements] == ['DELETE'] # No SELECT of the user's rows before
+    with engine.connect() as connection:
+        assert count(connection, Workout, 2) == count(connection, DailyWorkout, 2) == 0
+        assert connection.execute(text("SELECT count(*) FROM notes_fts WHERE user_id = 2")).scalar() == 0
+
+def test_purge_before_a_cutoff_keeps_rollups_exact(engine):
+    '''Retention removes whole days before the cutoff, nights by the day they started; goal counters follow.'''
+    with Session(engine) as session:
+        session.add(FitnessGoal(user_id=1, goal="Run 2 hours", metric="workout_minutes", target=120, start_date=date(2024, 3, 1), target_date=date(2024, 3, 31)))
+        session.commit()
+    counts = purge.purge_before(engine, date(2024, 3, 3), chunk_size=3)
+    assert counts == {'workouts': 4, 'nutrition_logs': 4, 'sleep_records': 4, 'mood_logs': 4}
+    with engine.connect() as connection:
+        assert connection.execute(select(func.min(Workout.date))).scalar() == date(2024, 3, 3)
+        assert connection.execute(select(func.min(DailySleep.day))).scalar() == date(2024, 3, 3)
+        assert count(connection, FitnessGoal) == 3
+        assert connection.execute(select(FitnessGoal.progress, FitnessGoal.completed).where(FitnessGoal.metric.isnot(None))).one() == (90, False)
+        assert rollups.check(connection) == []
+        assert goal_progress.check(connection) == []
+
+def test_migration_adds_cascading_foreign_keys(tmp_path):
+    '''Tables created before ON DELETE CASCADE are rebuilt with their rows, indexes and search triggers.'''
+    engine = get_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, age INTEGER, gender VARCHAR, "
+                                "weight FLOAT, height FLOAT, email VARCHAR NOT NULL, bio TEXT)"))
+        connection.execute(text("CREATE TABLE workouts (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id), date DATE NOT NULL, "
+                                "duration FLOAT, type VARCHAR, intensity VARCHAR, calories_burned FLOAT, notes TEXT)"))
+        connection.execute(text("INSERT INTO users (id, name, email) VALUES (1, 'Olga Old', 'olga@example.com')"))
+        connection.execute(text("INSERT INTO workouts (user_id, date, notes) VALUES (1, '2024-03-01', 'Tempo run')"))
+    Base.metadata.create_all(engine)
+    create.add_cascading_foreign_keys(engine)
+    create.create_missing_indexes(engine)
+    with engine.begin() as connection:
+        search.create_index(connection)
+        assert create._foreign_keys_to_rebuild(connection) == []
+        assert count(connection, Workout, 1) == 1
+        assert connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'ix_workouts_user_id_date'")).scalar() == 1
+        connection.execute(text("DELETE FROM users WHERE id = 1"))
+        assert count(connection, Workout) == 0
+        assert connection.execute(text("SELECT count(*) FROM notes_fts")).scalar() == 0
+    engine.dispose()
@@ -0,0 +1,102 @@
+import pytest
+from datetime import date
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, FitnessGoal, Workout, NutritionLog
+from cache import SummaryCache
+import query_data
+
+@pytest.fixture
+def session(monkeypatch):
+    '''Point query_data at a fresh in-memory database for each test.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine, expire_on_commit=False)
+    monkeypatch.setattr(query_data, "Session", Session)
+    session = Session()
+    monkeypatch.setattr(query_data, "summary_cache", SummaryCache())
+    yield session
+    session.close()
+    engine.dispose()
+
+def test_nutrition_summary_uses_day_range(session, capsys):
+    '''Only meals logged on the requested day are summed.'''
+    user = User(name="Nina Nutrition", email="nina@example.com")
+    session.add(user)
+    session.flush()
+    session.add_all([
+        NutritionLog(user_id=user.id, date=date(2024, 3, 3), meal_type="Dinner", calories=900),
+        NutritionLog(user_id=user.id, date=date(2024, 3, 4), meal_type="Breakfast", calories=300),
+        NutritionLog(user_id=user.id, date=date(2024, 3, 4), meal_type="Lunch", calories=500),
+        NutritionLog(user_id=user.id, date=date(2024, 3, 5), meal_type="Breakfast", calories=700),
+    ])
+    session.commit()
+
+    query_data.get_nutrition_summary(user.id, "2024-03-04")
+    assert "Total Calories for 2024-03-04: 800" in capsys.readouterr().out
+
+def test_monthly_workout_summary_handles_december(session, capsys):
+    '''The month window ends at the first day of the next year.'''
+    user = User(name="Walt Workout", email="walt@example.com")
+    session.add(user)
+    session.flush()
+    session.add_all([
+        Workout(user_id=user.id, date=date(2023, 11, 30), duration=15, intensity="Low"),
+        Workout(user_id=user.id, date=date(2023, 12, 1), duration=30, intensity="High"),
+        Workout(user_id=user.id, date=date(2023, 12, 31), duration=45, intensity="High"),
+        Workout(user_id=user.id, date=date(2024, 1, 1), duration=60, intensity="Low"),
+    ])
+    session.commit()
+
+    query_data.get_monthly_workout_summary(user.id, 12, 2023)
+    output = capsys.readouterr().out
+    assert "Total Workout Duration this Month: 75.0 minutes" in output
+    assert "Workout Intensities Encountered: High" in output
+
+def explain_last_statement(engine, function, *args):
+    '''Run a reporting function and return the query plan of the last statement it issued.'''
+    statements = []
+    record = lambda conn, cursor, statement, parameters, context, executemany: statements.append((statement, parameters))
+    event.listen(engine, "before_cursor_execute", record)
+    function(*args)
+    event.remove(engine, "before_cursor_execute", record)
+
+    statement, parameters = statements[-1]
+    with engine.connect() as connection:
+        return [row[3] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters)]
+
+def test_range_queries_seek_composite_index(session):
+    '''The daily nutrition summary is answered by the (user_id, date) index, not a table scan.'''
+    plan = explain_last_statement(session.get_bind(), query_data.get_nutrition_summary, 1, "2024-03-04")
+    assert any("USING INDEX ix_nutrition_logs_user_id_date" in detail for detail in plan)
+
+def test_monthly_summary_seeks_rollup_primary_key(session):
+    '''The monthly summary reads the daily rollup rows of one user through their primary key.'''
+    plan = explain_last_statement(session.get_bind(), query_data.get_monthly_workout_summary, 1, 3, 2024)
+    assert any(detail.startswith("SEARCH daily_workouts") and "user_id=? AND day>? AND day<?" in detail for detail in plan)
+
+def test_keyset_pages_cover_history_once(session):
+    '''Pages continue after their (date, id) cursor, including across ties and NULL target dates.'''
+    user = User(name="Pia Pager", email="pia@example.com")
+    session.add(user)
+    session.flush()
+    session.add_all([Workout(user_id=user.id, date=date(2024, 3, 1 + index // 3), duration=index) for index in range(10)])
+    session.add_all([FitnessGoal(user_id=user.id, goal=f"Goal {index}", target_date=None if index < 2 else date(2024, 6, index)) for index in range(5)])
+    session.commit()
+
+    for fetch_page, iterate in ((query_data.get_user_workouts_page, query_data.iter_user_workouts),
+                                (query_data.get_user_fitness_goals_page, query_data.iter_user_fitness_goals)):
+        seen, cursor = [], None
+        while True:
+            rows, cursor = fetch_page(user.id, after=cursor, limit=3)
+            seen += [row.id for row in rows]
+            if cursor is None:
+                break
+        assert seen == [row.id for row in iterate(user.id, chunk_size=2)]
+        assert len(seen) == len(set(seen)) and len(seen) in (10, 5)
+
+def test_next_page_seeks_index_in_order(session):
+    '''A page after a cursor starts with an index seek and needs no sort, whatever the history length.'''
+    plan = explain_last_statement(session.get_bind(), query_data.get_user_workouts_page, 1, (date(2024, 3, 4), 10))
+    assert any("USING INDEX ix_workouts_user_id_date (user_id=? AND date>?)" in detail for detail in plan)
+    assert not any("TEMP B-TREE" in detail for detail in plan)
@@ -0,0 +1,57 @@
+import pytest
+from datetime import date, datetime
+from sqlalchemy import delete, insert, select
+from create import User, Workout, NutritionLog, SleepRecord, MoodLog, DailyWorkout, DailyNutrition, DailySleep, DailyMood
+import rollups
+
+def daily_workouts(session):
+    return session.execute(select(DailyWorkout.day, DailyWorkout.type, DailyWorkout.sessions, DailyWorkout.minutes).order_by(DailyWorkout.day)).all()
+
+def test_inserts_updates_and_deletes_maintain_rollups(session):
+    '''Every ORM write path keeps the daily rows equal to a recomputation from the log tables.'''
+    first = Workout(user_id=1, date=date(2024, 3, 1), duration=30, type="Yoga", intensity="Low")
+    second = Workout(user_id=1, date=date(2024, 3, 1), duration=45, type="Yoga", intensity="Low")
+    session.add_all([first, second,
+                     NutritionLog(user_id=1, date=date(2024, 3, 1), calories=400, proteins=20, carbs=50, fats=10),
+                     SleepRecord(user_id=1, start_time=datetime(2024, 3, 1, 23), end_time=datetime(2024, 3, 2, 6, 30), quality="Good", deep_sleep_duration=2),
+                     MoodLog(user_id=1, date=date(2024, 3, 1), mood="Calm", stress_level=3)])
+    session.commit()
+    assert daily_workouts(session) == [(date(2024, 3, 1), "Yoga", 2, 75)]
+    assert session.get(DailySleep, (1, date(2024, 3, 1), "Good")).hours == pytest.approx(7.5)
+
+    second.date = date(2024, 3, 2) # Moves the workout to another day
+    second.duration = 60
+    session.commit()
+    assert daily_workouts(session) == [(date(2024, 3, 1), "Yoga", 1, 30), (date(2024, 3, 2), "Yoga", 1, 60)]
+
+    session.delete(first)
+    session.commit()
+    assert daily_workouts(session) == [(date(2024, 3, 2), "Yoga", 1, 60)]
+    assert rollups.check(session.connection()) == []
+
+def test_deleting_a_user_clears_their_rollups(session):
+    '''ON DELETE CASCADE removes the logs and the rollup rows without loading them into the session.'''
+    session.add_all([Workout(user_id=1, date=date(2024, 3, 1), duration=30),
+                     MoodLog(user_id=1, date=date(2024, 3, 1), mood="Sad")])
+    session.commit()
+    session.delete(session.get(User, 1))
+    session.commit()
+    for table in (DailyWorkout, DailyNutrition, DailySleep, DailyMood):
+        assert session.scalars(select(table)).all() == []
+
+def test_check_finds_and_rebuild_repairs_drift(session):
+    '''Writes that bypass the ORM are reported by check() and fixed by rebuild().'''
+    session.add(Workout(user_id=1, date=date(2024, 3, 1), duration=30, type="Gym", intensity="High"))
+    session.commit()
+    connection = session.connection()
+    connection.execute(insert(Workout.__table__), [{"user_id": 1, "date": date(2024, 3, 1), "duration": 15, "type": "Gym", "intensity": "High"}])
+    connection.execute(insert(MoodLog.__table__), [{"user_id": 1, "date": date(2024, 3, 4), "mood": "Happy"}])
+    connection.execute(delete(DailyNutrition.__table__))
+    connection.execute(insert(DailyNutrition.__table__), [{"user_id": 1, "day": date(2024, 3, 9), "meals": 1, "calories": 100}])
+
+    problems = {(table, problem) for table, key, problem in rollups.check(connection)}
+    assert problems == {("daily_workouts", "stale"), ("daily_moods", "missing"), ("daily_nutrition", "orphaned")}
+
+    rollups.rebuild(connection, user_ids=[1])
+    assert rollups.check(connection) == []
+    assert daily_workouts(session) == [(date(2024, 3, 1), "Gym", 2, 45)]
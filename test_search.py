@@ -0,0 +1,96 @@
+from datetime import date, datetime
+import pytest
+from sqlalchemy import create_engine, insert, text
+from sqlalchemy.orm import Session
+from create import Base, User, Workout, SleepRecord, MoodLog
+import search
+
+@pytest.fixture
+def session():
+    '''An in-memory database with the search index and notes of two users.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        search.create_index(connection)
+    session = Session(engine)
+    session.add_all([
+        User(id=1, name="Ana Runner", email="ana@example.com", bio="Marathon runner recovering from a knee injury"),
+        User(id=2, name="Ben Lifter", email="ben@example.com"),
+        Workout(id=1, user_id=1, date=date(2024, 3, 1), notes="Easy run, knee felt sore afterwards"),
+        Workout(id=2, user_id=1, date=date(2024, 3, 8), notes="Intervals on the track, knee fine"),
+        Workout(id=3, user_id=2, date=date(2024, 3, 2), notes="Squats; knee pain on the last set"),
+        Workout(id=4, user_id=2, date=date(2024, 3, 3)),
+        SleepRecord(id=1, user_id=1, start_time=datetime(2024, 3, 1, 23), end_time=datetime(2024, 3, 2, 6), notes="Woke up with knee pain"),
+        MoodLog(id=1, user_id=2, date=date(2024, 3, 4), notes="Stressed about running late"),
+    ])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def found(hits):
+    return sorted((hit.kind, hit.source_id) for hit in hits)
+
+def test_search_filters_by_user_date_and_kind(session):
+    '''Words are all required and stemmed; user, day range and kind narrow the hits.'''
+    assert found(search.search_notes(session, "knee pain")[0]) == [('sleep', 1), ('workout', 3)]
+    assert found(search.search_notes(session, "runs")[0]) == [('mood', 1), ('workout', 1)] # run, running; not runner
+    assert found(search.search_notes(session, "knee", user_id=1)[0]) == [('bio', 1), ('sleep', 1), ('workout', 1), ('workout', 2)]
+    assert found(search.search_notes(session, "knee", user_id=1, start=date(2024, 3, 2), end=date(2024, 3, 9))[0]) == [('workout', 2)] # The night belongs to March 1, when it started
+    assert found(search.search_notes(session, "knee", kinds=['workout'])[0]) == [('workout', 1), ('workout', 2), ('workout', 3)]
+    assert found(search.search_notes(session, "interv*")[0]) == [('workout', 2)]
+    hit, = search.search_notes(session, "squats")[0]
+    assert (hit.user_id, hit.day, hit.snippet) == (2, '2024-03-02', "[Squats]; knee pain on the last set")
+    assert search.search_notes(session, "u1")[0] == [] # The owner tokens are not searchable text
+    with pytest.raises(ValueError):
+        search.search_notes(session, " * ")
+
+def test_pages_follow_the_ranking(session):
+    '''Keyset pages list every match once, best first or newest first.'''
+    everything, cursor = search.search_notes(session, "knee", limit=10)
+    assert cursor is None and len(everything) == 5
+    assert [hit.rank for hit in everything] == sorted(hit.rank for hit in everything)
+    pages, cursor = [], None
+    while True:
+        hits, cursor = search.search_notes(session, "knee", after=cursor, limit=2)
+        pages.extend(hits)
+        if cursor is None:
+            break
+    assert pages == everything
+
+    newest, cursor = search.search_notes(session, "knee", ranked=False, limit=3)
+    rest, last = search.search_notes(session, "knee", ranked=False, after=cursor, limit=3)
+    assert [(hit.kind, hit.source_id) for hit in newest + rest] == [('workout', 3), ('workout', 2), ('bio', 1), ('sleep', 1), ('workout', 1)] # By rowid, newest first
+    assert last is None and newest[0].rank is None
+
+def test_index_follows_writes_and_rebuild(session):
+    '''Inserts through Core, updates and deletes reach the index; rebuild recreates it from the sources.'''
+    session.execute(insert(Workout), [{"user_id": 2, "date": date(2024, 3, 5), "notes": "Deadlift personal best"}])
+    session.get(Workout, 3).notes = "Squats felt heavy"
+    session.delete(session.get(SleepRecord, 1))
+    session.get(User, 2).bio = "Powerlifter chasing a deadlift record"
+    session.commit()
+    assert found(search.search_notes(session, "deadlift")[0]) == [('bio', 2), ('workout', 5)]
+    assert search.search_notes(session, "knee pain")[0] == []
+
+    count = session.execute(text("SELECT count(*) FROM notes_fts")).scalar()
+    search.rebuild(session.connection())
+    assert session.execute(text("SELECT count(*) FROM notes_fts")).scalar() == count
+    assert found(search.search_notes(session, "deadlift")[0]) == [('bio', 2), ('workout', 5)]
+
+def test_updates_of_other_columns_leave_the_index_alone(session):
+    '''Only updates of the columns an entry is computed from rewrite it; older catch-all triggers are replaced.'''
+    def changes(statement):
+        before = session.execute(text("SELECT total_changes()")).scalar()
+        session.execute(text(statement))
+        return session.execute(text("SELECT total_changes()")).scalar() - before
+    assert changes("UPDATE workouts SET duration = 40 WHERE id = 1") == 1 # Just the row; total_changes() counts trigger writes too
+    assert changes("UPDATE users SET weight = 70 WHERE id = 1") == 1
+    assert changes("UPDATE workouts SET date = '2024-03-09' WHERE id = 1") > 1
+    assert found(search.search_notes(session, "sore", start=date(2024, 3, 9), end=date(2024, 3, 10))[0]) == [('workout', 1)]
+
+    connection = session.connection()
+    connection.exec_driver_sql("DROP TRIGGER workouts_notes_update")
+    connection.exec_driver_sql("CREATE TRIGGER workouts_notes_update AFTER UPDATE ON workouts BEGIN SELECT 1; END")
+    search.create_index(connection)
+    assert ' UPDATE OF ' in connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'workouts_notes_update'").scalar()
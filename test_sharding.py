@@ -0,0 +1,106 @@
+from datetime import date
+import pytest
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from cache import SummaryCache
+import leaderboards
+from sharding import ShardRouter
+import insert_data
+import query_data
+import rollups
+import search
+
+MARCH = (date(2024, 3, 1), date(2024, 4, 1))
+
+@pytest.fixture
+def router(tmp_path, monkeypatch):
+    '''Three shards with insert_data and query_data routed through them.'''
+    router = ShardRouter([f"sqlite:///{tmp_path / f'shard{shard}.db'}" for shard in range(3)], f"sqlite:///{tmp_path / 'directory.db'}")
+    router.create_all()
+    monkeypatch.setattr(insert_data, "DBSession", router.sessionmaker(expire_on_commit=False))
+    monkeypatch.setattr(query_data, "Session", router.sessionmaker(read_only=True, expire_on_commit=False))
+    monkeypatch.setattr(query_data, "summary_cache", SummaryCache())
+    yield router
+    router.dispose()
+
+def register(count):
+    '''Register `count` users through insert_data, each with one goal and `user_id` workouts in March'''
+    user_ids = []
+    for index in range(count):
+        user_id = insert_data.register_user_with_goals({"name": f"Shard User {index}", "email": f"shard{index}@example.com"},
+                                                       [{"goal": "Keep moving", "target_date": date(2024, 12, 31)}])
+        for day in range(1, user_id + 1):
+            insert_data.log_workout_and_update_goals(user_id, {"date": date(2024, 3, day), "duration": 10, "intensity": "Low"}, {})
+        user_ids.append(user_id)
+    return user_ids
+
+def rows_per_shard(router, user_id):
+    counts = []
+    for engine in router.engines.values():
+        with engine.connect() as connection:
+            counts.append(connection.execute(text("SELECT count(*) FROM workouts WHERE user_id = :user_id"), {"user_id": user_id}).scalar())
+    return counts
+
+def test_per_user_operations_are_routed(router, capsys):
+    '''Users get unique ids, their rows live on one shard only and reports find them there.'''
+    user_ids = register(6)
+    assert user_ids == [1, 2, 3, 4, 5, 6]
+    assert router.user_counts() == {0: 2, 1: 2, 2: 2}
+    assert rows_per_shard(router, 5) == [0, 5, 0]
+
+    capsys.readouterr()
+    query_data.get_monthly_workout_summary(5, 3, 2024)
+    assert "Total Workout Duration this Month: 50.0 minutes" in capsys.readouterr().out
+    workouts, cursor = query_data.get_user_workouts_page(5, limit=10)
+    assert len(workouts) == 5 and cursor is None
+
+def test_move_user_and_rebalance(router, capsys):
+    '''Moved users keep their rows, rollups and reports; rebalancing evens out the shards.'''
+    register(6)
+    router.move_user(5, 0)
+    assert rows_per_shard(router, 5) == [5, 0, 0]
+    capsys.readouterr()
+    query_data.get_monthly_workout_summary(5, 3, 2024)
+    assert "Total Workout Duration this Month: 50.0 minutes" in capsys.readouterr().out
+    for engine in router.engines.values():
+        with Session(engine) as session:
+            assert rollups.check(session.connection()) == []
+
+    assert router.user_counts() == {0: 3, 1: 1, 2: 2}
+    assert router.rebalance() == [(5, 0, 1)]
+    assert router.user_counts() == {0: 2, 1: 2, 2: 2}
+
+def test_cross_user_report_fans_out(router):
+    '''The process-pool report merges every shard's users in id order.'''
+    user_ids = register(5)
+    report = router.user_summaries(*MARCH, processes=2)
+    assert [user_id for user_id, _ in report] == user_ids
+    assert [dashboard.workouts.sessions for _, dashboard in report] == user_ids
+
+def test_notes_are_searchable_on_their_shard(router):
+    '''Every shard gets the search index, and a moved user's notes are indexed on the shard they move to.'''
+    register(3)
+    insert_data.log_workout_and_update_goals(2, {"date": date(2024, 3, 20), "duration": 45, "intensity": "High", "notes": "Hill sprints in the rain"}, {})
+
+    def hits(shard):
+        with Session(router.engines[shard]) as session:
+            return [(hit.user_id, hit.kind) for hit in search.search_notes(session, "sprints", user_id=2)[0]]
+    source = router.shard_for(2)
+    assert [hits(shard) for shard in router.engines] == [[(2, "workout")] if shard == source else [] for shard in router.engines]
+
+    target = next(shard for shard in router.engines if shard != source)
+    router.move_user(2, target)
+    assert [hits(shard) for shard in router.engines] == [[(2, "workout")] if shard == target else [] for shard in router.engines]
+
+def test_leaderboards_rank_users_across_shards(router):
+    '''Ranks and percentiles cover the users of every shard, and the top of a cohort merges the shards by rank.'''
+    register(6) # User n logs n ten-minute workouts, so user 6 leads
+    day = date(2024, 3, 6)
+    counts = router.refresh_leaderboards(day, metrics=['workout_minutes'], periods=['month'], processes=2)
+    assert counts == {('workout_minutes', 'month'): 6}
+    top = router.leaderboard_top('workout_minutes', 'month', k=4, day=day)
+    assert [(ranking.user_id, ranking.rank, ranking.cohort_size) for ranking in top] == [(6, 1, 6), (5, 2, 6), (4, 3, 6), (3, 4, 6)]
+    for user_id, top_fraction in ((6, 1 / 6), (1, 1.0)):
+        with Session(router.engines[router.shard_for(user_id)]) as session:
+            [ranking] = leaderboards.user_rankings(session, user_id, 'month', day)
+            assert (ranking.rank, ranking.top_fraction) == (7 - user_id, top_fraction)
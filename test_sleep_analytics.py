@@ -0,0 +1,75 @@
+from datetime import date, datetime, time
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import Session
+from create import Base, User, SleepRecord, add_missing_columns, backfill_sleep_durations, create_missing_indexes
+import rollups
+import sleep_analytics
+
+MARCH = (date(2024, 3, 1), date(2024, 4, 1))
+
+@pytest.fixture
+def session():
+    '''An in-memory database with one user and four nights in two weeks of March 2024.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    session.add(User(id=1, name="Sol Sleeper", email="sol@example.com"))
+    session.add_all([
+        SleepRecord(user_id=1, start_time=datetime(2024, 3, 4, 23), end_time=datetime(2024, 3, 5, 7), deep_sleep_duration=2), # Monday, 8 h
+        SleepRecord(user_id=1, start_time=datetime(2024, 3, 6, 0, 30), end_time=datetime(2024, 3, 6, 5, 30), deep_sleep_duration=1), # 5 h
+        SleepRecord(user_id=1, start_time=datetime(2024, 3, 11, 22, 30), end_time=datetime(2024, 3, 12, 6, 30)), # Next Monday, 8 h
+        SleepRecord(user_id=1, start_time=datetime(2024, 3, 12, 23), end_time=datetime(2024, 3, 13, 6)), # 7 h
+    ])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def test_duration_is_stored_on_insert_and_update(session):
+    '''The ORM fills duration_hours and keeps it, and the sleep rollup, in step with the times.'''
+    record = session.get(SleepRecord, 2)
+    assert record.duration_hours == 5
+    record.end_time = datetime(2024, 3, 6, 7)
+    session.commit()
+    assert session.get(SleepRecord, 2).duration_hours == 6.5
+    assert rollups.check(session.connection()) == []
+
+def test_sleep_metrics(session):
+    '''Weekly averages, sleep debt, bedtime consistency and deep-sleep ratio over March.'''
+    assert sleep_analytics.weekly_averages(session, 1, *MARCH) == [
+        sleep_analytics.WeeklySleep(date(2024, 3, 4), 2, 6.5, 1.5),
+        sleep_analytics.WeeklySleep(date(2024, 3, 11), 2, 7.5, None),
+    ]
+    assert sleep_analytics.sleep_debt(session, 1, *MARCH) == sleep_analytics.SleepDebt(nights=4, debt_hours=4, short_nights=1)
+
+    consistency = sleep_analytics.bedtime_consistency(session, 1, *MARCH)
+    assert consistency.mean_bedtime == time(23, 15) # 23:00, 00:30, 22:30 and 23:00 average across midnight
+    assert consistency.stddev_minutes == pytest.approx(((15 ** 2 + 75 ** 2 + 45 ** 2 + 15 ** 2) / 4) ** 0.5) # 45 minutes
+
+    ratio = sleep_analytics.deep_sleep_ratio(session, 1, *MARCH)
+    assert (ratio.nights, ratio.ratio) == (2, pytest.approx(3 / 13))
+    assert [record.duration_hours for record in sleep_analytics.short_nights(session, 1)] == [5]
+
+def test_duration_threshold_seeks_index(session):
+    '''"Nights under 6 hours" is answered from the (user_id, duration_hours) index.'''
+    plan = session.execute(text("EXPLAIN QUERY PLAN SELECT id FROM sleep_records WHERE user_id = 1 AND duration_hours < 6 ORDER BY duration_hours")).all()
+    assert any("ix_sleep_records_user_id_duration_hours (user_id=? AND duration_hours<?)" in row[3] for row in plan)
+    assert not any("TEMP B-TREE" in row[3] for row in plan)
+
+def test_migration_backfills_existing_records(tmp_path):
+    '''A database created before duration_hours existed gains the column, its values and its index.'''
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as connection:
+        connection.execute(text("CREATE TABLE sleep_records (id INTEGER PRIMARY KEY, user_id INTEGER, start_time DATETIME NOT NULL, "
+                                "end_time DATETIME NOT NULL, quality VARCHAR, deep_sleep_duration FLOAT, notes TEXT)"))
+        connection.execute(text("INSERT INTO sleep_records (user_id, start_time, end_time) VALUES (1, '2024-03-04 23:00:00.000000', '2024-03-05 06:30:00.000000')"))
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    backfill_sleep_durations(engine)
+    create_missing_indexes(engine)
+
+    with engine.connect() as connection:
+        assert connection.execute(text("SELECT duration_hours FROM sleep_records")).scalar() == pytest.approx(7.5)
+        assert connection.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'ix_sleep_records_user_id_duration_hours'")).scalar() == 1
+    engine.dispose()
@@ -0,0 +1,103 @@
+import pytest
+from datetime import date, datetime
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from create import Base, User, Workout, NutritionLog, SleepRecord, MoodLog
+import summaries
+
+START, END = date(2024, 3, 1), date(2024, 4, 1)
+
+@pytest.fixture
+def session():
+    '''A fresh in-memory database with one user and a month of logs.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    user = User(id=1, name="Dana Dashboard", email="dana@example.com")
+    session.add_all([
+        user,
+        Workout(user_id=1, date=date(2024, 3, 2), duration=30, intensity="Low", calories_burned=200),
+        Workout(user_id=1, date=date(2024, 3, 9), duration=60, intensity="High", calories_burned=600),
+        Workout(user_id=1, date=date(2024, 4, 1), duration=90, intensity="Medium", calories_burned=900), # Outside the window
+        NutritionLog(user_id=1, date=date(2024, 3, 2), calories=500, proteins=20, carbs=60, fats=10),
+        NutritionLog(user_id=1, date=date(2024, 3, 31), calories=700, proteins=30, carbs=80, fats=25),
+        SleepRecord(user_id=1, start_time=datetime(2024, 3, 2, 22), end_time=datetime(2024, 3, 3, 6), quality="Good"),
+        SleepRecord(user_id=1, start_time=datetime(2024, 3, 3, 23), end_time=datetime(2024, 3, 4, 5), quality="Poor"),
+        MoodLog(user_id=1, date=date(2024, 3, 2), mood="Happy", stress_level=2),
+        MoodLog(user_id=1, date=date(2024, 3, 3), mood="Happy", stress_level=4),
+        MoodLog(user_id=1, date=date(2024, 3, 4), mood="Stressed", stress_level=9),
+    ])
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def test_metric_summaries(session):
+    '''Each metric is aggregated inside SQLite over the half-open window.'''
+    assert summaries.nutrition_summary(session, 1, START, END) == summaries.NutritionSummary(2, 1200, 50, 140, 35)
+    assert summaries.workout_summary(session, 1, START, END) == summaries.WorkoutSummary(2, 90, 800, ("High", "Low"))
+
+    sleep = summaries.sleep_overview(session, 1, START, END)
+    assert sleep.quality_counts == {"Poor": 1, "Fair": 0, "Good": 1, "Excellent": 0}
+    assert sleep.average_hours == pytest.approx(7)
+
+    mood = summaries.mood_trends(session, 1, START, END)
+    assert mood.mood_counts == {"Happy": 2, "Stressed": 1}
+    assert mood.average_stress == pytest.approx(5)
+
+def test_empty_window(session):
+    '''A window without logs gives zero totals rather than None.'''
+    board = summaries.dashboard(session, 1, date(2020, 1, 1), date(2020, 2, 1))
+    assert board.nutrition == summaries.NutritionSummary()
+    assert board.workouts == summaries.WorkoutSummary()
+    assert board.sleep.nights == 0 and board.sleep.average_hours is None
+    assert board.mood.mood_counts == {}
+
+def test_dashboard_is_one_statement(session):
+    '''The whole dashboard is fetched in a single round trip and matches the per-metric calls.'''
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+    board = summaries.dashboard(session, 1, START, END)
+
+    assert len(statements) == 1
+    assert board == summaries.Dashboard(
+        summaries.nutrition_summary(session, 1, START, END),
+        summaries.workout_summary(session, 1, START, END),
+        summaries.sleep_overview(session, 1, START, END),
+        summaries.mood_trends(session, 1, START, END),
+    )
+
+def test_batch_summaries_match_single_user_dashboards(session):
+    '''The batch variant gives every requested user the same panels as the single-user dashboard.'''
+    session.add_all([
+        User(id=2, name="Eli Empty", email="eli@example.com", age=40, gender="Male"),
+        User(id=3, name="Fay Fit", email="fay@example.com", age=35, gender="Female"),
+        Workout(user_id=3, date=date(2024, 3, 5), duration=45, intensity="Medium", calories_burned=400),
+        MoodLog(user_id=3, date=date(2024, 3, 5), mood="Calm", stress_level=1),
+    ])
+    session.query(User).filter(User.id == 1).update({"age": 30, "gender": "Female"})
+    session.commit()
+
+    batch = dict(summaries.iter_user_summaries(session, START, END, user_ids=[3, 1, 2], chunk_size=2))
+    assert list(batch) == [1, 2, 3]
+    for user_id, board in batch.items():
+        assert board == summaries.dashboard(session, user_id, START, END)
+    assert batch[2].workouts == summaries.WorkoutSummary()
+
+def test_cohort_summaries_scan_each_table_once(session):
+    '''A cohort report issues one statement for the cohort plus one grouped scan per log table.'''
+    session.add_all([User(id=2, name="Gil Gym", email="gil@example.com", age=33, gender="Male"),
+                     User(id=3, name="Hal Hike", email="hal@example.com", age=61, gender="Male"),
+                     Workout(user_id=2, date=date(2024, 3, 5), duration=20, intensity="Low", calories_burned=100),
+                     Workout(user_id=3, date=date(2024, 3, 5), duration=50, intensity="Low", calories_burned=300)])
+    session.commit()
+    statements = []
+    event.listen(session.get_bind(), "before_cursor_execute", lambda *args: statements.append(args[2]))
+
+    cohort = list(summaries.iter_user_summaries(session, START, END, cohort=summaries.Cohort(min_age=30, max_age=39, gender="Male")))
+    assert [user_id for user_id, _ in cohort] == [2]
+    assert cohort[0][1].workouts.total_duration == 20
+    assert len(statements) == 5
+
+    everyone = list(summaries.iter_user_summaries(session, START, END))
+    assert [user_id for user_id, _ in everyone] == [1, 2, 3]
@@ -0,0 +1,79 @@
+import io
+import threading
+import time
+from contextlib import redirect_stdout
+from datetime import date
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session, sessionmaker
+from create import Base, User, FitnessGoal, Workout
+from database import get_engine
+import insert_data
+import query_data
+import rollups
+
+WORKOUTS_PER_USER = 4
+
+def stress(directory, threads, users_per_thread):
+    '''Register users and log workouts from `threads` threads through insert_data and query_data.
+
+    Returns the writer engine, the errors raised in the threads and the operations per second.
+    '''
+    url = f"sqlite:///{directory / f'stress_{threads}.db'}"
+    writer, reader = get_engine(url), get_engine(url, read_only=True)
+    Base.metadata.create_all(writer)
+    insert_data.DBSession = sessionmaker(bind=writer, expire_on_commit=False)
+    query_data.Session = sessionmaker(bind=reader)
+    errors = []
+
+    def worker(thread_id):
+        try:
+            for index in range(users_per_thread):
+                user_id = insert_data.register_user_with_goals(
+                    {"name": f"Thread {thread_id} user {index}", "email": f"t{thread_id}u{index}@example.com"},
+                    [{"goal": "Stay consistent", "target_date": date(2024, 12, 31)}])
+                goal_id = None
+                for day in range(1, WORKOUTS_PER_USER + 1):
+                    goal_updates = {goal_id: True} if goal_id else {}
+                    insert_data.log_workout_and_update_goals(user_id, {"date": date(2024, 3, day), "duration": 30, "intensity": "Low"}, goal_updates)
+                    query_data.get_monthly_workout_summary(user_id, 3, 2024)
+                    if goal_id is None:
+                        with Session(reader) as session:
+                            goal_id = session.scalar(select(FitnessGoal.id).where(FitnessGoal.user_id == user_id))
+        except Exception as error: # Reported to the main thread, which fails the test
+            errors.append(error)
+
+    workers = [threading.Thread(target=worker, args=(thread_id,)) for thread_id in range(threads)]
+    started = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+    elapsed = time.perf_counter() - started
+    operations = threads * users_per_thread * (1 + 2 * WORKOUTS_PER_USER)
+    reader.dispose()
+    return writer, errors, operations / elapsed
+
+def test_concurrent_writes_and_reads_stay_consistent(tmp_path, monkeypatch):
+    '''Every thread's writes land exactly once and the rollups match the raw rows.'''
+    monkeypatch.setattr(insert_data, "DBSession", insert_data.DBSession)
+    monkeypatch.setattr(query_data, "Session", query_data.Session)
+    writer, errors, _ = stress(tmp_path, threads=8, users_per_thread=5)
+
+    assert errors == []
+    with Session(writer) as session:
+        assert session.scalar(select(func.count()).select_from(User)) == 40
+        per_user = session.execute(select(Workout.user_id, func.count()).group_by(Workout.user_id)).all()
+        assert len(per_user) == 40 and {count for _, count in per_user} == {WORKOUTS_PER_USER}
+        assert session.scalar(select(func.count()).select_from(FitnessGoal).where(FitnessGoal.completed)) == 40
+        assert rollups.check(session.connection()) == []
+    writer.dispose()
+
+if __name__ == "__main__":
+    import tempfile
+    from pathlib import Path
+    with tempfile.TemporaryDirectory() as directory:
+        for threads in (1, 2, 4, 8):
+            writer, errors, throughput = stress(Path(directory), threads, users_per_thread=10)
+            writer.dispose()
+            print(f"{threads} thread(s): {throughput:,.0f} operations/s, {len(errors)} error(s)")
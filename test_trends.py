@@ -0,0 +1,70 @@
+from datetime import date, datetime, timedelta
+import math
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from create import Base, User, Workout, NutritionLog, SleepRecord, MoodLog
+import rollups # noqa: F401 (keeps the daily rollups the trends read up to date)
+import trends
+
+WINDOW = (date(2024, 3, 1), date(2024, 3, 15)) # Two weeks, the last day being March 14
+
+@pytest.fixture
+def session():
+    '''An in-memory database with three users; user 1 logs a bit of everything in early March 2024.'''
+    engine = create_engine("sqlite:///:memory:")
+    Base.metadata.create_all(engine)
+    session = Session(engine)
+    session.add_all([User(id=user_id, name=f"Trend User {user_id}", email=f"trend{user_id}@example.com") for user_id in (1, 2, 3)])
+    session.add_all([Workout(user_id=1, date=date(2024, 3, day), duration=30, calories_burned=100) for day in (1, 2, 3, 5, 6, 13, 14)])
+    session.add(Workout(user_id=2, date=date(2024, 3, 14), duration=45, calories_burned=300))
+    session.add_all([
+        NutritionLog(user_id=1, date=date(2024, 3, 13), calories=2000),
+        NutritionLog(user_id=1, date=date(2024, 3, 14), calories=1000),
+        NutritionLog(user_id=1, date=date(2024, 3, 14), calories=500),
+    ])
+    for day, hours, stress in ((1, 8, 2), (2, 7, 4), (3, 6, 6), (4, 5, 8)): # Less sleep, more stress the next day
+        start = datetime(2024, 3, day, 23)
+        session.add(SleepRecord(user_id=1, start_time=start, end_time=start + timedelta(hours=hours)))
+        session.add(MoodLog(user_id=1, date=date(2024, 3, day + 1), mood="Tense", stress_level=stress))
+    session.commit()
+    yield session
+    session.close()
+    engine.dispose()
+
+def test_load_daily_series_keeps_requested_users_only(session):
+    '''Rows of users in the id range but not requested are dropped; users without logs get zero rows.'''
+    series = trends.load_daily_series(session, [3, 1], *WINDOW)
+    assert series.user_ids.tolist() == [1, 3]
+    assert series.workouts.shape == (2, 14)
+    assert series.days[0] == np.datetime64('2024-03-01') and len(series.days) == 14
+    assert series.workouts[0].tolist() == [1, 1, 1, 0, 1, 1, 0, 0, 0, 0, 0, 0, 1, 1]
+    assert series.calories_in[0, 13] == 1500 and series.meals[0, 13] == 2
+    assert not series.workouts[1].any()
+
+def test_trend_summary(session):
+    '''Trailing means, energy balance, streaks and the stress/sleep correlation, in chunks of two users.'''
+    summary = trends.trend_summary(session, *WINDOW, chunk_size=2)
+    assert summary.user_ids.tolist() == [1, 2, 3]
+    first = summary.for_user(1)
+    assert first['calories_in_7d'] == 1750
+    assert first['energy_balance_7d'] == 1650 # (2000 - 100 + 1500 - 100) / 2 days with meals
+    assert first['workout_minutes_7d'] == pytest.approx(60 / 7)
+    assert math.isnan(first['sleep_hours_7d']) and first['sleep_hours_28d'] == 6.5
+    assert (first['current_streak'], first['longest_streak']) == (2, 3)
+    assert first['stress_sleep_correlation'] == pytest.approx(-1)
+
+    second = summary.for_user(2)
+    assert (second['current_streak'], second['longest_streak']) == (1, 1)
+    assert math.isnan(second['calories_in_28d']) and math.isnan(second['stress_sleep_correlation'])
+    with pytest.raises(KeyError):
+        summary.for_user(4)
+    assert len(trends.trend_summary(session, *WINDOW, user_ids=[])) == 0
+
+def test_user_trends(session):
+    '''Rolling means over every day, NaN until the window reaches a logged day.'''
+    rolling = trends.user_trends(session, 1, *WINDOW, window=3)
+    assert rolling.workout_minutes[0, :4].tolist() == [30, 30, 30, 20] # Days before the window are unknown, not rest days
+    assert rolling.sleep_hours[0, :5].tolist() == [8, 7.5, 7, 6, 5.5]
+    assert np.isnan(rolling.calories_in[0, 11]) and rolling.calories_in[0, 13] == 1750
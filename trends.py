@@ -0,0 +1,196 @@
+from dataclasses import dataclass, fields
+from itertools import chain
+import numpy as np
+from sqlalchemy import select, func, cast, Integer
+from create import DailyNutrition, DailyWorkout, DailySleep, DailyMood
+from summaries import Cohort
+
+# Trend metrics over dense per-user daily series. Each daily rollup table is read with one grouped
+# range scan per chunk of users and scattered into (users x days) float32 matrices, so every metric
+# below is a handful of whole-array NumPy operations instead of a Python loop over rows. Windows are
+# half-open [start, end) ranges of days; days without logs hold 0 and are told apart by their counts.
+
+CHUNK_USERS = 2000 # Users loaded at a time; each matrix of a chunk takes CHUNK_USERS x days x 4 bytes
+MIN_CORRELATION_DAYS = 3 # Fewer paired days than this give a NaN correlation
+
+_SERIES_COLUMNS = ( # Rollup table and the series filled from its measures, summed per user and day
+    (DailyNutrition, {'calories_in': DailyNutrition.calories, 'meals': DailyNutrition.meals}),
+    (DailyWorkout, {'calories_burned': DailyWorkout.calories_burned, 'workout_minutes': DailyWorkout.minutes, 'workouts': DailyWorkout.sessions}),
+    (DailySleep, {'sleep_hours': DailySleep.hours, 'nights': DailySleep.nights}),
+    (DailyMood, {'stress_total': DailyMood.stress_total, 'stress_entries': DailyMood.stress_entries}),
+)
+
+@dataclass(frozen=True)
+class DailySeries:
+    """Dense daily series of several users; every matrix has one row per user and one column per day"""
+    user_ids: np.ndarray # Sorted user ids, in row order
+    start: object # Date of the first column
+    calories_in: np.ndarray
+    meals: np.ndarray # Nutrition logs per day
+    calories_burned: np.ndarray
+    workout_minutes: np.ndarray
+    workouts: np.ndarray # Workout sessions per day
+    sleep_hours: np.ndarray # Hours slept in the nights starting that day
+    nights: np.ndarray
+    stress_total: np.ndarray # Sum of the stress levels logged that day
+    stress_entries: np.ndarray
+
+    @property
+    def days(self):
+        """Date of every column, as numpy datetime64[D]"""
+        first = np.datetime64(self.start, 'D')
+        return np.arange(first, first + self.calories_in.shape[1])
+
+@dataclass(frozen=True)
+class RollingTrends:
+    """Trailing `window`-day means for every user and day; NaN until a window holds any logged day"""
+    user_ids: np.ndarray
+    start: object
+    window: int
+    calories_in: np.ndarray
+    calories_burned: np.ndarray
+    energy_balance: np.ndarray # Calories eaten minus calories burned, over days with meals logged
+    workout_minutes: np.ndarray # Over all days, so rest days count as zero
+    sleep_hours: np.ndarray # Over nights logged
+
+@dataclass(frozen=True)
+class TrendSummary:
+    """Trend metrics at the end of a window, one array element per user"""
+    user_ids: np.ndarray
+    calories_in_7d: np.ndarray
+    calories_in_28d: np.ndarray
+    energy_balance_7d: np.ndarray
+    energy_balance_28d: np.ndarray
+    sleep_hours_7d: np.ndarray
+    sleep_hours_28d: np.ndarray
+    workout_minutes_7d: np.ndarray
+    workout_minutes_28d: np.ndarray
+    current_streak: np.ndarray # Consecutive days with a workout up to the last day of the window
+    longest_streak: np.ndarray
+    stress_sleep_correlation: np.ndarray # Pearson r of a day's mean stress and the previous night's sleep
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def for_user(self, user_id):
+        """Metrics of one user as a dict of Python scalars"""
+        row = int(np.searchsorted(self.user_ids, user_id))
+        if row == len(self.user_ids) or self.user_ids[row] != user_id:
+            raise KeyError(user_id)
+        return {field.name: getattr(self, field.name)[row].item() for field in fields(self)}
+
+    @classmethod
+    def concatenate(cls, parts):
+        """Join the summaries of consecutive chunks of users"""
+        if not parts:
+            return cls(*[np.empty(0, dtype=np.int64 if field.name in ('user_ids', 'current_streak', 'longest_streak') else np.float32) for field in fields(cls)])
+        return cls(*[np.concatenate([getattr(part, field.name) for part in parts]) for field in fields(cls)])
+
+def load_daily_series(session, user_ids, start, end):
+    """Load the daily series of `user_ids` over [start, end) with one query per rollup table"""
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+    shape = (len(user_ids), (end - start).days)
+    matrices = {}
+    for model, columns in _SERIES_COLUMNS:
+        for name in columns:
+            matrices[name] = np.zeros(shape, dtype=np.float32)
+        if not len(user_ids):
+            continue
+        day_index = cast(func.julianday(model.day) - func.julianday(start.isoformat()), Integer)
+        statement = select(model.user_id, day_index, *[func.sum(column) for column in columns.values()]).\
+            where(model.user_id.between(int(user_ids[0]), int(user_ids[-1])), model.day >= start, model.day < end).\
+            group_by(model.user_id, model.day) # A range over the rollup primary key, already in (user_id, day) order
+        rows = session.connection().execute(statement).all() # Core rows, skipping the ORM result machinery
+        rows = np.fromiter(chain.from_iterable(rows), dtype=np.float64, count=len(rows) * (2 + len(columns))).reshape(-1, 2 + len(columns))
+        row_users = rows[:, 0].astype(np.int64)
+        positions = np.searchsorted(user_ids, row_users).clip(max=len(user_ids) - 1)
+        members = user_ids[positions] == row_users # The id range may include users outside the requested set
+        days = rows[members, 1].astype(np.intp)
+        for offset, name in enumerate(columns, start=2):
+            matrices[name][positions[members], days] = rows[members, offset]
+    return DailySeries(user_ids, start, **matrices)
+
+def _trailing_sums(matrix, window):
+    """Sum of every trailing `window`-day span, for each user and day"""
+    totals = np.cumsum(matrix, axis=1, dtype=np.float64)
+    sums = totals.copy()
+    sums[:, window:] -= totals[:, :-window]
+    return sums
+
+def rolling_mean(values, present, window):
+    """Trailing `window`-day mean of `values` over the days where `present` is positive; NaN without any"""
+    counts = _trailing_sums(present > 0, window)
+    sums = _trailing_sums(values, window)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan).astype(np.float32)
+
+def trailing_mean(values, present, window):
+    """Mean of `values` over the days of the last `window` where `present` is positive; NaN without any"""
+    counts = (present[:, -window:] > 0).sum(axis=1)
+    sums = values[:, -window:].sum(axis=1, dtype=np.float64)
+    return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan).astype(np.float32)
+
+def energy_balance(series):
+    """Calories eaten minus calories burned, per user and day"""
+    return series.calories_in - series.calories_burned
+
+def workout_streaks(workouts):
+    """(current, longest) runs of consecutive days with at least one workout, per user"""
+    active = workouts > 0
+    runs = np.cumsum(active, axis=1)
+    resets = np.maximum.accumulate(np.where(active, 0, runs), axis=1) # Active days counted before the last rest day
+    lengths = runs - resets
+    if not lengths.shape[1]:
+        return np.zeros(len(lengths), dtype=np.int64), np.zeros(len(lengths), dtype=np.int64)
+    return lengths[:, -1].astype(np.int64), lengths.max(axis=1).astype(np.int64)
+
+def stress_sleep_correlation(series):
+    """Pearson correlation between each day's mean stress level and the hours slept the night before, per user"""
+    paired = (series.stress_entries[:, 1:] > 0) & (series.nights[:, :-1] > 0)
+    stress = np.where(paired, series.stress_total[:, 1:] / np.maximum(series.stress_entries[:, 1:], 1), 0.0)
+    sleep = np.where(paired, series.sleep_hours[:, :-1], 0.0)
+    count = paired.sum(axis=1)
+    safe_count = np.maximum(count, 1)[:, None]
+    stress_deviation = np.where(paired, stress - stress.sum(axis=1)[:, None] / safe_count, 0.0)
+    sleep_deviation = np.where(paired, sleep - sleep.sum(axis=1)[:, None] / safe_count, 0.0)
+    scale = np.sqrt((stress_deviation ** 2).sum(axis=1) * (sleep_deviation ** 2).sum(axis=1))
+    covariance = (stress_deviation * sleep_deviation).sum(axis=1)
+    valid = (count >= MIN_CORRELATION_DAYS) & (scale > 0)
+    return np.where(valid, covariance / np.where(valid, scale, 1), np.nan).astype(np.float32)
+
+def rolling_trends(series, window=7):
+    """Trailing `window`-day means of every series, for each user and day"""
+    return RollingTrends(series.user_ids, series.start, window,
+                         rolling_mean(series.calories_in, series.meals, window),
+                         rolling_mean(series.calories_burned, np.ones_like(series.calories_burned), window),
+                         rolling_mean(energy_balance(series), series.meals, window),
+                         rolling_mean(series.workout_minutes, np.ones_like(series.workout_minutes), window),
+                         rolling_mean(series.sleep_hours, series.nights, window))
+
+def summarize(series):
+    """TrendSummary of the users in `series` at the last day of its window"""
+    balance = energy_balance(series)
+    every_day = np.ones_like(series.workout_minutes)
+    current, longest = workout_streaks(series.workouts)
+    return TrendSummary(
+        series.user_ids,
+        trailing_mean(series.calories_in, series.meals, 7), trailing_mean(series.calories_in, series.meals, 28),
+        trailing_mean(balance, series.meals, 7), trailing_mean(balance, series.meals, 28),
+        trailing_mean(series.sleep_hours, series.nights, 7), trailing_mean(series.sleep_hours, series.nights, 28),
+        trailing_mean(series.workout_minutes, every_day, 7), trailing_mean(series.workout_minutes, every_day, 28),
+        current, longest, stress_sleep_correlation(series))
+
+def iter_trend_summaries(session, start, end, user_ids=None, cohort=None, chunk_size=CHUNK_USERS):
+    """Yield a TrendSummary per chunk of `chunk_size` users, for `user_ids`, a `Cohort` or (with neither) every user"""
+    if user_ids is None:
+        user_ids = session.scalars((cohort or Cohort()).user_ids()).all()
+    user_ids = np.unique(np.asarray(user_ids, dtype=np.int64))
+    for offset in range(0, len(user_ids), chunk_size):
+        yield summarize(load_daily_series(session, user_ids[offset:offset + chunk_size], start, end))
+
+def trend_summary(session, start, end, user_ids=None, cohort=None, chunk_size=CHUNK_USERS):
+    """One TrendSummary for every requested user, ordered by user id"""
+    return TrendSummary.concatenate(list(iter_trend_summaries(session, start, end, user_ids, cohort, chunk_size)))
+
+def user_trends(session, user_id, start, end, window=7):
+    """RollingTrends of a single user, e.g. for a coach's chart"""
+    return rolling_trends(load_daily_series(session, [user_id], start, end), window)